@@ -12,206 +12,3468 @@ Usage:
     python scripts/security-review-action.py --repo-dir /path/to/repo
     python scripts/security-review-action.py --repo-dir . --max-files 30
     python scripts/security-review-action.py --repo-dir . --skill-path skills/security-review/SKILL.md
+    python scripts/security-review-action.py --repo-dir . --sharded --workers 8
+    python scripts/security-review-action.py --repo-dir . --base origin/main
+    python scripts/security-review-action.py --repo-dir . --cache-dir ~/.cache/soundcheck
+    python scripts/security-review-action.py --repo-dir . --sharded --route-skills
+    python scripts/security-review-action.py --repo-dir . --token-budget 150000 --plan
+    python scripts/security-review-action.py --repo-dir . --sharded --batch
+    python scripts/security-review-action.py --repo-dir . --sarif soundcheck.sarif --jsonl out.jsonl
+    python scripts/security-review-action.py --repo-dir . --monorepo --max-files 20
+    python scripts/security-review-action.py --repo-dir . --sharded --cascade
+    python scripts/security-review-action.py --repo-dir . --sharded --two-phase
+    python scripts/security-review-action.py --repo-dir . --sharded --compact
+    python scripts/security-review-action.py --repo-dir . --map-reduce
+    python scripts/security-review-action.py --repo-dir . --callee-context
+    python scripts/security-review-action.py --repo-dir . --update-baseline
+    python scripts/security-review-action.py --repo-dir . --watch --cache-dir ~/.cache/soundcheck
+    python scripts/security-review-action.py --repo-dir . --sharded --batch --batch-id msgbatch_...
 
 Exit codes:
     0 — no Critical or High findings
     1 — Critical or High findings present (use to fail a blocking check)
 """
 
+import abc
 import argparse
+import ast
+import difflib
+import hashlib
 import json
+import math
 import os
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable
 
 import anthropic
 
 SCRIPT_DIR = Path(__file__).parent
-DEFAULT_SKILL_PATH = SCRIPT_DIR.parent / "skills" / "security-review" / "SKILL.md"
+DEFAULT_SKILLS_DIR = SCRIPT_DIR.parent / "skills"
+DEFAULT_SKILL_PATH = DEFAULT_SKILLS_DIR / "security-review" / "SKILL.md"
 
 MODEL = "claude-sonnet-4-6"
-MAX_FILE_BYTES = 50_000    # truncate files larger than 50 KB
+TRIAGE_MODEL = "claude-haiku-4-5"  # first stage of --cascade
+TRIAGE_MIN_CONFIDENCE = 0.2  # escalate Medium+ candidates at or above this confidence
+MAX_FILE_BYTES = 50_000    # split files larger than 50 KB into chunks of this size
+MAX_CHUNKED_FILE_BYTES = 2_000_000  # skip files over 2 MB outright (dumps, bundles)
+MAX_HEADER_BYTES = 4_000   # imports/globals repeated with each chunk of a large file
 MAX_TOTAL_BYTES = 200_000  # stop adding files after 200 KB total
 DEFAULT_MAX_FILES = 50
+MAX_OUTPUT_TOKENS = 8192
+FIX_SEVERITIES = ("Critical", "High", "Medium")  # findings that get a patch or rewrite
+MAX_CONTINUATIONS = 3  # times a review cut off at max_tokens is resumed via prefill
+DEFAULT_SHARD_TOKENS = 60_000  # input-token budget per request in --sharded mode
+MAX_REDUCE_TOKENS = 150_000  # summaries per --map-reduce reduce request, in input tokens
+DEFAULT_WORKERS = 4
+CHARS_PER_TOKEN = 3.5  # fallback estimate for unknown file types
+# Characters per input token by file suffix; --calibrate replaces these with
+# ratios measured by the token-counting endpoint on a sample of the repo.
+CHARS_PER_TOKEN_BY_SUFFIX = {
+    ".py": 3.6, ".js": 3.2, ".ts": 3.3, ".go": 3.3, ".java": 3.7,
+    ".rb": 3.4, ".php": 3.2, ".cs": 3.7, ".rs": 3.3, ".md": 4.0,
+}
+MINIFIED_CHARS_PER_TOKEN = 2.5  # minified code tokenizes densely
+MINIFIED_LINE_CHARS = 200  # average line length above which code counts as minified
+CALIBRATION_SAMPLES = 3  # files per suffix sent to the token-counting endpoint
+# (input, output) USD per million tokens, for --plan cost projections.
+# Cache reads bill at 0.1x input and cache writes at 1.25x input.
+MODEL_PRICING = {
+    "claude-sonnet-4-6": (3.00, 15.00),
+    "claude-haiku-4-5": (1.00, 5.00),
+    "claude-opus-4-6": (5.00, 25.00),
+}
+READ_WORKERS = 16  # threads used to read candidate files
+BINARY_SNIFF_BYTES = 8192  # a NUL byte in this prefix marks a file as binary
+CHURN_WINDOW = "180.days"  # git history window used for churn in risk ranking
+MAX_CONTEXT_FILES = 10  # imported files sent alongside changed files in --base mode
+MAX_CALLEE_LINES = 40  # lines of each referenced definition sent with --callee-context
+MAX_CALLEE_BYTES = 8_000  # referenced definitions sent per reviewed file
+VERIFY_WORKERS = os.cpu_count() or 4  # processes for post-edit syntax checks
+VERIFY_TIMEOUT = 30  # seconds per `node --check`
+BATCH_POLL_SECONDS = 60
+DEFAULT_BATCH_STATE = "/tmp/soundcheck-batch.json"
+DEFAULT_WATCH_CACHE = "/tmp/soundcheck-watch-cache"  # --watch cache without --cache-dir
+WATCH_POLL_SECONDS = 0.5
+WATCH_DEBOUNCE_SECONDS = 1.0  # quiet time after the last save before reviewing
+DEFAULT_CACHE_BYTES = 100_000_000  # evict least-recently-used entries beyond 100 MB
+DEFAULT_BASELINE = ".soundcheck-baseline.json"  # accepted findings, committed at the repo root
+FINGERPRINT_WINDOW = 2  # non-blank lines each side that anchor a finding outside any definition
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+SARIF_LEVELS = {"Critical": "error", "High": "error", "Medium": "warning", "Low": "note"}
+# GitHub code scanning buckets alerts by this 0-10 score, read from the SARIF rule
+SECURITY_SEVERITY = {"Critical": "9.5", "High": "7.5", "Medium": "5.0", "Low": "2.0"}
 
 SOURCE_GLOBS = [
     "**/*.py", "**/*.js", "**/*.ts", "**/*.go",
     "**/*.java", "**/*.rb", "**/*.php", "**/*.cs", "**/*.rs",
 ]
+# Files marking the root of a package in --monorepo mode
+PACKAGE_MARKERS = ("pyproject.toml", "setup.py", "package.json", "go.mod", "Cargo.toml")
 SKIP_DIRS = {"node_modules", ".venv", "venv", "dist", "build", ".git", "__pycache__"}
+SOURCE_SUFFIXES = [Path(pattern).suffix for pattern in SOURCE_GLOBS]
+# Files generated, bundled or copied in from elsewhere rather than written here,
+# by path; classify_file() skips them (see also its content checks).
+GENERATED_PATH_PATTERNS = [
+    (re.compile(r"_pb2(_grpc)?\.py$|(_grpc)?\.pb(\.gw)?\.go$|_(grpc_)?pb\.[jt]s$"),
+     "protobuf/gRPC stub"),
+    (re.compile(r"[.-]min\.js$|[.-]bundle\.js$"), "minified"),
+    (re.compile(r"(^|/)(vendor|vendored|third_party|third-party|bower_components)/"),
+     "vendored"),
+    (re.compile(r"(^|/)__snapshots__/|\.snap\.[jt]s$"), "snapshot"),
+    (re.compile(r"\.d\.ts$|\.g\.cs$|\.Designer\.cs$|(^|/)zz_generated\.|_generated\.\w+$"),
+     "generated"),
+]
+# Mechanical but occasionally security-relevant (raw SQL): kept, ranked last.
+DEMOTED_PATH_PATTERNS = [
+    (re.compile(r"(^|/)(migrations|alembic/versions|db/migrate)/"), "migration"),
+]
+# Tool-written marker comments near the top of a generated file ("Code generated
+# ... DO NOT EDIT.", "@generated"): the file is skipped.
+GENERATED_MARKER = re.compile(
+    r"^\s*(#|//|/?\*|--|[\"']{3})\s*(<auto-generated>|@generated\b|(.*\b)?do not edit\b)",
+    re.IGNORECASE,
+)
+# Prose that merely says a file is generated ("Auto-generated by ..."): ranked last,
+# since the same words open hand-written docstrings too.
+GENERATED_HINT = re.compile(
+    r"^\s*(#|//|/?\*|--|[\"']{3})\s*(this (file|code) (is|was|has been) )?"
+    r"(auto-?generated|automatically generated|generated (by|from))\b",
+    re.IGNORECASE,
+)
+# Preserved license banner of a bundled third-party library ("/*! jQuery v3.6.0 ...")
+LIBRARY_BANNER = re.compile(
+    r"/\*!\s*[\w.\- ]+?\s+v?\d+\.\d+|@license\s+[\w.\- ]+?\s+v?\d+\.\d+"
+)
+GENERATED_HEADER_LINES = 10  # lines searched for GENERATED_MARKER and GENERATED_HINT
+LINGUIST_ATTRIBUTES = ("linguist-generated", "linguist-vendored")
+
+# Machine-readable output formats shared by the review, findings and fix prompts.
+EDIT_FORMAT = """\
+For each file with a Critical, High, or Medium finding, output one patch block
+containing one or more search/replace hunks:
+
+<soundcheck-patch file="relative/path/to/file">
+<<<<<<< SEARCH
+exact lines copied from the original file, enough to match in exactly one place
+=======
+replacement lines
+>>>>>>> REPLACE
+</soundcheck-patch>
+
+Only if most of a file changes, output the complete rewritten file instead:
+
+<soundcheck-rewrite file="relative/path/to/file">
+complete rewritten file content
+</soundcheck-rewrite>
+"""
+
+FINDINGS_FORMAT = """\
+<soundcheck-findings>
+[
+  {
+    "severity": "Critical|High|Medium|Low",
+    "file": "relative/path/to/file",
+    "line": 42,
+    "skill": "skill-name",
+    "finding": "one-line description"
+  }
+]
+</soundcheck-findings>
+"""
+
+SEVERITY_DEFINITIONS = """\
+Severity definitions:
+- Critical: exploitable remotely, no authentication required
+- High: exploitable with authentication, or significant data exposure
+- Medium: limited exploitability or requires user interaction
+- Low: defense-in-depth / informational
+"""
+
+# Appended to the skill's own system prompt to request structured output.
+SYSTEM_SUFFIX = f"""
+---
+
+After your findings table and prose rewrites, output all results in the following
+machine-readable format so they can be applied automatically.
+
+{EDIT_FORMAT}
+Then output a JSON findings list ("line" is the 1-based line of the vulnerable code
+in the file as shown to you):
+
+{FINDINGS_FORMAT}
+{SEVERITY_DEFINITIONS}"""
+
+# Phase one of --two-phase: findings only, every affected file is fixed separately.
+FINDINGS_SUFFIX = f"""
+---
+
+Review the following repository files for security issues and identify all
+vulnerabilities. Do not write patches, rewrites or prose in this pass: each
+affected file is fixed in a separate request. Files labelled `path#Lstart-Lend`
+are excerpts of a larger file: report them by that exact label. Output only a
+JSON findings list ("line" is the 1-based line of the vulnerable code in the file
+as shown to you):
+
+{FINDINGS_FORMAT}
+{SEVERITY_DEFINITIONS}"""
+
+# Phase two of --two-phase: fix the given findings in one file.
+FIX_SUFFIX = f"""
+---
+
+Fix the security findings listed after the file below, using search/replace
+patches unless most of the file changes. Output only the machine-readable edits,
+with no findings list and no prose. If the file is labelled `path#Lstart-Lend`,
+use that exact label and edit only the lines below the ⋮ marker.
+
+{EDIT_FORMAT}"""
+
+# Replaces SYSTEM_SUFFIX and the review instructions in the --cascade triage pass.
+TRIAGE_SUFFIX = """
+---
+
+This is a fast triage pass over repository files. Do not write patches, rewrites
+or prose. Output only candidate security issues as a single JSON list, with your
+confidence (0.0-1.0) that each is real; a stronger reviewer confirms every
+candidate you report, so include anything plausibly exploitable. Files labelled
+`path#Lstart-Lend` are excerpts of a larger file: report candidates in them under
+that exact label.
+
+<soundcheck-findings>
+[
+  {
+    "severity": "Critical|High|Medium|Low",
+    "file": "relative/path/to/file",
+    "confidence": 0.7,
+    "finding": "one-line description"
+  }
+]
+</soundcheck-findings>
+
+Output an empty list if nothing looks vulnerable.
+
+""" + SEVERITY_DEFINITIONS
+
+# System prompt for the --map-reduce map pass (no skill: it summarizes, not reviews).
+MAP_PROMPT = """\
+You summarize repository files for a security reviewer who will not see their
+source. For every file below, output one entry in a single JSON list. Name
+functions, routes and parameters exactly as they appear in the code; use [] for
+anything that does not apply and keep each entry under 80 words:
+
+<soundcheck-findings>
+[
+  {
+    "file": "relative/path/to/file",
+    "entry_points": ["POST /upload -> upload(request)"],
+    "sinks": ["subprocess.run(cmd, shell=True) in run_cmd(cmd)"],
+    "auth": ["@login_required on upload"],
+    "trust_boundaries": ["request.files reaches save_file(name)"],
+    "calls": ["app/utils/shell.py: run_cmd"]
+  }
+]
+</soundcheck-findings>
+
+Output nothing else.
+"""
+
+# System prompt for the --map-reduce reduce pass over every file summary.
+REDUCE_PROMPT = """\
+You are planning a security review of a repository too large to read in full.
+The user turn is a JSON list with one summary per file: its entry points,
+dangerous sinks, authentication checks, trust boundaries and the other files it
+calls into. Trace how untrusted input can travel from entry points through
+calls to sinks, across files, and pick the flows worth a full-source review:
+missing or bypassable auth in front of a sink, input reaching a sink through a
+helper in another file, secrets crossing a trust boundary. A single file with a
+dangerous sink of its own is a flow of one file.
+
+Output only a JSON list, most severe first, naming every file a reviewer needs
+to judge each flow (entry point, helpers and sink):
+
+<soundcheck-findings>
+[
+  {
+    "files": ["app/routes.py", "app/utils/shell.py"],
+    "severity": "Critical|High|Medium|Low",
+    "flow": "unauthenticated POST /run passes a form field to run_cmd (shell=True)"
+  }
+]
+</soundcheck-findings>
+
+Output an empty list if no flow looks exploitable.
+"""
+
+USER_PROMPT_HEADER = """\
+Review the following repository files for security issues. Identify all \
+vulnerabilities. Fix every file that has a Critical, High, or Medium finding — \
+output search/replace patches, not complete files, unless most of the file changes.
+Files labelled `path#Lstart-Lend` are excerpts of a larger file: refer to them by \
+that exact label in patches, rewrites and findings, and edit only the lines below \
+the ⋮ marker — the lines above it are the file's shared imports and globals.
+
+"""
+
+
+# Deterministic trigger index for --route-skills, distilled from each skill's
+# "Vulnerable patterns" section. A file is reviewed by a skill only if one of
+# that skill's patterns matches. Skills about plans, manifests or datasets
+# (threat-model, supply-chain, training-data-poisoning) have no source triggers.
+SKILL_TRIGGERS: dict[str, list[str]] = {
+    "injection": [
+        r"\b(SELECT|INSERT|UPDATE|DELETE)\b.{0,60}\b(FROM|INTO|SET|WHERE)\b",
+        r"\b(execute|executemany|raw|query)\s*\(\s*f?[\"'`]",
+        r"\b(subprocess|os\.system|os\.popen|child_process|shell_exec)\b",
+        r"\b(exec\.Command|Process\.Start|Runtime\.getRuntime)\b",
+        r"\b(eval|exec)\s*\(", r"render_template_string|Template\(|\$where|\.find\(\s*\{",
+    ],
+    "authentication-failures": [
+        r"\b(login|logout|password|passwd|session|jwt|bcrypt|argon2|mfa|totp)\b",
+        r"(API|SECRET|AUTH)_?KEY\s*=\s*[\"']",
+    ],
+    "broken-access-control": [
+        r"@(app|router|bp|blueprint)\.(route|get|post|put|delete|patch)",
+        r"\bapp\.(get|post|put|delete)\(",
+        r"req\.(params|query|body)|request\.(args|params|form|json)|HttpServletRequest",
+        r"\b(fetch|axios|requests\.(get|post)|urlopen|http\.Get)\s*\(",
+        r"\b(admin|owner_id|user_id)\b",
+    ],
+    "cryptographic-failures": [
+        r"\b(hashlib|md5|sha1|Cipher|AES|DES|RSA|crypto|ssl|tls|verify\s*=\s*False)\b",
+        r"\b(random\.random|Math\.random|rand\(\))", r"SECRET_KEY\s*=\s*[\"']",
+    ],
+    "exceptional-conditions": [
+        r"\bexcept\b|\bcatch\s*\(|\brescue\b|\brecover\(\)", r"debug\s*=\s*True",
+    ],
+    "excessive-agency": [
+        r"\b(agent|tool_use|tool_calls|function_call|send_email|delete_record)\b",
+    ],
+    "insecure-design": [
+        r"\b(login|checkout|payment|transfer|reset_password|signup|register|step)\b",
+    ],
+    "insecure-local-storage": [
+        r"localStorage|sessionStorage|SharedPreferences|NSUserDefaults|UserDefaults",
+        r"NamedTemporaryFile|mkstemp|json\.dump\(|\.write\(.{0,40}(token|secret|password|key)",
+    ],
+    "insecure-output-handling": [
+        r"innerHTML|dangerouslySetInnerHTML|v-html|\|\s*safe\b|Markup\(",
+        r"\b(completion|llm|response|output)\w*.{0,40}\b(eval|exec|execute|shell=True)\b",
+    ],
+    "insecure-plugin-design": [
+        r"\b(tools|functions)\s*=\s*\[|\binput_schema\b|\bparameters\b.{0,20}\"type\"",
+    ],
+    "integrity-failures": [
+        r"\b(pickle|marshal|shelve|yaml\.load|unserialize|BinaryFormatter|ObjectInputStream)\b",
+        r"\b(urlretrieve|download|update_url)\b",
+    ],
+    "ipc-security": [
+        r"android:exported|BroadcastReceiver|NSXPCConnection|open\s*url:|createServer|\.listen\(",
+        r"\bsocket\b|ipcMain|postMessage",
+    ],
+    "llm-supply-chain": [
+        r"from_pretrained|hf_hub_download|torch\.load|load_model|model_id|:latest",
+    ],
+    "logging-failures": [
+        r"\b(logger|logging|log)\.(debug|info|warn|warning|error|critical)\b|console\.(log|error)",
+    ],
+    "mcp-security": [
+        r"\bmcp\b|FastMCP|@\w+\.tool\b|McpServer|call_tool|list_tools",
+    ],
+    "model-dos": [
+        r"\b(messages\.create|chat\.completions|completions\.create|generate\(|max_tokens)",
+    ],
+    "model-theft": [
+        r"\b(logprobs|embeddings?|inference|predict)\b.{0,80}\b(route|endpoint|app\.|router)",
+        r"@(app|router)\.\w+\(.{0,40}(predict|infer|embed|generate)",
+    ],
+    "multi-agent-trust": [
+        r"\b(subagent|sub_agent|orchestrator|worker_agent|agent_to_agent|a2a|handoff)\b",
+    ],
+    "oauth-implementation": [
+        r"\b(oauth|oidc|redirect_uri|authorization_code|id_token|access_token|jwt\.decode|jwks)\b",
+    ],
+    "overreliance": [
+        r"\b(completion|llm_response|model_output|response\.content)\b"
+        r".{0,80}\b(approve|merge|deploy|diagnos|decision)",
+        r"\b(diagnos\w*|auto_(deploy|merge|approve)\w*|deploy_to_production)\b",
+    ],
+    "prompt-injection": [
+        r"\b(system_prompt|prompt|messages)\b\s*[+=].{0,80}(\{|\+|format\()",
+        r"\b(anthropic|openai|langchain|llama_index|ChatCompletion|messages\.create)\b",
+    ],
+    "rag-security": [
+        r"\b(retriever|vectorstore|vector_store|similarity_search|embeddings?)\b",
+        r"\b(chroma|pinecone|faiss|weaviate|qdrant)\b",
+        r"\bretriev\w*|\b(doc|document|context)\w*\s*\+?=.{0,60}\b(prompt|SYSTEM)",
+    ],
+    "security-misconfiguration": [
+        r"\bcors\b|Access-Control-Allow-Origin|debug\s*=\s*True|DEBUG\s*=\s*True|ALLOWED_HOSTS",
+        r"(password|passwd)\s*=\s*[\"'][^\"']+[\"']|Strict-Transport-Security|X-Frame-Options",
+    ],
+    "sensitive-disclosure": [
+        r"(system_prompt|prompt|messages).{0,80}\b(ssn|dob|email|password|api_key|user)\b",
+        r"\b(OPENAI|ANTHROPIC)_API_KEY\b",
+    ],
+    "token-smuggling": [
+        r"unicodedata|normalize\(|\\u202[a-e]|\\u200[b-d]|homoglyph|confusable",
+        r"\b(prompt|messages)\b.{0,80}\b(user_input|review|comment|content)\b",
+    ],
+}
+_SKILL_TRIGGER_RES = {
+    skill: re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+    for skill, patterns in SKILL_TRIGGERS.items()
+}
+
+
+def route_skills(content: str) -> list[str]:
+    """Return the skills whose trigger patterns match content, in SKILL_TRIGGERS order."""
+    return [skill for skill, regex in _SKILL_TRIGGER_RES.items() if regex.search(content)]
+
+
+def skill_groups(
+    files: list[tuple[str, str]], skills_dir: Path
+) -> tuple[list[tuple[str | None, str, list[tuple[str, str]]]], list[str]]:
+    """
+    Route each file to the skills it triggers and group files per skill.
+    Returns (groups, unrouted) where each group is (skill_name, SKILL.md text,
+    files) and unrouted lists files that matched no trigger.
+    """
+    routed: dict[str, list[tuple[str, str]]] = {}
+    unrouted: list[str] = []
+    for rel, content in files:
+        skills = route_skills(content)
+        if not skills:
+            unrouted.append(rel)
+        for skill in skills:
+            routed.setdefault(skill, []).append((rel, content))
+    groups = []
+    for skill, skill_files in routed.items():
+        skill_path = skills_dir / skill / "SKILL.md"
+        if not skill_path.is_file():
+            print(f"  [skip] skill {skill} — {skill_path} not found", file=sys.stderr)
+            continue
+        groups.append((skill, skill_path.read_text(encoding="utf-8"), skill_files))
+    return groups, unrouted
+
+
+def _is_source_path(rel_path: str) -> bool:
+    path = Path(rel_path)
+    if any(skip in path.parts for skip in SKIP_DIRS):
+        return False
+    return path.suffix in SOURCE_SUFFIXES
+
+
+def _gitignore_rule(base: str, line: str) -> tuple[str, re.Pattern, bool, bool] | None:
+    """Compile one .gitignore line into (base, regex, negated, dir_only)."""
+    line = line.rstrip("\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    # A slash at the start or in the middle anchors the pattern to the .gitignore's dir
+    anchored = "/" in line
+    line = line.lstrip("/")
+    if not line:
+        return None
+    out = ""
+    i = 0
+    while i < len(line):
+        if line.startswith("**/", i):
+            out += "(?:.*/)?"
+            i += 3
+        elif line.startswith("/**", i) and i + 3 == len(line):
+            out += "/.*"
+            i += 3
+        elif line[i] == "*":
+            out += "[^/]*"
+            i += 1
+        elif line[i] == "?":
+            out += "[^/]"
+            i += 1
+        elif line[i] == "[" and "]" in line[i + 1:]:
+            close = line.index("]", i + 1)
+            body = line[i + 1:close]
+            # Only a leading ! negates; elsewhere it is a literal member
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out += "[" + body + "]"
+            i = close + 1
+        else:
+            out += re.escape(line[i])
+            i += 1
+    prefix = "^" if anchored else "^(?:.*/)?"
+    return base, re.compile(prefix + out + "$"), negated, dir_only
+
+
+def _is_ignored(rules: list, rel_path: str, is_dir: bool) -> bool:
+    ignored = False
+    for base, regex, negated, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        if base:
+            if not rel_path.startswith(base + "/"):
+                continue
+            local = rel_path[len(base) + 1:]
+        else:
+            local = rel_path
+        if regex.match(local):
+            ignored = not negated
+    return ignored
+
+
+def walk_source_files(repo_dir: Path) -> list[str]:
+    """
+    Walk repo_dir once with os.scandir and return relative source paths.
+
+    SKIP_DIRS and directories matched by .gitignore files (including nested
+    ones) are pruned before descending. Symlinks are not followed. Paths are
+    ordered by SOURCE_GLOBS, then by path, as the per-glob walk used to be.
+    """
+    found: list[str] = []
+    stack: list[tuple[str, list]] = [("", [])]
+    while stack:
+        rel_dir, rules = stack.pop()
+        abs_dir = repo_dir / rel_dir if rel_dir else repo_dir
+        gitignore = abs_dir / ".gitignore"
+        if gitignore.is_file():
+            try:
+                lines = gitignore.read_text(encoding="utf-8", errors="replace").splitlines()
+            except OSError:
+                lines = []
+            rules = rules + [r for r in (_gitignore_rule(rel_dir, l) for l in lines) if r]
+        try:
+            entries = list(os.scandir(abs_dir))
+        except OSError:
+            continue
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIP_DIRS and not _is_ignored(rules, rel, True):
+                        stack.append((rel, rules))
+                elif entry.is_file(follow_symlinks=False):
+                    suffix = os.path.splitext(entry.name)[1]
+                    if suffix in SOURCE_SUFFIXES and not _is_ignored(rules, rel, False):
+                        found.append(rel)
+            except OSError:
+                continue
+    def order(rel: str) -> tuple[int, list[str]]:
+        return SOURCE_SUFFIXES.index(os.path.splitext(rel)[1]), rel.split("/")
+
+    return sorted(found, key=order)
+
+
+# Path fragments that suggest security-relevant code, with ranking weights.
+RISK_PATH_HINTS = [
+    (re.compile(r"auth|login|logout|session|passw|token|oauth|jwt|sso|mfa|acl|permission"), 5.0),
+    (re.compile(r"crypt|secret|key|cert|sign"), 4.0),
+    (re.compile(r"route|handler|controller|view|endpoint|api|webhook|middleware|server"), 3.0),
+    (re.compile(r"admin|upload|payment|billing|account|user"), 3.0),
+    (re.compile(r"config|settings|setup|env"), 2.0),
+    (re.compile(r"agent|tool|prompt|llm|rag|mcp"), 2.0),
+]
+LOW_RISK_PATH_HINTS = re.compile(
+    r"(^|/)(tests?|__tests__|spec|fixtures?|mocks?|examples?|docs?|benchmarks?)(/|$)"
+    r"|[._-](test|spec)\.\w+$|(^|/)test_[^/]*$"
+)
+
+# Sensitive APIs whose presence makes a file worth reviewing first.
+RISK_CONTENT_PATTERNS = [
+    (re.compile(
+        r"\b(subprocess|os\.system|os\.popen|child_process|exec\.Command|Runtime\.getRuntime)\b"
+    ), 4.0),
+    (re.compile(r"\b(eval|exec)\s*\("), 4.0),
+    (re.compile(
+        r"\b(pickle|marshal|yaml\.load|unserialize|BinaryFormatter|ObjectInputStream)\b"
+    ), 4.0),
+    (re.compile(
+        r"\b(SELECT|INSERT|UPDATE|DELETE)\b.{0,40}\b(FROM|INTO|SET|WHERE)\b", re.IGNORECASE
+    ), 3.0),
+    (re.compile(r"\b(jwt|bcrypt|hashlib|crypto|Cipher|md5|sha1|random\.random)\b"), 3.0),
+    (re.compile(
+        r"\b(request\.|req\.(body|query|params)|@app\.route|@router\.|HttpServletRequest)"
+    ), 3.0),
+    (re.compile(r"\b(innerHTML|dangerouslySetInnerHTML|render_template_string|Markup)\b"), 3.0),
+    (re.compile(r"\b(anthropic|openai|langchain|llama_index|messages\.create)\b"), 2.0),
+    (re.compile(r"\b(requests\.(get|post)|urllib|fetch\(|http\.Get|open\()"), 1.0),
+]
+
+
+@lru_cache(maxsize=None)
+def git_churn(repo_dir: Path) -> dict[str, int]:
+    """Count commits touching each path within CHURN_WINDOW; empty if git fails."""
+    try:
+        log = subprocess.run(
+            ["git", "log", f"--since={CHURN_WINDOW}", "--name-only", "--relative", "--format="],
+            cwd=repo_dir, capture_output=True, text=True, check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    churn: dict[str, int] = {}
+    for name in log.splitlines():
+        if name:
+            churn[name] = churn.get(name, 0) + 1
+    return churn
+
+
+def risk_score(rel_path: str, content: str, size: int, churn: int = 0) -> float:
+    """
+    Cheap local estimate of how likely a file is to hold Critical/High issues,
+    from path hints, sensitive API usage, recent git churn and size.
+    """
+    lowered = rel_path.lower()
+    score = sum(weight for pattern, weight in RISK_PATH_HINTS if pattern.search(lowered))
+    if LOW_RISK_PATH_HINTS.search(lowered):
+        score -= 6.0
+    score += sum(weight for pattern, weight in RISK_CONTENT_PATTERNS if pattern.search(content))
+    score += min(math.log2(1 + churn), 4.0)
+    # Prefer substantive files, but don't let sheer size dominate
+    score += min(math.log10(1 + size), 4.5) / 2
+    return score
+
+
+@lru_cache(maxsize=None)
+def linguist_rules(repo_dir: Path) -> tuple[tuple[re.Pattern, str, bool], ...]:
+    """
+    (regex, attribute, value) for every linguist-generated or
+    linguist-vendored setting in the repo's root .gitattributes, in file
+    order, so the last matching rule wins as it does for git.
+    """
+    try:
+        text = (repo_dir / ".gitattributes").read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return ()
+    rules: list[tuple[re.Pattern, str, bool]] = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or fields[0].startswith("#"):
+            continue
+        rule = _gitignore_rule("", fields[0])
+        if rule is None:
+            continue
+        for attr in fields[1:]:
+            name, _, setting = attr.lstrip("-!").partition("=")
+            if name in LINGUIST_ATTRIBUTES and not attr.startswith("!"):
+                value = not attr.startswith("-") and setting.lower() not in ("false", "0")
+                rules.append((rule[1], name, value))
+    return tuple(rules)
+
+
+def classify_file(
+    rel_path: str, content: str, rules: tuple[tuple[re.Pattern, str, bool], ...] = ()
+) -> tuple[str, str] | None:
+    """
+    Cheap check for files not worth the review budget. Returns ("skip",
+    reason) for generated, minified, vendored and snapshot files,
+    ("demote", reason) for files to rank last, or None for ordinary source.
+    .gitattributes linguist rules come first: set, they skip the file; unset
+    (linguist-generated=false), they keep it whatever the heuristics say.
+    """
+    attributes: dict[str, bool] = {}
+    for regex, name, value in rules:
+        if regex.match(rel_path):
+            attributes[name] = value
+    for name in LINGUIST_ATTRIBUTES:
+        if attributes.get(name):
+            return "skip", name
+    if attributes:
+        return None
+
+    for pattern, reason in GENERATED_PATH_PATTERNS:
+        if pattern.search(rel_path):
+            return "skip", reason
+    # Checked before the header: Django and Alembic stamp migrations "Generated by"
+    for pattern, reason in DEMOTED_PATH_PATTERNS:
+        if pattern.search(rel_path):
+            return "demote", reason
+    head = content[:2000]
+    header = head.splitlines()[:GENERATED_HEADER_LINES]
+    if any(GENERATED_MARKER.match(line) for line in header):
+        return "skip", "generated"
+    if LIBRARY_BANNER.search(head):
+        return "skip", "vendored"
+    lines = content.count("\n") + 1
+    if len(content) > 1000 and len(content) / lines > MINIFIED_LINE_CHARS:
+        return "skip", "minified"
+    if any(GENERATED_HINT.match(line) for line in header):
+        return "demote", "possibly generated"
+    return None
+
+
+def _read_source(path: Path) -> tuple[str, int] | None:
+    """
+    Read a source file once, returning (content, size_in_bytes), or None if it
+    is unreadable, looks binary, or exceeds MAX_CHUNKED_FILE_BYTES. Files over
+    MAX_FILE_BYTES are returned whole; chunk_files() splits them for review.
+    """
+    try:
+        raw = path.read_bytes()
+    except OSError:
+        return None
+    if b"\0" in raw[:BINARY_SNIFF_BYTES] or len(raw) > MAX_CHUNKED_FILE_BYTES:
+        return None
+    return raw.decode("utf-8", errors="replace"), len(raw)
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+@dataclass
+class BlobIndex:
+    """Content hashes of collected files, so each unique blob is reviewed once."""
+    by_hash: dict[str, str] = field(default_factory=dict)  # sha256 -> canonical path
+    copies: dict[str, list[str]] = field(default_factory=dict)  # canonical -> other paths
+
+
+def collect_files(
+    repo_dir: Path,
+    max_files: int | None,
+    max_total_bytes: int | None = MAX_TOTAL_BYTES,
+    include: list[str] | None = None,
+    rank: bool = True,
+    max_total_tokens: int | None = None,
+    dropped: list[str] | None = None,
+    candidates: list[str] | None = None,
+    blobs: BlobIndex | None = None,
+    classify: bool = True,
+    skipped: list[tuple[str, str]] | None = None,
+) -> list[tuple[str, str]]:
+    """
+    Collect source files from repo_dir, respecting size and count limits.
+    A limit of None disables that limit (used by --sharded); max_total_tokens
+    budgets estimated input tokens instead of bytes.
+    If include is given, only those relative paths are read, in that order.
+    Otherwise the repo is walked (or `candidates`, already-walked paths such
+    as one package's files, are used), and when the candidates exceed a limit
+    and rank is set, they are ordered by risk_score() first so the budget goes
+    to the riskiest files.
+    Paths cut by the budget are appended to `dropped` if given.
+    With `blobs`, a file byte-identical to one already collected (in this call
+    or an earlier one sharing the index) is recorded as its copy instead of
+    being returned, and costs no budget.
+    With `classify`, generated, minified, vendored and snapshot files are
+    left out before any budgeting and migrations are ranked last (see
+    classify_file); each left-out (path, reason) is appended to `skipped`,
+    as is every file over MAX_CHUNKED_FILE_BYTES.
+    Returns a list of (relative_path, content) tuples.
+    """
+    if include is not None:
+        candidates = [
+            rel for rel in dict.fromkeys(include)
+            if _is_source_path(rel) and (repo_dir / rel).is_file()
+        ]
+    elif candidates is None:
+        candidates = walk_source_files(repo_dir)
+
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        contents = list(pool.map(lambda rel: _read_source(repo_dir / rel), candidates))
+    readable = [(rel, read) for rel, read in zip(candidates, contents) if read is not None]
+    oversized = [
+        rel for rel, read in zip(candidates, contents)
+        if read is None and _file_size(repo_dir / rel) > MAX_CHUNKED_FILE_BYTES
+    ]
+    if oversized:
+        print(f"  [size] skipped {len(oversized)} file(s) over "
+              f"{MAX_CHUNKED_FILE_BYTES // 1_000_000} MB: {', '.join(oversized[:5])}"
+              + (", ..." if len(oversized) > 5 else ""))
+        if skipped is not None:
+            skipped += [(rel, "too large") for rel in oversized]
+    demoted: set[str] = set()
+    if classify:
+        rules = linguist_rules(repo_dir)
+        ordinary = []
+        left_out: dict[str, int] = {}
+        for rel, read in readable:
+            verdict = classify_file(rel, read[0], rules)
+            if verdict is None or verdict[0] == "demote":
+                ordinary.append((rel, read))
+                if verdict is not None:
+                    demoted.add(rel)
+                continue
+            left_out[verdict[1]] = left_out.get(verdict[1], 0) + 1
+            if skipped is not None:
+                skipped.append((rel, verdict[1]))
+        if left_out:
+            reasons = ", ".join(f"{n} {reason}" for reason, n in sorted(left_out.items()))
+            print(f"  [classify] skipped {len(readable) - len(ordinary)} file(s): {reasons}")
+        readable = ordinary
+    tokens = {
+        rel: estimate_tokens(content, os.path.splitext(rel)[1])
+        for rel, (content, _) in readable
+    } if max_total_tokens is not None else {}
+
+    over_budget = (
+        (max_files is not None and len(readable) > max_files)
+        or (max_total_bytes is not None
+            and sum(size for _, (_, size) in readable) > max_total_bytes)
+        or (max_total_tokens is not None and sum(tokens.values()) > max_total_tokens)
+    )
+    if include is None and rank and over_budget:
+        churn = git_churn(repo_dir)
+        scores = {
+            rel: risk_score(rel, content, size, churn.get(rel, 0))
+            for rel, (content, size) in readable
+        }
+        # Stable sort keeps the walk order among equally scored files
+        readable.sort(key=lambda item: (item[0] in demoted, -scores[item[0]]))
+
+    files: list[tuple[str, str]] = []
+    copied: set[str] = set()
+    total_bytes = 0
+    total_tokens = 0
+    for rel, (content, size) in readable:
+        digest = ""
+        if blobs is not None:
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            if digest in blobs.by_hash:
+                blobs.copies.setdefault(blobs.by_hash[digest], []).append(rel)
+                copied.add(rel)
+                continue
+        # Skip rather than stop: a smaller file further down may still fit
+        if max_files is not None and len(files) >= max_files:
+            continue
+        if max_total_bytes is not None and total_bytes + size > max_total_bytes:
+            continue
+        if max_total_tokens is not None and total_tokens + tokens[rel] > max_total_tokens:
+            continue
+        files.append((rel, content))
+        total_bytes += size
+        total_tokens += tokens.get(rel, 0)
+        if blobs is not None:
+            blobs.by_hash[digest] = rel
+
+    kept = {rel for rel, _ in files} | copied
+    if dropped is not None:
+        dropped += [rel for rel, _ in readable if rel not in kept]
+    if len(kept) < len(readable):
+        ranked = "lower-ranked " if include is None and rank else ""
+        unique = len(readable) - len(copied)
+        print(f"  [budget] kept {len(files)} of {unique} file(s); "
+              f"dropped {unique - len(files)} {ranked}file(s)")
+    return files
+
+
+def assign_packages(repo_dir: Path, paths: list[str]) -> dict[str, list[str]]:
+    """
+    Group paths by their nearest enclosing package root: the deepest
+    directory holding one of PACKAGE_MARKERS, or "." if none does. Groups and
+    the paths within them keep the order of `paths`.
+    """
+    nearest: dict[str, str] = {}
+
+    def root_of(directory: str) -> str:
+        if directory not in nearest:
+            if any((repo_dir / directory / marker).is_file() for marker in PACKAGE_MARKERS):
+                nearest[directory] = directory or "."
+            elif not directory:
+                nearest[directory] = "."
+            else:
+                nearest[directory] = root_of(os.path.dirname(directory))
+        return nearest[directory]
+
+    packages: dict[str, list[str]] = {}
+    for rel in paths:
+        packages.setdefault(root_of(os.path.dirname(rel)), []).append(rel)
+    return packages
+
+
+def changed_files(repo_dir: Path, base: str) -> list[str]:
+    """
+    Return source paths changed since the merge base of `base` and HEAD,
+    including uncommitted edits. Deleted files are excluded.
+    """
+    def git(*argv: str) -> str:
+        return subprocess.run(
+            ["git", *argv], cwd=repo_dir, capture_output=True, text=True, check=True
+        ).stdout
+
+    merge_base = git("merge-base", base, "HEAD").strip()
+    names = git(
+        "diff", "--name-only", "--relative", "--diff-filter=ACMR", merge_base
+    ).splitlines()
+    return [n for n in sorted(set(names)) if _is_source_path(n)]
+
+
+_PY_IMPORT = re.compile(
+    r"^\s*(?:from\s+(\.*[\w.]*)\s+import\s+\(?([\w, ]+)|import\s+([\w.]+))", re.MULTILINE
+)
+_JS_IMPORT = re.compile(r"""(?:from\s+|require\(\s*|import\s*\(\s*)['"](\.{1,2}/[^'"]+)['"]""")
+_JS_EXTENSIONS = ("", ".ts", ".js", "/index.ts", "/index.js")
+
+
+def _resolve_imports(repo_dir: Path, rel_path: str, content: str) -> list[str]:
+    """Best-effort resolution of a file's local imports to repo-relative paths."""
+    here = Path(rel_path).parent
+    targets: list[Path] = []
+    if rel_path.endswith(".py"):
+        for m in _PY_IMPORT.finditer(content):
+            module = m.group(1) or m.group(3)
+            names = [n.strip() for n in (m.group(2) or "").split(",") if n.strip()]
+            dots = len(module) - len(module.lstrip("."))
+            parts = [p for p in module.lstrip(".").split(".") if p]
+            if dots:
+                anchor = here
+                for _ in range(dots - 1):
+                    anchor = anchor.parent
+                roots = [anchor]
+            else:
+                roots = [Path(), here]
+            for root in roots:
+                stem = root.joinpath(*parts) if parts else root
+                if parts:
+                    targets.append(stem.with_suffix(".py"))
+                targets.append(stem / "__init__.py")
+                # `from pkg import module` names may themselves be modules
+                targets += [(stem / name).with_suffix(".py") for name in names]
+    elif rel_path.endswith((".js", ".ts")):
+        for m in _JS_IMPORT.finditer(content):
+            stem = os.path.normpath(here / m.group(1))
+            targets += [Path(stem + ext) for ext in _JS_EXTENSIONS]
+
+    resolved: list[str] = []
+    for target in targets:
+        rel = target.as_posix()
+        if rel.startswith("../") or rel in resolved or rel == rel_path:
+            continue
+        if _is_source_path(rel) and (repo_dir / rel).is_file():
+            resolved.append(rel)
+    return resolved
+
+
+def import_context(
+    repo_dir: Path, changed: list[str], limit: int = MAX_CONTEXT_FILES
+) -> list[str]:
+    """Return up to `limit` files imported by the changed files (one hop)."""
+    context: list[str] = []
+    for rel in changed:
+        try:
+            content = (repo_dir / rel).read_text(encoding="utf-8", errors="replace")
+        except OSError:
+            continue
+        for dep in _resolve_imports(repo_dir, rel, content):
+            if len(context) >= limit:
+                return context
+            if dep not in changed and dep not in context:
+                context.append(dep)
+    return context
+
+
+@dataclass
+class Chunk:
+    """Lines [start, end) of a file too large to review in one piece (0-based)."""
+    path: str
+    start: int
+    end: int
+    header_lines: int = 0  # shared-context lines shown before the chunk's own
+
+    @property
+    def label(self) -> str:
+        return f"{self.path}#L{self.start + 1}-L{self.end}"
+
+
+_CHUNK_LABEL = re.compile(r"#L\d+-L\d+$")
+_CHUNK_MARKER = "⋮ lines {first}–{last} of {path} follow; lines above are shared context\n"
+_CHUNK_MARKER_LINE = re.compile(r"^⋮ lines \d+–\d+ of .*\n?", re.MULTILINE)
+_CLOSER = re.compile(r"[})\]]|(?:end|else|elif|elsif|except|finally|catch)\b")
+_COMMENT_OR_DECORATOR = ("#", "//", "/*", "*", "@", "'''", '"""')
+_HEADER_LINE = re.compile(
+    r"^(?:import\b|from\s+\S+\s+import\b|package\b|use\b|using\b|require(?:_relative)?\b"
+    r"|#include\b|(?:const|let|var)\s+[^=]+=\s*require\()"
+)
+_BRACE_NOISE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`[^`]*`|//.*)""")
+
+
+def source_path(rel_path: str) -> str:
+    """The file path behind a chunk label such as "app/big.py#L120-L340"."""
+    return _CHUNK_LABEL.sub("", rel_path)
+
+
+def _python_structure(
+    content: str,
+) -> tuple[list[int], list[int], list[tuple[int, int]]] | None:
+    """
+    Split points for a Python file from its AST: starts of top-level
+    statements, starts of methods inside top-level classes, and the line
+    ranges of imports and module-level assignments (the shared header).
+    Returns None if the file doesn't parse.
+    """
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return None
+
+    def start(node: ast.stmt) -> int:
+        decorators = getattr(node, "decorator_list", [])
+        return min([node.lineno] + [d.lineno for d in decorators]) - 1
+
+    defs = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    top = [start(node) for node in tree.body]
+    nested = [
+        start(child)
+        for node in tree.body if isinstance(node, ast.ClassDef)
+        for child in node.body if isinstance(child, defs)
+    ]
+    header = [
+        (node.lineno - 1, node.end_lineno)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Assign, ast.AnnAssign))
+    ]
+    return top, nested, header
+
+
+def _brace_structure(lines: list[str]) -> tuple[list[int], list[int], list[tuple[int, int]]]:
+    """
+    Split points for other languages from brace depth and indentation:
+    unindented lines outside any brace are top-level boundaries, and lines one
+    level deep that follow a blank line are nested ones (members, methods).
+    Import/require/package lines at the top level form the shared header.
+    """
+    top: list[int] = []
+    nested: list[int] = []
+    header: list[tuple[int, int]] = []
+    depth = 0
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and not _CLOSER.match(stripped):
+            indented = line[0] in " \t"
+            if depth == 0 and not indented:
+                top.append(i)
+                if _HEADER_LINE.match(stripped):
+                    header.append((i, i + 1))
+            elif depth <= 1 and i and not lines[i - 1].strip():
+                nested.append(i)
+        code = _BRACE_NOISE.sub("", line)
+        depth = max(depth + code.count("{") - code.count("}"), 0)
+    return top, nested, header
+
+
+def _with_leading_comments(lines: list[str], cut: int) -> int:
+    """Move a split point up so comments and decorators stay with their code."""
+    while cut > 0 and lines[cut - 1].lstrip().startswith(_COMMENT_OR_DECORATOR):
+        cut -= 1
+    return cut
+
+
+def _pack_chunks(
+    lines: list[str], top: list[int], nested: list[int], limit: int
+) -> list[tuple[int, int]]:
+    """
+    Greedily cut lines into ranges of at most `limit` bytes, preferring the
+    latest top-level split point that fits, then a nested one, and only
+    splitting mid-definition when a single definition exceeds the limit.
+    """
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line.encode()))
+    top = sorted({_with_leading_comments(lines, c) for c in top})
+    nested = sorted({_with_leading_comments(lines, c) for c in nested})
+    ranges: list[tuple[int, int]] = []
+    start = 0
+    while start < len(lines):
+        def fits(cut: int) -> bool:
+            return cut > start and offsets[cut] - offsets[start] <= limit
+
+        if offsets[-1] - offsets[start] <= limit:
+            end = len(lines)
+        else:
+            end = (max(filter(fits, top), default=0)
+                   or max(filter(fits, nested), default=0)
+                   or max(filter(fits, range(start + 1, len(lines))), default=start + 1))
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def chunk_files(
+    files: list[tuple[str, str]], limit: int = MAX_FILE_BYTES
+) -> tuple[list[tuple[str, str]], dict[str, Chunk]]:
+    """
+    Split files larger than `limit` at function/class boundaries (Python via
+    ast, other languages by brace depth and indentation). Each chunk is
+    labelled path#Lstart-Lend and, after the first, is prefixed with the
+    file's imports and globals and a marker line. Returns the review units —
+    whole files and chunks, in the original order — and a map from chunk
+    label to Chunk for translating results back to the file.
+    """
+    units: list[tuple[str, str]] = []
+    chunks: dict[str, Chunk] = {}
+    for rel, content in files:
+        if len(content.encode()) <= limit:
+            units.append((rel, content))
+            continue
+        lines = content.splitlines(keepends=True)
+        structure = None
+        if rel.endswith(".py"):
+            structure = _python_structure(content)
+        top, nested, header = structure or _brace_structure(lines)
+        for start, end in _pack_chunks(lines, top, nested, limit):
+            shared = ""
+            for first, last in header:
+                text = "".join(lines[first:last])
+                if last <= start and len(shared) + len(text) <= MAX_HEADER_BYTES:
+                    shared += text
+            if shared:
+                marker = _CHUNK_MARKER.format(first=start + 1, last=end, path=rel)
+                shared = shared.rstrip("\n") + "\n" + marker
+            chunk = Chunk(rel, start, end, shared.count("\n"))
+            units.append((chunk.label, shared + "".join(lines[start:end])))
+            chunks[chunk.label] = chunk
+        print(f"  [chunk] {rel}: {len(content.encode()) // 1024} KB "
+              f"split into {sum(1 for c in chunks.values() if c.path == rel)} chunk(s)")
+    return units, chunks
+
+
+def fan_out_findings(findings: list[dict], copies: dict[str, list[str]]) -> list[dict]:
+    """Repeat each finding for every byte-identical copy of its file."""
+    return findings + [
+        {**f, "file": copy} for f in findings for copy in copies.get(f.get("file", ""), [])
+    ]
+
+
+def unchunk_findings(findings: list[dict], chunks: dict[str, Chunk]) -> list[dict]:
+    """Point findings reported against a chunk label back at the file and its lines."""
+    for f in findings:
+        chunk = chunks.get(f.get("file", ""))
+        if chunk is None:
+            continue
+        f["file"] = chunk.path
+        f["lines"] = f"L{chunk.start + 1}-L{chunk.end}"
+        line = f.pop("line", None)
+        if isinstance(line, int) and 0 < line - chunk.header_lines <= chunk.end - chunk.start:
+            f["line"] = chunk.start + line - chunk.header_lines
+    return findings
+
+
+_JS_DEF = re.compile(
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)\s*\("
+    r"|^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?"
+    r"(?:function\b|\([^)]*\)[^=]*=>|[A-Za-z_$][\w$]*\s*=>)"
+    r"|^\s*(?:(?:public|private|protected|static|async)\s+)*([A-Za-z_$][\w$]*)\s*\([^)]*\)"
+    r"\s*(?::[^{]+)?\{\s*$"
+)
+_GO_DEF = re.compile(r"^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)\s*[\[(]")
+_CALL = re.compile(r"(?:\b([A-Za-z_]\w*)\.)?\b([A-Za-z_$][\w$]*)\s*\(")
+_NOT_CALLEES = {
+    "if", "for", "while", "switch", "catch", "return", "function", "func", "new", "typeof",
+    "await", "super", "print", "len", "make", "append",
+}
+
+
+@dataclass
+class SymbolIndex:
+    """Where each function, method and class in the repo is defined (see build_symbol_index)."""
+    defs: dict[str, list[Chunk]] = field(default_factory=dict)  # name -> definitions
+    lines: dict[str, list[str]] = field(default_factory=dict)  # path -> source lines
+    paths: set[str] = field(default_factory=set)
+
+
+def _brace_end(lines: list[str], start: int) -> int:
+    """End (exclusive) of the brace-delimited body opened on or after lines[start]."""
+    depth = 0
+    opened = False
+    for i in range(start, len(lines)):
+        code = _BRACE_NOISE.sub("", lines[i])
+        depth += code.count("{") - code.count("}")
+        opened = opened or "{" in code
+        if opened and depth <= 0:
+            return i + 1
+        if not opened and i > start:
+            break  # an expression-bodied arrow function or a declaration
+    return start + 1
+
+
+def _definitions(rel_path: str, content: str) -> list[tuple[str, int, int]]:
+    """(name, start, end) of the top-level functions, classes and methods in a file."""
+    lines = content.splitlines()
+    if rel_path.endswith(".py"):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            return []
+        defs = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        found = []
+        for node in tree.body:
+            members = node.body if isinstance(node, ast.ClassDef) else []
+            for item in [node] + [m for m in members if isinstance(m, defs)]:
+                if isinstance(item, defs):
+                    first = min([item.lineno] + [d.lineno for d in item.decorator_list]) - 1
+                    found.append((item.name, first, item.end_lineno))
+        return found
+    pattern = _GO_DEF if rel_path.endswith(".go") else _JS_DEF
+    if not rel_path.endswith((".go", ".js", ".ts")):
+        return []
+    found = []
+    for i, line in enumerate(lines):
+        m = pattern.match(line)
+        name = m and next(g for g in m.groups() if g)
+        if name and name not in _NOT_CALLEES:
+            found.append((name, i, _brace_end(lines, i)))
+    return found
+
+
+def build_symbol_index(repo_dir: Path, paths: list[str]) -> SymbolIndex:
+    """
+    Read every file once and index its definitions by name: Python via ast,
+    JavaScript/TypeScript and Go by regex with brace matching.
+    """
+    index = SymbolIndex(paths=set(paths))
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        contents = list(pool.map(lambda rel: _read_source(repo_dir / rel), paths))
+    for rel, read in zip(paths, contents):
+        if read is None:
+            continue
+        definitions = _definitions(rel, read[0])
+        if not definitions:
+            continue
+        index.lines[rel] = read[0].splitlines(keepends=True)
+        for name, start, end in definitions:
+            index.defs.setdefault(name, []).append(Chunk(rel, start, end))
+    return index
+
+
+def _callee_files(
+    repo_dir: Path, rel_path: str, content: str, index: SymbolIndex, qualifiers: set[str]
+) -> set[str]:
+    """Files a file's calls can resolve to: its local imports, or for Go its packages."""
+    if not rel_path.endswith(".go"):
+        return set(_resolve_imports(repo_dir, rel_path, content))
+    here = str(Path(rel_path).parent)
+    return {
+        path for path in index.lines
+        if path.endswith(".go") and (str(Path(path).parent) == here
+                                     or Path(path).parent.name in qualifiers)
+    }
+
+
+def callee_context(
+    repo_dir: Path, units: list[tuple[str, str]], index: SymbolIndex,
+    limit: int = MAX_CALLEE_BYTES,
+) -> tuple[list[tuple[str, str]], dict[str, Chunk], dict[str, list[str]]]:
+    """
+    Follow each unit with the definitions it calls from other files: only
+    names it actually calls, only from the files it imports (its package,
+    for Go), and not from files already among `units`. Each definition is an
+    excerpt labelled path#Lstart-Lend, cut at MAX_CALLEE_LINES, sent at most
+    once per unit set and at most `limit` bytes per unit. Returns the units
+    with excerpts interleaved, a map from excerpt label to Chunk, and a map
+    from unit label to the labels of the excerpts it calls into (including
+    those already sent after an earlier unit).
+    """
+    in_set = {source_path(label) for label, _ in units}
+    out: list[tuple[str, str]] = []
+    excerpts: dict[str, Chunk] = {}
+    refs: dict[str, list[str]] = {}
+    for label, content in units:
+        out.append((label, content))
+        rel = source_path(label)
+        calls = set()
+        if rel.endswith(".py"):
+            try:
+                calls = {
+                    (None, node.func.id if isinstance(node.func, ast.Name) else node.func.attr)
+                    for node in ast.walk(ast.parse(content)) if isinstance(node, ast.Call)
+                    and isinstance(node.func, (ast.Name, ast.Attribute))
+                }
+            except (SyntaxError, ValueError):
+                pass  # a chunk with its shared header; fall back to the regex
+        calls = calls or set(_CALL.findall(content))
+        names = {name for _, name in calls if name not in _NOT_CALLEES}
+        targets = _callee_files(
+            repo_dir, rel, content, index, {q for q, _ in calls if q}
+        ) - in_set
+        size = 0
+        for name in sorted(names):
+            for definition in index.defs.get(name, []):
+                if definition.path not in targets:
+                    continue
+                excerpt = Chunk(definition.path, definition.start,
+                                min(definition.end, definition.start + MAX_CALLEE_LINES))
+                if excerpt.label in excerpts:
+                    refs.setdefault(label, []).append(excerpt.label)
+                    continue
+                text = "".join(index.lines[excerpt.path][excerpt.start:excerpt.end])
+                if size + len(text) > limit:
+                    continue
+                size += len(text)
+                excerpts[excerpt.label] = excerpt
+                refs.setdefault(label, []).append(excerpt.label)
+                out.append((excerpt.label, text))
+    return out, excerpts, refs
+
+
+@dataclass
+class Compaction:
+    """A review unit as sent with --compact, and where its lines came from."""
+    original: str  # the unit's text before compaction
+    kept: list[int]  # original line index (0-based) of each compacted line
+
+
+_COMMENT_LINE = re.compile(r"^\s*(#|//|/\*|\*)")
+_LICENSE = re.compile(r"copyright|licen[cs]e|spdx-", re.IGNORECASE)
+# Directives that only look like comments: shebangs, encodings, build tags, linters
+_DIRECTIVE = re.compile(
+    r"^#!|coding[:=]|frozen_string_literal|//go:|\+build|@ts-|eslint|nosec|noqa|pragma"
+)
+_COMMENTED_C_CODE = re.compile(r"^\s*//\s*(.*[;{}]|[\w.]+\(.*\))\s*$")
+_DOCSTRING_QUOTES = ('"""', "'''")
+
+
+def _commented_out_code(line: str, python: bool) -> bool:
+    """True if a full-line comment holds code rather than prose."""
+    if _DIRECTIVE.search(line):
+        return False
+    if not python:
+        return bool(_COMMENTED_C_CODE.match(line))
+    body = line.strip().lstrip("#").strip()
+    try:
+        tree = ast.parse(body)
+    except (SyntaxError, ValueError):
+        return False
+    # A lone word or literal ("# fallthrough") is prose
+    return bool(tree.body) and not all(
+        isinstance(node, ast.Expr) and isinstance(node.value, (ast.Name, ast.Constant))
+        for node in tree.body
+    )
+
+
+def _string_interiors(tree: ast.Module | None) -> set[int]:
+    """Lines after the first of every multi-line Python string literal."""
+    inside: set[int] = set()
+    for node in ast.walk(tree) if tree else ():
+        if isinstance(node, ast.JoinedStr) or (
+                isinstance(node, ast.Constant) and isinstance(node.value, (str, bytes))):
+            # 1-based lineno is the 0-based index of the string's second line
+            inside.update(range(node.lineno, node.end_lineno))
+    return inside
+
+
+def _docstring_bodies(lines: list[str], tree: ast.Module | None, python: bool) -> set[int]:
+    """Interior lines of multi-line docstrings and /** */ doc comments."""
+    drop: set[int] = set()
+    spans: list[tuple[int, int]] = []
+    if python:
+        defs = (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+        for node in ast.walk(tree) if tree else ():
+            if (isinstance(node, defs) and node.body and isinstance(node.body[0], ast.Expr)
+                    and isinstance(node.body[0].value, ast.Constant)
+                    and isinstance(node.body[0].value.value, str)):
+                spans.append((node.body[0].lineno - 1, node.body[0].end_lineno - 1))
+    else:
+        start = None
+        for i, line in enumerate(lines):
+            if start is None and line.lstrip().startswith("/**") and "*/" not in line:
+                start = i
+            elif start is not None and "*/" in line:
+                spans.append((start, i))
+                start = None
+    for first, last in spans:
+        # Keep the summary line when the opening quotes sit on a line of their own
+        if lines[first].strip().lstrip("rRbBuU") in _DOCSTRING_QUOTES + ("/**",):
+            first += 1
+        drop.update(range(first + 1, last))
+    return drop
+
+
+def compact_source(rel_path: str, content: str) -> tuple[str, list[int]] | None:
+    """
+    Strip security-irrelevant lines from one review unit: a leading
+    license header, the bodies of multi-line docstrings and doc comments,
+    commented-out code and runs of blank lines. Lines inside other Python
+    string literals are data and left alone. Only whole lines are removed,
+    so the result maps back line by line. Returns (compacted, kept) where
+    kept[i] is the original index of compacted line i, or None if nothing
+    was removed.
+    """
+    lines = content.splitlines(keepends=True)
+    python = source_path(rel_path).endswith(".py")
+    tree = None
+    if python:
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            pass
+    drop = _docstring_bodies(lines, tree, python)
+    literal = _string_interiors(tree)
+    header = 0
+    while header < len(lines) and (not lines[header].strip()
+                                   or _COMMENT_LINE.match(lines[header])):
+        header += 1
+    if _LICENSE.search("".join(lines[:header])):
+        drop.update(i for i in range(header) if not _DIRECTIVE.search(lines[i]))
+    for i, line in enumerate(lines):
+        if i in drop or i in literal:
+            continue
+        if not line.strip():
+            if i > 0 and not lines[i - 1].strip():
+                drop.add(i)
+        elif line.lstrip().startswith(("#", "//")) and _commented_out_code(line, python):
+            drop.add(i)
+    kept = [i for i in range(len(lines)) if i not in drop]
+    if not drop or not kept:
+        return None
+    return "".join(lines[i] for i in kept), kept
+
+
+def compact_files(
+    units: list[tuple[str, str]]
+) -> tuple[list[tuple[str, str]], dict[str, Compaction]]:
+    """
+    Compact every review unit (see compact_source). Returns the units as
+    they should be sent and a map from unit label to Compaction for
+    translating findings and edits back to the untouched text.
+    """
+    compacted: list[tuple[str, str]] = []
+    compactions: dict[str, Compaction] = {}
+    before = after = 0
+    for label, content in units:
+        result = compact_source(label, content)
+        before += len(content)
+        if result is None:
+            compacted.append((label, content))
+            after += len(content)
+            continue
+        text, kept = result
+        compacted.append((label, text))
+        compactions[label] = Compaction(content, kept)
+        after += len(text)
+    if compactions:
+        print(f"  [compact] {len(compactions)} file(s): {before:,} -> {after:,} bytes")
+    return compacted, compactions
+
+
+def uncompact_findings(
+    findings: list[dict], compactions: dict[str, Compaction]
+) -> list[dict]:
+    """
+    Findings with "line" translated from a compacted unit to its original.
+    Returns new dicts: streamed findings are translated as they arrive and
+    again, from the same objects, at the end of the run.
+    """
+    translated = []
+    for f in findings:
+        compaction = compactions.get(f.get("file", ""))
+        line = f.get("line")
+        if compaction is not None and isinstance(line, int) and 0 < line <= len(compaction.kept):
+            f = {**f, "line": compaction.kept[line - 1] + 1}
+        translated.append(f)
+    return translated
+
+
+def _uncompact_lines(
+    compaction: Compaction, first: int, search: list[str], replace: list[str]
+) -> tuple[list[str], list[str]]:
+    """
+    Translate a replacement of compacted lines first..first+len(search) to
+    the original: the search grows to cover the lines compaction removed in
+    between, and those removed lines are kept next to any unchanged line in
+    the replacement. Removed lines that sat inside changed code are dropped.
+    """
+    original = compaction.original.splitlines()
+    index = compaction.kept[first:first + len(search)]
+    gaps = [original[index[k] + 1:index[k + 1]] for k in range(len(index) - 1)] + [[]]
+    out: list[str] = []
+    matcher = difflib.SequenceMatcher(
+        None, [l.rstrip() for l in search], [l.rstrip() for l in replace], autojunk=False
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            out += replace[j1:j2]
+            continue
+        if i1 > 0:
+            out += gaps[i1 - 1]
+        for k in range(i1, i2):
+            out.append(original[index[k]])
+            out += gaps[k]
+    return original[index[0]:index[-1] + 1], out
+
+
+def uncompact_edit(compaction: Compaction, kind: str, body: str) -> str:
+    """
+    Translate a rewrite or patch of a compacted unit into one of the
+    original. A patch hunk that can't be located in the compacted text is
+    passed through unchanged for apply_patch to accept or reject.
+    """
+    original = compaction.original.splitlines()
+    compacted = [original[i] for i in compaction.kept]
+    if kind == "rewrite":
+        _, lines = _uncompact_lines(compaction, 0, compacted, body.splitlines())
+        # A rewrite replaces the whole unit: keep what compaction cut at either end
+        lines = original[:compaction.kept[0]] + lines + original[compaction.kept[-1] + 1:]
+        newline = "\r\n" if "\r\n" in compaction.original else "\n"
+        return newline.join(lines) + (newline if body.endswith("\n") else "")
+
+    def translate(match: re.Match) -> str:
+        search, replace = match.group(1).splitlines(), match.group(2).splitlines()
+        try:
+            first = _find_hunk(compacted, search)
+        except PatchError:
+            return match.group(0)
+        search, replace = _uncompact_lines(compaction, first, search, replace)
+        return ("<<<<<<< SEARCH\n" + "".join(l + "\n" for l in search) + "=======\n"
+                + "".join(l + "\n" for l in replace) + ">>>>>>> REPLACE")
+
+    return _HUNK.sub(translate, body)
+
+
+_SOUNDCHECK_TAG = re.compile(r"<(/?)soundcheck-", re.IGNORECASE)
+
+
+def _sanitize_content(content: str) -> str:
+    """Neutralize soundcheck XML tags in file content to prevent prompt injection."""
+    return _SOUNDCHECK_TAG.sub(lambda m: f"<{m.group(1)}soundcheck\u2011", content)
+
+
+def review_prompt(skill_text: str) -> str:
+    """Full system prompt for reviewing files with a skill."""
+    return skill_text + SYSTEM_SUFFIX + "\n---\n\n" + USER_PROMPT_HEADER
+
+
+def triage_prompt(skill_text: str) -> str:
+    """Full system prompt for the --cascade triage pass with a skill."""
+    return skill_text + TRIAGE_SUFFIX
+
+
+def findings_prompt(skill_text: str) -> str:
+    """Full system prompt for phase one of --two-phase with a skill."""
+    return skill_text + FINDINGS_SUFFIX
+
+
+def fix_prompt(skill_text: str) -> str:
+    """Full system prompt for phase two of --two-phase with a skill."""
+    return skill_text + FIX_SUFFIX
+
+
+def build_system(system_prompt: str) -> list[dict]:
+    """
+    System blocks for a review request. Everything that is identical across
+    shards, skills' files and runs (SKILL.md, SYSTEM_SUFFIX and the review
+    instructions, see review_prompt) sits in one block marked as a
+    prompt-cache breakpoint, ahead of the per-request file contents in the
+    user turn.
+    """
+    return [{
+        "type": "text",
+        "text": system_prompt,
+        "cache_control": {"type": "ephemeral"},
+    }]
+
+
+def build_request(
+    model: str,
+    system_prompt: str,
+    files: list[tuple[str, str]],
+    context_only: set[str] | None = None,
+    known_findings: list[dict] | None = None,
+    accepted: list[dict] | None = None,
+) -> dict:
+    """Messages API parameters for reviewing one shard."""
+    content = build_user_prompt(files, context_only, known_findings, accepted)
+    return {
+        "model": model,
+        "max_tokens": MAX_OUTPUT_TOKENS,
+        "system": build_system(system_prompt),
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def build_user_prompt(
+    files: list[tuple[str, str]],
+    context_only: set[str] | None = None,
+    known_findings: list[dict] | None = None,
+    accepted: list[dict] | None = None,
+) -> str:
+    parts = []
+    for rel_path, content in files:
+        ext = Path(source_path(rel_path)).suffix.lstrip(".")
+        note = ""
+        if context_only and rel_path in context_only:
+            note = " (context only — do not report findings in it or rewrite it)"
+        parts.append(f"## {rel_path}{note}\n```{ext}\n{_sanitize_content(content)}\n```\n")
+    if known_findings:
+        listed = _sanitize_content(json.dumps(known_findings, indent=2))
+        parts.append(f"## Findings to fix\n```json\n{listed}\n```\n")
+    if accepted:
+        listed = _sanitize_content(json.dumps(accepted, indent=2))
+        parts.append("## Accepted findings (baseline)\nThese were reviewed and accepted: do "
+                     "not report them again or change code only to fix them. Line numbers "
+                     f"may have drifted.\n```json\n{listed}\n```\n")
+    return "\n".join(parts)
+
+
+def estimate_tokens(text: str, suffix: str = "") -> int:
+    """Estimate input tokens for text using the per-suffix character ratio."""
+    ratio = CHARS_PER_TOKEN_BY_SUFFIX.get(suffix, CHARS_PER_TOKEN)
+    lines = text.count("\n") + 1
+    if len(text) / lines > MINIFIED_LINE_CHARS:  # minified or generated single-line code
+        ratio = min(ratio, MINIFIED_CHARS_PER_TOKEN)
+    return int(len(text) / ratio) + 1
+
+
+def calibrate_token_ratios(
+    client: anthropic.Anthropic, model: str, repo_dir: Path
+) -> dict[str, float]:
+    """
+    Measure characters per token for each source suffix in the repo by sending
+    a few sample files to the token-counting endpoint, and update
+    CHARS_PER_TOKEN_BY_SUFFIX in place. Returns the measured ratios.
+    """
+    samples: dict[str, list[str]] = {}
+    for rel in walk_source_files(repo_dir):
+        suffix = os.path.splitext(rel)[1]
+        if len(samples.setdefault(suffix, [])) >= CALIBRATION_SAMPLES:
+            continue
+        read = _read_source(repo_dir / rel)
+        if read is not None and read[0].strip():
+            samples[suffix].append(read[0])
+
+    measured: dict[str, float] = {}
+    for suffix, texts in samples.items():
+        if not texts:
+            continue
+        text = "\n".join(texts)
+        try:
+            counted = client.messages.count_tokens(
+                model=model, messages=[{"role": "user", "content": text}]
+            ).input_tokens
+        except anthropic.APIError as exc:
+            print(f"  [calibrate] {suffix}: {exc}", file=sys.stderr)
+            continue
+        measured[suffix] = len(text) / max(counted, 1)
+    CHARS_PER_TOKEN_BY_SUFFIX.update(measured)
+    return measured
+
+
+def _file_tokens(rel_path: str, content: str) -> int:
+    """Estimated tokens for one file as rendered by build_user_prompt."""
+    suffix = os.path.splitext(source_path(rel_path))[1]
+    return estimate_tokens(content, suffix) + estimate_tokens(rel_path) + 8
+
+
+def shard_files(
+    files: list[tuple[str, str]], max_tokens: int
+) -> list[list[tuple[str, str]]]:
+    """
+    Greedily pack files into shards whose estimated user-turn size stays
+    under max_tokens. A file larger than the budget gets a shard of its own.
+    """
+    shards: list[list[tuple[str, str]]] = []
+    current: list[tuple[str, str]] = []
+    current_tokens = 0
+    for rel_path, content in files:
+        tokens = _file_tokens(rel_path, content)
+        if current and current_tokens + tokens > max_tokens:
+            shards.append(current)
+            current = []
+            current_tokens = 0
+        current.append((rel_path, content))
+        current_tokens += tokens
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _retry_wait(exc: anthropic.APIStatusError, attempt: int) -> int | None:
+    """Seconds to wait before retrying a rate-limited/overloaded call, or None."""
+    if exc.status_code == 429:
+        # Respect Retry-After header if present, else exponential backoff from 30s
+        retry_after = exc.response.headers.get("retry-after")
+        wait = int(float(retry_after)) if retry_after else 30 * (2**attempt)
+        print(f"  [rate limited, retrying in {wait}s]", flush=True)
+        return wait
+    if exc.status_code == 529:
+        wait = 2**attempt
+        print(f"  [overloaded, retrying in {wait}s]", flush=True)
+        return wait
+    return None
+
+
+def api_call_with_retry(
+    client: anthropic.Anthropic, kwargs: dict, max_retries: int = 5
+) -> anthropic.types.Message:
+    for attempt in range(max_retries):
+        try:
+            return client.messages.create(**kwargs)
+        except anthropic.APIStatusError as exc:
+            wait = _retry_wait(exc, attempt) if attempt < max_retries - 1 else None
+            if wait is None:
+                raise
+            time.sleep(wait)
+    raise RuntimeError(f"api_call_with_retry: all {max_retries} attempts failed")
+
+
+def stream_with_retry(
+    client: anthropic.Anthropic,
+    kwargs: dict,
+    on_text: Callable[[str], None],
+    max_retries: int = 5,
+) -> anthropic.types.Message:
+    """
+    Stream a Messages API call, passing each text delta to on_text.
+    Only retries if the failure happened before any text was received, so
+    on_text never sees the same output twice.
+    """
+    for attempt in range(max_retries):
+        received = False
+        try:
+            with client.messages.stream(**kwargs) as stream:
+                for text in stream.text_stream:
+                    received = True
+                    on_text(text)
+                return stream.get_final_message()
+        except anthropic.APIStatusError as exc:
+            wait = None
+            if not received and attempt < max_retries - 1:
+                wait = _retry_wait(exc, attempt)
+            if wait is None:
+                raise
+            time.sleep(wait)
+    raise RuntimeError(f"stream_with_retry: all {max_retries} attempts failed")
+
+
+@dataclass
+class TokenUsage:
+    """Thread-safe running totals of Messages API usage across requests."""
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    continuations: int = 0  # requests that resumed output cut off at max_tokens
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, usage: object) -> None:
+        with self._lock:
+            self.requests += 1
+            self.input_tokens += getattr(usage, "input_tokens", 0) or 0
+            self.output_tokens += getattr(usage, "output_tokens", 0) or 0
+            self.cache_read_tokens += getattr(usage, "cache_read_input_tokens", 0) or 0
+            self.cache_write_tokens += getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+    def add_continuation(self) -> None:
+        with self._lock:
+            self.continuations += 1
+
+    def merge(self, other: "TokenUsage") -> None:
+        """Add another set of running totals (e.g. one stage's) to these."""
+        with self._lock:
+            self.requests += other.requests
+            self.input_tokens += other.input_tokens
+            self.output_tokens += other.output_tokens
+            self.cache_read_tokens += other.cache_read_tokens
+            self.cache_write_tokens += other.cache_write_tokens
+            self.continuations += other.continuations
+
+    def describe(self) -> str:
+        continued = f" · {self.continuations} continuation(s)" if self.continuations else ""
+        return (f"{self.requests} request(s) · input {self.input_tokens} "
+                f"(cache read {self.cache_read_tokens}, cache write {self.cache_write_tokens}) "
+                f"· output {self.output_tokens}{continued}")
+
+
+def stream_review(
+    client: anthropic.Anthropic,
+    kwargs: dict,
+    on_text: Callable[[str], None],
+    usage: TokenUsage | None = None,
+    finished: Callable[[], bool] | None = None,
+    transcript: str = "",
+) -> anthropic.types.Message:
+    """
+    Stream a review, and while it stops at max_tokens before finished()
+    reports every block closed, resend the output so far as a prefilled
+    assistant turn so the model carries on where it stopped, up to
+    MAX_CONTINUATIONS times. on_text sees the output once, as one stream.
+    `transcript` is output already received elsewhere (e.g. a batch result)
+    to continue from. Returns the last message.
+    """
+    # The API rejects a prefill ending in whitespace, so trailing whitespace
+    # is held back until more text follows it; a continuation regenerates it.
+    held = ""
+
+    def emit(text: str) -> None:
+        nonlocal held, transcript
+        text = held + text
+        visible = text.rstrip()
+        held = text[len(visible):]
+        if visible:
+            transcript += visible
+            on_text(visible)
+
+    transcript = transcript.rstrip()
+    continuations = 0
+    while True:
+        request = kwargs
+        if transcript:
+            request = {**kwargs, "messages": [
+                *kwargs["messages"], {"role": "assistant", "content": transcript},
+            ]}
+        message = stream_with_retry(client, request, emit)
+        if usage is not None:
+            usage.add(message.usage)
+        if (message.stop_reason != "max_tokens" or continuations >= MAX_CONTINUATIONS
+                or (finished is not None and finished())):
+            break
+        continuations += 1
+        held = ""
+        if usage is not None:
+            usage.add_continuation()
+        print(f"  [continue] output hit max_tokens; resuming "
+              f"({continuations}/{MAX_CONTINUATIONS})", flush=True)
+    if held:
+        on_text(held)
+    if message.stop_reason == "max_tokens" and not (finished is not None and finished()):
+        print("  [truncated] output still incomplete at max_tokens", file=sys.stderr)
+    return message
+
+
+def review_shard(
+    client: anthropic.Anthropic,
+    model: str,
+    system_prompt: str,
+    files: list[tuple[str, str]],
+    context_only: set[str] | None = None,
+    on_edit: Callable[[str, str, str], None] | None = None,
+    usage: TokenUsage | None = None,
+    started: threading.Event | None = None,
+    on_findings: Callable[[list[dict]], None] | None = None,
+    known_findings: list[dict] | None = None,
+    accepted: list[dict] | None = None,
+) -> tuple[list[dict], dict[str, tuple[str, str]], bool]:
+    """
+    Stream one shard's review (continuing past max_tokens, see
+    stream_review), handing each completed rewrite or patch block to
+    on_edit(kind, file, body) and each findings list to on_findings as soon
+    as its closing tag arrives.
+    `started` is set once output begins (or the request fails), and token
+    usage is added to `usage`. known_findings are listed after the files
+    for the fix prompt to act on, and `accepted` baseline findings for the
+    reviewer to leave alone.
+
+    Returns (findings, edits, complete) where edits maps each file to its
+    ("rewrite" | "patch", body); multiple patch blocks for one file are
+    concatenated. If the request fails partway through, whatever was
+    received before the failure is returned with complete=False.
+    """
+    parser = StreamParser()
+    findings: list[dict] = []
+    edits: dict[str, tuple[str, str]] = {}
+
+    def on_text(text: str) -> None:
+        if started is not None:
+            started.set()
+        for kind, rel_path, body in parser.feed(text):
+            if kind == "findings":
+                findings.extend(body)
+                if on_findings is not None:
+                    on_findings(body)
+                continue
+            if not body.strip():
+                continue
+            previous = edits.get(rel_path)
+            if kind == "patch" and previous and previous[0] == "patch":
+                edits[rel_path] = ("patch", previous[1] + "\n" + body)
+            else:
+                edits[rel_path] = (kind, body)
+            if on_edit is not None:
+                on_edit(kind, rel_path, body)
+
+    try:
+        message = stream_review(
+            client,
+            build_request(model, system_prompt, files, context_only, known_findings, accepted),
+            on_text, usage, lambda: parser.finished,
+        )
+    except anthropic.APIError as exc:
+        if not edits and not findings:
+            raise
+        print(f"  [partial] request failed after {len(edits)} edit(s): {exc}",
+              file=sys.stderr)
+        return findings, edits, False
+    finally:
+        if started is not None:
+            started.set()
+    # Output still cut off after every continuation is not a complete review
+    return findings, edits, message.stop_reason != "max_tokens" or parser.finished
+
+
+def review_shards(
+    client: anthropic.Anthropic,
+    model: str,
+    system_prompts: list[str],
+    shards: list[list[tuple[str, str]]],
+    workers: int,
+    context_only: set[str] | None = None,
+    on_edit: Callable[[str, str, str], None] | None = None,
+    usage: TokenUsage | None = None,
+    on_findings: Callable[[int, list[dict]], None] | None = None,
+    known_findings: list[list[dict]] | None = None,
+    accepted: list[list[dict]] | None = None,
+) -> list[tuple[list[dict], dict[str, tuple[str, str]], bool]]:
+    """
+    Review shards concurrently on a bounded worker pool, shard i using
+    system_prompts[i] (and known_findings[i] and accepted[i], if given). Findings are
+    streamed to on_findings(i, findings) as they are parsed. Returns one
+    (findings, edits, complete) per shard, in shard order; a shard whose
+    request failed outright yields ([], {}, False).
+
+    The first shard for each distinct system prompt is sent ahead of the rest,
+    which wait until it starts streaming: by then its prompt-cache entry has
+    been written, so the others read it instead of each writing their own.
+    """
+    results: list[tuple[list[dict], dict[str, tuple[str, str]], bool]] = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        def submit(i: int, started: threading.Event | None = None):
+            def shard_findings(found: list[dict]) -> None:
+                on_findings(i, found)
+
+            return pool.submit(
+                review_shard, client, model, system_prompts[i], shards[i],
+                context_only, on_edit, usage, started,
+                shard_findings if on_findings is not None else None,
+                known_findings[i] if known_findings is not None else None,
+                accepted[i] if accepted is not None else None,
+            )
+
+        futures = [None] * len(shards)
+        leaders: dict[str, threading.Event] = {}
+        for i, prompt in enumerate(system_prompts):
+            if prompt not in leaders:
+                leaders[prompt] = threading.Event()
+                futures[i] = submit(i, leaders[prompt])
+        for i, prompt in enumerate(system_prompts):
+            if futures[i] is None:
+                leaders[prompt].wait()
+                futures[i] = submit(i)
+
+        for i, future in enumerate(futures, 1):
+            try:
+                shard_findings, shard_edits, complete = future.result()
+            except anthropic.APIError as exc:
+                print(f"  [shard {i}/{len(shards)}] failed: {exc}", file=sys.stderr)
+                results.append(([], {}, False))
+                continue
+            if len(shards) > 1:
+                print(f"  [shard {i}/{len(shards)}] {len(shard_findings)} finding(s), "
+                      f"{len(shard_edits)} edit(s)")
+            results.append((shard_findings, shard_edits, complete))
+    return results
+
+
+@dataclass
+class ReviewResult:
+    findings: list[dict] = field(default_factory=list)
+    edits: dict[str, tuple[str, str]] = field(default_factory=dict)
+    unreviewed: list[str] = field(default_factory=list)
+    requested: int = 0  # files sent to the API (cache misses)
+    usage: TokenUsage = field(default_factory=TokenUsage)
+
+
+def plan_jobs(
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    model: str,
+    shard_tokens: int | None = None,
+    context_only: set[str] | None = None,
+    cache: "ReviewCache | None" = None,
+    cache_context: dict[tuple[int, str], str] | None = None,
+) -> tuple[
+    list[tuple[int, list[tuple[str, str]]]],
+    list[tuple[str, list[dict], tuple[str, str] | None]],
+    dict[tuple[int, str], str],
+]:
+    """
+    Split groups into review requests without sending anything.
+    Returns (jobs, cache_hits, cache_keys): jobs are (group_index, shard)
+    pairs, cache_hits are (file, findings, edit) served from the cache, and
+    cache_keys maps (group_index, file) to the key its result is stored under.
+    cache_context maps (group_index, file) to text sent with the file that
+    its result depends on (referenced definitions, accepted findings), so
+    the result is not reused once that text changes.
+    """
+    cache_context = cache_context or {}
+    context_only = context_only or set()
+    jobs: list[tuple[int, list[tuple[str, str]]]] = []
+    hits: list[tuple[str, list[dict], tuple[str, str] | None]] = []
+    keys: dict[tuple[int, str], str] = {}
+    for gi, (_, skill_text, files) in enumerate(groups):
+        to_review = files
+        if cache is not None:
+            to_review = []
+            for rel, content in files:
+                if rel in context_only:
+                    to_review.append((rel, content))
+                    continue
+                keys[gi, rel] = ReviewCache.cache_key(
+                    content, skill_text, model, cache_context.get((gi, rel), "")
+                )
+                hit = cache.get(keys[gi, rel], rel)
+                if hit is None:
+                    to_review.append((rel, content))
+                else:
+                    hits.append((rel, *hit))
+        if not to_review or all(rel in context_only for rel, _ in to_review):
+            continue
+        shards = shard_files(to_review, shard_tokens) if shard_tokens else [to_review]
+        jobs += [(gi, shard) for shard in shards]
+    return jobs, hits, keys
+
+
+def format_plan(
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    jobs: list[tuple[int, list[tuple[str, str]]]],
+    dropped: list[str],
+    model: str,
+    cached: int = 0,
+    skipped: list[tuple[str, str]] | None = None,
+) -> str:
+    """Describe the planned requests, skipped and dropped files and projected cost."""
+    lines = [f"Plan: {len(jobs)} request(s) to {model}"]
+    input_tokens = cache_reads = cache_writes = 0
+    seen_prompts: set[int] = set()
+    for i, (gi, shard) in enumerate(jobs, 1):
+        skill = groups[gi][0] or "security-review"
+        system_tokens = estimate_tokens(review_prompt(groups[gi][1]), ".md")
+        file_tokens = sum(_file_tokens(rel, content) for rel, content in shard)
+        if gi in seen_prompts:
+            cache_reads += system_tokens
+        else:
+            cache_writes += system_tokens
+            seen_prompts.add(gi)
+        input_tokens += file_tokens
+        lines.append(f"  [{i}] {skill} · {len(shard)} file(s) · "
+                     f"~{system_tokens + file_tokens:,} input tokens")
+        for rel, _ in shard:
+            lines.append(f"        {rel}")
+    if cached:
+        lines.append(f"Cached: {cached} file result(s) reused without a request")
+    if skipped:
+        lines.append(f"Skipped (generated, vendored, minified or too large): "
+                     f"{len(skipped)} file(s)")
+        lines += [f"  {rel} — {reason}" for rel, reason in skipped]
+    if dropped:
+        lines.append(f"Dropped (over budget): {len(dropped)} file(s)")
+        lines += [f"  {rel}" for rel in dropped]
+    output_tokens = MAX_OUTPUT_TOKENS * len(jobs)
+    lines.append(f"Projected: ~{input_tokens + cache_reads + cache_writes:,} input tokens "
+                 f"({cache_reads:,} cache read, {cache_writes:,} cache write) · "
+                 f"output ≤ {output_tokens:,} tokens")
+    if model in MODEL_PRICING:
+        in_price, out_price = MODEL_PRICING[model]
+        input_cost = (input_tokens + 0.1 * cache_reads + 1.25 * cache_writes) * in_price / 1e6
+        output_cost = output_tokens * out_price / 1e6
+        lines.append(f"Projected cost: ${input_cost:.2f} input + ≤ ${output_cost:.2f} output")
+    else:
+        lines.append(f"Projected cost: unknown — no pricing for {model}")
+    return "\n".join(lines)
+
+
+def _confidence(candidate: dict) -> float:
+    """A triage candidate's confidence; unparseable values count as certain."""
+    try:
+        return float(candidate.get("confidence", 1.0))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def triage_jobs(
+    client: anthropic.Anthropic,
+    triage_model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    jobs: list[tuple[int, list[tuple[str, str]]]],
+    workers: int,
+    context_only: set[str],
+    min_confidence: float = TRIAGE_MIN_CONFIDENCE,
+    usage: TokenUsage | None = None,
+) -> list[tuple[int, list[tuple[str, str]]]]:
+    """
+    First stage of the --cascade: send every job to the cheap triage model,
+    which lists candidate findings with a confidence, and return the jobs cut
+    down to files with a Medium-or-higher candidate at min_confidence or
+    above (plus any context-only files alongside them). A shard whose triage
+    request fails is escalated whole.
+    """
+    prompts = [triage_prompt(groups[gi][1]) for gi, _ in jobs]
+    outcomes = review_shards(
+        client, triage_model, prompts, [shard for _, shard in jobs], workers,
+        context_only, usage=usage,
+    )
+    escalated: list[tuple[int, list[tuple[str, str]]]] = []
+    for (gi, shard), (candidates, _, complete) in zip(jobs, outcomes):
+        if not complete:
+            escalated.append((gi, shard))
+            continue
+        # By file, not label: a chunk reported under its plain path still counts
+        flagged = {
+            source_path(str(c.get("file", ""))) for c in candidates
+            if c.get("severity") in FIX_SEVERITIES
+            and _confidence(c) >= min_confidence
+        }
+        if flagged & {source_path(rel) for rel, _ in shard if rel not in context_only}:
+            escalated.append((gi, [
+                (rel, content) for rel, content in shard
+                if source_path(rel) in flagged or rel in context_only
+            ]))
+    return escalated
+
+
+def fix_findings(
+    client: anthropic.Anthropic,
+    model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    jobs: list[tuple[int, list[tuple[str, str]]]],
+    outcomes: list[tuple[list[dict], dict[str, tuple[str, str]], bool]],
+    workers: int,
+    context_only: set[str],
+    on_edit: Callable[[str, str, str], None] | None = None,
+    usage: TokenUsage | None = None,
+) -> tuple[list[tuple[list[dict], dict[str, tuple[str, str]], bool]], set[str]]:
+    """
+    Second phase of --two-phase: send one fix request per file with a
+    Critical, High or Medium finding in a complete phase-one outcome, holding
+    just that file and its findings, all on one worker pool. Returns the
+    outcomes with each file's edits merged into its shard's, and the files
+    whose fix request failed or was cut off.
+    """
+    fixes: list[tuple[int, str, str, list[dict]]] = []
+    for i, ((gi, shard), (findings, _, complete)) in enumerate(zip(jobs, outcomes)):
+        if not complete:
+            continue
+        for rel, content in shard:
+            own = [f for f in findings
+                   if f.get("file") == rel and f.get("severity") in FIX_SEVERITIES]
+            if own and rel not in context_only:
+                fixes.append((i, rel, content, own))
+    if not fixes:
+        return outcomes, set()
+
+    fixed = review_shards(
+        client, model, [fix_prompt(groups[jobs[i][0]][1]) for i, *_ in fixes],
+        [[(rel, content)] for _, rel, content, _ in fixes], workers,
+        on_edit=on_edit, usage=usage, known_findings=[own for *_, own in fixes],
+    )
+    merged = [(findings, dict(edits), complete) for findings, edits, complete in outcomes]
+    unfixed: set[str] = set()
+    for (i, rel, _, _), (_, edits, complete) in zip(fixes, fixed):
+        merged[i][1].update(edits)
+        if not complete:
+            unfixed.add(rel)
+    print(f"  [fix] {len(fixes) - len(unfixed)} of {len(fixes)} file(s) fixed")
+    return merged, unfixed
+
+
+def _shard_accepted(
+    shard: list[tuple[str, str]], accepted: dict[str, list[dict]] | None
+) -> list[dict]:
+    """The baseline findings of every file with a unit in shard."""
+    return [
+        entry for rel in dict.fromkeys(source_path(rel) for rel, _ in shard)
+        for entry in (accepted or {}).get(rel, [])
+    ]
+
+
+def review_files(
+    client: anthropic.Anthropic,
+    model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    workers: int,
+    shard_tokens: int | None = None,
+    context_only: set[str] | None = None,
+    cache: "ReviewCache | None" = None,
+    on_edit: Callable[[str, str, str], None] | None = None,
+    on_findings: Callable[[list[dict]], None] | None = None,
+    triage_model: str | None = None,
+    triage_min_confidence: float = TRIAGE_MIN_CONFIDENCE,
+    two_phase: bool = False,
+    accepted: dict[str, list[dict]] | None = None,
+    findings_only: bool = False,
+    cache_context: dict[tuple[int, str], str] | None = None,
+) -> ReviewResult:
+    """
+    Review every (skill_name, skill_text, files) group: serve cache hits,
+    shard the misses (one shard per group unless shard_tokens is set), review
+    all shards on one worker pool, then cache each fully reviewed file.
+    skill_name is None for the security-review orchestrator; otherwise it
+    fills in findings that omit their "skill". Findings are also streamed to
+    on_findings as they are parsed.
+    With triage_model, the misses are first triaged by that model and only
+    files it flags are reviewed by `model` (see triage_jobs); files it clears
+    count as reviewed with no findings.
+    With two_phase, each shard is asked for findings only, and every file
+    with a Critical, High or Medium finding is then fixed in a request of
+    its own (see fix_findings).
+    `accepted` maps files to baseline findings, listed in each request
+    reviewing the file so they are not reported or fixed again.
+    With findings_only, no edits are asked for (the first phase of
+    two_phase, on its own). cache_context is passed to plan_jobs.
+    """
+    context_only = context_only or set()
+    result = ReviewResult()
+    # Cascade and findings-only results are cached apart from full reviews
+    cache_model = f"{triage_model}>{model}" if triage_model else model
+    if findings_only:
+        cache_model += "+findings"
+    jobs, hits, keys = plan_jobs(
+        groups, cache_model, shard_tokens, context_only, cache, cache_context
+    )
+    for rel, findings, edit in hits:
+        result.findings += findings
+        if on_findings is not None and findings:
+            on_findings(findings)
+        if edit is not None:
+            result.edits[rel] = edit
+            if on_edit is not None:
+                on_edit(edit[0], rel, edit[1])
+
+    if triage_model and jobs:
+        triage_usage = TokenUsage()
+        triaged = jobs
+        jobs = triage_jobs(
+            client, triage_model, groups, triaged, workers, context_only,
+            triage_min_confidence, triage_usage,
+        )
+        kept = {(gi, rel) for gi, shard in jobs for rel, _ in shard}
+        cleared = [
+            (gi, rel) for gi, shard in triaged for rel, _ in shard
+            if (gi, rel) not in kept and rel not in context_only
+        ]
+        print(f"  [triage] {triage_model} escalated {len(kept)} of {len(kept) + len(cleared)} "
+              f"file(s) to {model} · {triage_usage.describe()}")
+        result.usage.merge(triage_usage)
+        if cache is not None:
+            for key in (keys[k] for k in cleared if k in keys):
+                cache.put(key, [], None)
+
+    if not jobs:
+        return result
+    result.requested = sum(len(shard) for _, shard in jobs)
+    prompt = findings_prompt if two_phase or findings_only else review_prompt
+    prompts = [prompt(groups[gi][1]) for gi, _ in jobs]
+
+    def label(gi: int, findings: list[dict]) -> list[dict]:
+        if groups[gi][0]:
+            for f in findings:
+                f.setdefault("skill", groups[gi][0])
+        return findings
+
+    def stream_findings(i: int, findings: list[dict]) -> None:
+        on_findings(label(jobs[i][0], findings))
+
+    baselined = [_shard_accepted(shard, accepted) for _, shard in jobs] if accepted else None
+    outcomes = review_shards(
+        client, model, prompts, [shard for _, shard in jobs], workers,
+        context_only, None if two_phase else on_edit, result.usage,
+        stream_findings if on_findings is not None else None, accepted=baselined,
+    )
+    unfixed: set[str] = set()
+    if two_phase and not findings_only:
+        outcomes, unfixed = fix_findings(
+            client, model, groups, jobs, outcomes, workers, context_only, on_edit,
+            result.usage,
+        )
+    for (gi, shard), (findings, edits, complete) in zip(jobs, outcomes):
+        result.findings += label(gi, findings)
+        result.edits.update(edits)
+        if not complete:
+            result.unreviewed += [rel for rel, _ in shard if rel not in result.unreviewed]
+            continue
+        if cache is not None:
+            for rel, _ in shard:
+                # A file whose fix failed is retried next run, not cached unfixed
+                if (gi, rel) in keys and rel not in unfixed:
+                    cache.put(
+                        keys[gi, rel],
+                        [f for f in findings if f.get("file") == rel],
+                        edits.get(rel),
+                    )
+    return result
+
+
+def summarize_files(
+    client: anthropic.Anthropic,
+    model: str,
+    units: list[tuple[str, str]],
+    shard_tokens: int,
+    workers: int,
+    cache: "ReviewCache | None" = None,
+    usage: TokenUsage | None = None,
+) -> dict[str, dict]:
+    """
+    Map pass of --map-reduce: send every unit to `model` in token-budgeted
+    shards and return a compact security summary per unit label (see
+    MAP_PROMPT). Summaries are cached per file content like reviews are.
+    Units whose shard failed get no summary.
+    """
+    summaries: dict[str, dict] = {}
+    keys: dict[str, str] = {}
+    misses: list[tuple[str, str]] = []
+    for rel, content in units:
+        if cache is not None:
+            keys[rel] = ReviewCache.cache_key(content, MAP_PROMPT, f"map:{model}")
+            hit = cache.get(keys[rel], rel)
+            if hit is not None and hit[0]:
+                summaries[rel] = hit[0][0]
+                continue
+        misses.append((rel, content))
+    if not misses:
+        return summaries
+    shards = shard_files(misses, shard_tokens)
+    outcomes = review_shards(
+        client, model, [MAP_PROMPT] * len(shards), shards, workers, usage=usage
+    )
+    for shard, (entries, _, _) in zip(shards, outcomes):
+        labels = {rel for rel, _ in shard}
+        for entry in entries:
+            if not isinstance(entry, dict) or entry.get("file") not in labels:
+                continue
+            summaries[entry["file"]] = entry
+            if cache is not None:
+                cache.put(keys[entry["file"]], [entry], None)
+    return summaries
+
+
+def select_flows(
+    client: anthropic.Anthropic,
+    model: str,
+    summaries: dict[str, dict],
+    usage: TokenUsage | None = None,
+    workers: int = 1,
+    max_tokens: int = MAX_REDUCE_TOKENS,
+) -> list[dict]:
+    """
+    Reduce pass of --map-reduce: ask `model` for the cross-file flows that
+    deserve a full review (see REDUCE_PROMPT), sending every summary in one
+    request if they fit in max_tokens and otherwise in batches of path-ordered
+    summaries, so a package's files are traced together. Returns the flows
+    with "files" cut down to known units.
+    """
+    batches: list[list[dict]] = [[]]
+    size = 0
+    for rel in sorted(summaries):
+        tokens = estimate_tokens(json.dumps(summaries[rel], separators=(",", ":")))
+        if batches[-1] and size + tokens > max_tokens:
+            batches.append([])
+            size = 0
+        batches[-1].append(summaries[rel])
+        size += tokens
+    if len(batches) > 1:
+        print(f"  [reduce] summaries exceed ~{max_tokens:,} tokens; "
+              f"reducing in {len(batches)} batches")
+
+    def reduce(batch: list[dict]) -> str:
+        listed = json.dumps(batch, separators=(",", ":"))
+        message = api_call_with_retry(client, {
+            "model": model,
+            "max_tokens": MAX_OUTPUT_TOKENS,
+            "system": build_system(REDUCE_PROMPT),
+            "messages": [{"role": "user", "content": _sanitize_content(listed)}],
+        })
+        if usage is not None:
+            usage.add(message.usage)
+        return "".join(getattr(block, "text", "") for block in message.content)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as pool:
+        texts = list(pool.map(reduce, batches))
+    flows = []
+    for text in texts:
+        for flow in parse_findings(text):
+            if not isinstance(flow, dict) or not isinstance(flow.get("files"), list):
+                continue
+            files = [rel for rel in flow["files"] if rel in summaries]
+            if files:
+                flows.append({**flow, "files": list(dict.fromkeys(files))})
+    return flows
+
+
+def group_flows(
+    flows: list[dict], units: list[tuple[str, str]], shard_tokens: int
+) -> list[set[str]]:
+    """
+    Group the files of selected flows for full review: flows sharing a file
+    are merged while the merged set still fits in shard_tokens; past that a
+    flow is reviewed as a set of its own, repeating the files it shares, so
+    one widely used helper cannot pull every flow into a single request.
+    """
+    sizes = {rel: _file_tokens(rel, content) for rel, content in units}
+    components: list[set[str]] = []
+    for flow in flows:
+        files = set(flow["files"])
+        if any(files <= component for component in components):
+            continue
+        overlapping = [c for c in components if c & files]
+        merged = files.union(*overlapping)
+        if sum(sizes.get(rel, 0) for rel in merged) <= shard_tokens:
+            components = [c for c in components if not c & files]
+            files = merged
+        components.append(files)
+    return components
+
+
+def map_reduce(
+    client: anthropic.Anthropic,
+    map_model: str,
+    model: str,
+    units: list[tuple[str, str]],
+    shard_tokens: int,
+    workers: int,
+    cache: "ReviewCache | None" = None,
+) -> list[list[tuple[str, str]]]:
+    """
+    Summarize every unit with the cheap map_model, let `model` pick the
+    flows worth reviewing from the summaries alone, and return the units to
+    review fully: one set per group of flows (see group_flows), so every
+    file of a cross-file flow is reviewed in the same request. Units that
+    could not be summarized are reviewed on their own.
+    """
+    usage = TokenUsage()
+    summaries = summarize_files(client, map_model, units, shard_tokens, workers, cache, usage)
+    print(f"  [map] {map_model} summarized {len(summaries)} of {len(units)} file(s) · "
+          f"{usage.describe()}")
+    usage = TokenUsage()
+    flows = select_flows(client, model, summaries, usage, workers) if summaries else []
+    for flow in flows:
+        print(f"  [reduce] {flow.get('severity', '?')}: {flow.get('flow', '')} "
+              f"({', '.join(flow['files'])})")
+    components = group_flows(flows, units, shard_tokens)
+    components += [{rel} for rel, _ in units if rel not in summaries]
+    selected = set().union(*components) if components else set()
+    print(f"  [reduce] {model} selected {len(flows)} flow(s) over {len(selected)} of "
+          f"{len(units)} file(s) for full review · {usage.describe()}")
+    return [[unit for unit in units if unit[0] in component] for component in components]
+
+
+def _snapshot(repo_dir: Path) -> dict[str, tuple[int, int]]:
+    """(mtime_ns, size) of every source file walk_source_files() would visit."""
+    stats: dict[str, tuple[int, int]] = {}
+    for rel in walk_source_files(repo_dir):
+        try:
+            st = os.stat(repo_dir / rel)
+        except OSError:
+            continue
+        stats[rel] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def watch_repo(
+    client: anthropic.Anthropic,
+    model: str,
+    repo_dir: Path,
+    skill_text: str,
+    cache: "ReviewCache",
+    workers: int,
+    baseline: dict[str, dict] | None = None,
+    classify: bool = True,
+    compact: bool = False,
+    poll: float = WATCH_POLL_SECONDS,
+    debounce: float = WATCH_DEBOUNCE_SECONDS,
+) -> int:
+    """
+    --watch: poll the repo with the same skip rules as collect_files and,
+    once saves have been quiet for `debounce` seconds, review just the files
+    that changed, findings only, and print the findings. Unchanged content
+    is served from `cache`, so reverting an edit costs nothing. Files are
+    never edited. Runs until interrupted.
+    """
+    seen = _snapshot(repo_dir)
+    print(f"Watching {len(seen)} source file(s) in {repo_dir} (Ctrl-C to stop)...")
+    pending: set[str] = set()
+    last_change = 0.0
+    try:
+        while True:
+            time.sleep(poll)
+            current = _snapshot(repo_dir)
+            changed = {rel for rel, stat in current.items() if seen.get(rel) != stat}
+            seen = current
+            if changed:
+                pending |= changed
+                last_change = time.monotonic()
+                continue
+            if not pending or time.monotonic() - last_change < debounce:
+                continue
+            started = time.monotonic()
+            files = collect_files(repo_dir, None, None, sorted(pending), classify=classify)
+            pending = set()
+            if not files:
+                continue
+            units, chunks = chunk_files(files)
+            compactions: dict[str, Compaction] = {}
+            if compact:
+                units, compactions = compact_files(units)
+            print(f"Reviewing {len(files)} changed file(s): "
+                  + ", ".join(rel for rel, _ in files))
+            try:
+                result = review_files(
+                    client, model, [(None, skill_text, units)], workers, cache=cache,
+                    findings_only=True,
+                )
+            except anthropic.APIError as exc:
+                print(f"  ERROR: review failed: {exc}", file=sys.stderr)
+                continue
+            sources = dict(files)
+            findings = unchunk_findings(uncompact_findings(result.findings, compactions), chunks)
+            shown = 0
+            for f in findings:
+                f["fingerprint"] = fingerprint(f, sources.get(f.get("file")))
+                if baseline and is_baselined(f, baseline):
+                    continue
+                shown += 1
+                where = f.get("file", "?") + (f":{f['line']}" if "line" in f else "")
+                skill = f" [{f['skill']}]" if f.get("skill") else ""
+                print(f"  {f.get('severity', '?')}: {where} — {f.get('finding', '')}{skill}")
+            print(f"  {shown} finding(s) in {time.monotonic() - started:.1f}s"
+                  + (f" · {result.usage.describe()}" if result.usage.requests else " · cached"))
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+        return 0
+
+
+def submit_batch(
+    client: anthropic.Anthropic,
+    model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    jobs: list[tuple[int, list[tuple[str, str]]]],
+    keys: dict[tuple[int, str], str],
+    context_only: set[str],
+    state_path: Path,
+    accepted: dict[str, list[dict]] | None = None,
+) -> dict:
+    """
+    Submit every job as one Message Batches request and save the state needed
+    to resume (batch ID, and each request's skill, files and cache keys) to
+    state_path. Returns the state.
+    """
+    requests = []
+    state: dict = {"model": model, "requests": {}}
+    for i, (gi, shard) in enumerate(jobs):
+        custom_id = f"shard-{i}"
+        requests.append({
+            "custom_id": custom_id,
+            "params": build_request(
+                model, review_prompt(groups[gi][1]), shard, context_only, None,
+                _shard_accepted(shard, accepted),
+            ),
+        })
+        state["requests"][custom_id] = {
+            "skill": groups[gi][0],
+            "files": [rel for rel, _ in shard],
+            "keys": {rel: keys[gi, rel] for rel, _ in shard if (gi, rel) in keys},
+        }
+    batch = client.messages.batches.create(requests=requests)
+    state["batch_id"] = batch.id
+    state_path.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    print(f"Submitted batch {batch.id} with {len(requests)} request(s); "
+          f"state saved to {state_path}")
+    return state
+
+
+def wait_for_batch(client: anthropic.Anthropic, batch_id: str) -> None:
+    """Poll until the batch has finished processing."""
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        print(f"  [batch {batch_id}] {batch.processing_status}: "
+              f"{counts.succeeded} succeeded, {counts.errored} errored, "
+              f"{counts.processing} processing", flush=True)
+        if batch.processing_status == "ended":
+            return
+        time.sleep(BATCH_POLL_SECONDS)
+
+
+def _continue_batch_result(
+    client: anthropic.Anthropic,
+    model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    request: dict,
+    text: str,
+    context_only: set[str],
+    usage: TokenUsage,
+    accepted: dict[str, list[dict]] | None = None,
+) -> str:
+    """
+    Finish a batch result cut off at max_tokens with streamed continuations,
+    rebuilding its request from the current files. Returns the full text, or
+    the truncated text if the request can't be rebuilt or continuing fails.
+    """
+    skill_text = next((t for name, t, _ in groups if name == request["skill"]), None)
+    contents = {rel: content for _, _, files in groups for rel, content in files}
+    if skill_text is None or any(rel not in contents for rel in request["files"]):
+        return text
+    shard = [(rel, contents[rel]) for rel in request["files"]]
+    kwargs = build_request(
+        model, review_prompt(skill_text), shard, context_only, None,
+        _shard_accepted(shard, accepted),
+    )
+    parser = StreamParser()
+    parts = [text.rstrip()]
+    parser.feed(parts[0])
+    if parser.finished:
+        return text
+
+    def on_text(more: str) -> None:
+        parts.append(more)
+        parser.feed(more)
+
+    usage.add_continuation()
+    print("  [continue] batch result hit max_tokens; resuming with a streamed request")
+    try:
+        stream_review(client, kwargs, on_text, usage, lambda: parser.finished, parts[0])
+    except anthropic.APIError as exc:
+        print(f"  [continue] batch result could not be resumed: {exc}", file=sys.stderr)
+    return "".join(parts)
+
+
+def review_files_batch(
+    client: anthropic.Anthropic,
+    model: str,
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]],
+    shard_tokens: int | None = None,
+    context_only: set[str] | None = None,
+    cache: "ReviewCache | None" = None,
+    on_edit: Callable[[str, str, str], None] | None = None,
+    state_path: Path = Path(DEFAULT_BATCH_STATE),
+    batch_id: str | None = None,
+    on_findings: Callable[[list[dict]], None] | None = None,
+    cache_context: dict[tuple[int, str], str] | None = None,
+    accepted: dict[str, list[dict]] | None = None,
+) -> ReviewResult:
+    """
+    Like review_files, but sends the requests through the Message Batches API
+    and feeds the results through the same parse/apply/cache pipeline. With
+    batch_id, resumes a batch submitted earlier from the state in state_path
+    instead of submitting a new one. `accepted` is as for review_files.
+    """
+    context_only = context_only or set()
+    result = ReviewResult()
+    jobs, hits, keys = plan_jobs(
+        groups, model, shard_tokens, context_only, cache, cache_context
+    )
+    for rel, findings, edit in hits:
+        result.findings += findings
+        if on_findings is not None and findings:
+            on_findings(findings)
+        if edit is not None:
+            result.edits[rel] = edit
+            if on_edit is not None:
+                on_edit(edit[0], rel, edit[1])
+
+    if batch_id is not None:
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+        if state.get("batch_id") != batch_id:
+            raise ValueError(f"{state_path} holds batch {state.get('batch_id')}, not {batch_id}")
+    elif jobs:
+        state = submit_batch(
+            client, model, groups, jobs, keys, context_only, state_path, accepted
+        )
+    else:
+        return result
+
+    batch_id = state["batch_id"]
+    print(f"Waiting for batch {batch_id} (resume later with --batch-id {batch_id})...")
+    wait_for_batch(client, batch_id)
+
+    requests = state["requests"]
+    result.requested = sum(len(r["files"]) for r in requests.values())
+    pending = set(requests)
+    for entry in client.messages.batches.results(batch_id):
+        request = requests.get(entry.custom_id)
+        if request is None:
+            continue
+        pending.discard(entry.custom_id)
+        if entry.result.type != "succeeded":
+            print(f"  [{entry.custom_id}] {entry.result.type}", file=sys.stderr)
+            result.unreviewed += request["files"]
+            continue
+        message = entry.result.message
+        result.usage.add(message.usage)
+        text = "".join(b.text for b in message.content if b.type == "text")
+        if message.stop_reason == "max_tokens":
+            text = _continue_batch_result(client, model, groups, request, text,
+                                          context_only, result.usage, accepted)
+        findings = parse_findings(text)
+        edits = {rel: ("rewrite", body) for rel, body in parse_rewrites(text).items()}
+        edits.update({rel: ("patch", body) for rel, body in parse_patches(text).items()})
+        if request["skill"]:
+            for f in findings:
+                f.setdefault("skill", request["skill"])
+        result.findings += findings
+        if on_findings is not None and findings:
+            on_findings(findings)
+        result.edits.update(edits)
+        if on_edit is not None:
+            for rel, (kind, body) in edits.items():
+                on_edit(kind, rel, body)
+        if cache is not None:
+            for rel, key in request["keys"].items():
+                cache.put(key, [f for f in findings if f.get("file") == rel], edits.get(rel))
+    for custom_id in pending:
+        result.unreviewed += requests[custom_id]["files"]
+    return result
+
+
+def parse_rewrites(response: str) -> dict[str, str]:
+    """Extract <soundcheck-rewrite file="..."> blocks from the response."""
+    pattern = re.compile(
+        r'<soundcheck-rewrite\s+file="([^"]+)">\n(.*?)\n</soundcheck-rewrite>',
+        re.DOTALL,
+    )
+    return {m.group(1): m.group(2) for m in pattern.finditer(response)}
+
+
+def parse_patches(response: str) -> dict[str, str]:
+    """Extract <soundcheck-patch file="..."> blocks, joining blocks for the same file."""
+    pattern = re.compile(
+        r'<soundcheck-patch\s+file="([^"]+)">\n(.*?)\n</soundcheck-patch>',
+        re.DOTALL,
+    )
+    patches: dict[str, str] = {}
+    for m in pattern.finditer(response):
+        rel_path, body = m.group(1), m.group(2)
+        patches[rel_path] = patches[rel_path] + "\n" + body if rel_path in patches else body
+    return patches
+
+
+def parse_findings(response: str) -> list[dict]:
+    """Extract <soundcheck-findings> JSON array from the response."""
+    match = re.search(
+        r"<soundcheck-findings>\s*(\[.*?\])\s*</soundcheck-findings>",
+        response,
+        re.DOTALL,
+    )
+    if not match:
+        return []
+    try:
+        return json.loads(match.group(1))
+    except (json.JSONDecodeError, ValueError):
+        return []
+
+
+_BLOCK_OPEN = re.compile(r'<soundcheck-(rewrite|patch)\s+file="([^"]+)">\n')
+_FINDINGS_OPEN = "<soundcheck-findings>"
+_TAG_PREFIX = "<soundcheck-"
+_MAX_OPEN_TAG = 4096
+
+
+class StreamParser:
+    """
+    Incremental parser for <soundcheck-rewrite>, <soundcheck-patch> and
+    <soundcheck-findings> blocks in a streamed response.
+
+    feed() returns completed blocks as (kind, file, body) events: kind is
+    "rewrite" or "patch" with the block text as body, or "findings" with the
+    decoded JSON list. Prose outside blocks is discarded as it streams past,
+    so only the block currently being received is held in memory.
+    """
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._block: tuple[str, str | None] | None = None
+        self.saw_findings = False
+
+    @property
+    def finished(self) -> bool:
+        """True once the findings list has closed and no block is open."""
+        return self.saw_findings and self._block is None
+
+    def feed(self, text: str) -> list[tuple[str, str | None, object]]:
+        self._buf += text
+        events: list[tuple[str, str | None, object]] = []
+        while True:
+            if self._block is None:
+                idx = self._buf.find(_TAG_PREFIX)
+                if idx < 0:
+                    # Keep just enough to recognize a tag split across deltas
+                    self._buf = self._buf[-(len(_TAG_PREFIX) - 1):]
+                    return events
+                self._buf = self._buf[idx:]
+                m = _BLOCK_OPEN.match(self._buf)
+                if m:
+                    self._block = (m.group(1), m.group(2))
+                    self._buf = self._buf[m.end():]
+                elif self._buf.startswith(_FINDINGS_OPEN):
+                    self._block = ("findings", None)
+                    self._buf = self._buf[len(_FINDINGS_OPEN):]
+                elif "\n" not in self._buf and len(self._buf) < _MAX_OPEN_TAG:
+                    return events  # opening tag may still be arriving
+                else:
+                    self._buf = self._buf[1:]
+                continue
+
+            kind, rel_path = self._block
+            close = f"\n</soundcheck-{kind}>" if rel_path else "</soundcheck-findings>"
+            end = self._buf.find(close)
+            if end < 0:
+                return events
+            body, self._buf = self._buf[:end], self._buf[end + len(close):]
+            self._block = None
+            if kind != "findings":
+                events.append((kind, rel_path, body))
+                continue
+            try:
+                parsed = json.loads(body.strip())
+            except (json.JSONDecodeError, ValueError):
+                continue
+            if isinstance(parsed, list):
+                self.saw_findings = True
+                events.append((kind, None, parsed))
+
+
+def _rewrite_target(
+    repo_dir: Path, rel_path: str, reviewed: set[str]
+) -> tuple[str, Path] | None:
+    """Return (safe_rel, absolute_target) if rel_path may be written, else None."""
+    safe_rel = rel_path.replace("\r", "").replace("\n", "")
+    if safe_rel not in reviewed:
+        print(f"  [skip] {safe_rel} — not in reviewed file set", file=sys.stderr)
+        return None
+    target = (repo_dir / safe_rel).resolve()
+    if not target.is_relative_to(repo_dir.resolve()):
+        print(f"  [skip] {safe_rel} — path outside repo root", file=sys.stderr)
+        return None
+    return safe_rel, target
+
+
+def _atomic_write(target: Path, data: bytes) -> None:
+    """Replace target with data via a temp file in the same directory."""
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=target.parent)
+    try:
+        with os.fdopen(tmp_fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, target)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def apply_rewrites(
+    repo_dir: Path, rewrites: dict[str, str], reviewed: set[str]
+) -> list[str]:
+    """
+    Write rewritten content to disk using atomic writes.
+    Skips any path that:
+      - escapes the repo root (path traversal guard)
+      - was not in the set of files sent for review (allowlist)
+    Returns list of relative paths successfully written.
+    """
+    written: list[str] = []
+    for rel_path, content in rewrites.items():
+        resolved = _rewrite_target(repo_dir, rel_path, reviewed)
+        if resolved is None:
+            continue
+        safe_rel, target = resolved
+        target.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write(target, content.encode("utf-8"))
+        written.append(safe_rel)
+        print(f"  [rewrite] {safe_rel}")
+    return written
+
+
+def mirror_copies(
+    repo_dir: Path, rel_path: str, copies: list[str], before: bytes, reviewed: set[str]
+) -> list[str]:
+    """
+    Write rel_path's freshly edited content over each of its byte-identical
+    copies, skipping any copy that no longer matches `before` (rel_path's
+    content prior to the edit). Returns list of relative paths written.
+    """
+    after = (repo_dir / rel_path).read_bytes()
+    written: list[str] = []
+    for copy in copies:
+        resolved = _rewrite_target(repo_dir, copy, reviewed)
+        if resolved is None:
+            continue
+        safe_rel, target = resolved
+        try:
+            if target.read_bytes() != before:
+                print(f"  [skip] {safe_rel} — no longer identical to {rel_path}",
+                      file=sys.stderr)
+                continue
+            _atomic_write(target, after)
+        except OSError as exc:
+            print(f"  [skip] {safe_rel} — {exc}", file=sys.stderr)
+            continue
+        written.append(safe_rel)
+        print(f"  [rewrite] {safe_rel} (copy of {rel_path})")
+    return written
+
+
+class PatchError(ValueError):
+    """A patch hunk could not be matched unambiguously against the original."""
+
+
+_HUNK = re.compile(
+    r"^<{7} SEARCH[ \t]*\n(.*?)^={7}[ \t]*\n(.*?)^>{7} REPLACE[ \t]*$",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+def _find_hunk(lines: list[str], search: list[str]) -> int:
+    """Index of the unique run of lines equal to search, ignoring trailing whitespace."""
+    for normalize in (lambda l: l.rstrip("\r\n"), str.rstrip):
+        wanted = [normalize(l) for l in search]
+        have = [normalize(l) for l in lines]
+        matches = [
+            i for i in range(len(have) - len(wanted) + 1)
+            if have[i:i + len(wanted)] == wanted
+        ]
+        if len(matches) == 1:
+            return matches[0]
+        if len(matches) > 1:
+            raise PatchError(f"SEARCH block matches {len(matches)} places")
+    raise PatchError("SEARCH block not found")
+
+
+def apply_patch(original: str, patch: str) -> str:
+    """
+    Apply search/replace hunks to original, in order, and return the result.
+    Every hunk must match exactly one run of lines in the text as left by the
+    previous hunks; otherwise PatchError is raised and nothing is applied.
+    """
+    hunks = _HUNK.findall(patch)
+    if not hunks:
+        raise PatchError("no SEARCH/REPLACE hunks")
+    newline = "\r\n" if "\r\n" in original else "\n"
+    lines = original.splitlines(keepends=True)
+    for search, replace in hunks:
+        search_lines = search.splitlines()
+        if not any(l.strip() for l in search_lines):
+            raise PatchError("empty SEARCH block")
+        start = _find_hunk(lines, search_lines)
+        end = start + len(search_lines)
+        replacement = [l + newline for l in replace.splitlines()]
+        if replacement and end == len(lines) and not lines[-1].endswith(("\n", "\r")):
+            replacement[-1] = replacement[-1].rstrip("\r\n")
+        lines[start:end] = replacement
+    return "".join(lines)
+
+
+def apply_patches(
+    repo_dir: Path, patches: dict[str, str], reviewed: set[str]
+) -> list[str]:
+    """
+    Validate each file's patch against its current content and write the
+    result atomically via apply_rewrites. A file is only written if every
+    one of its hunks applies. Returns list of relative paths written.
+    """
+    rewrites: dict[str, str] = {}
+    for rel_path, patch in patches.items():
+        resolved = _rewrite_target(repo_dir, rel_path, reviewed)
+        if resolved is None:
+            continue
+        safe_rel, target = resolved
+        try:
+            # Decode bytes directly: read_text() would turn CRLF into LF
+            original = target.read_bytes().decode("utf-8")
+            rewrites[safe_rel] = apply_patch(original, patch)
+        except (OSError, UnicodeDecodeError, PatchError) as exc:
+            print(f"  [skip] {safe_rel} — patch rejected: {exc}", file=sys.stderr)
+    return apply_rewrites(repo_dir, rewrites, reviewed)
+
+
+def apply_chunk_edit(
+    repo_dir: Path,
+    chunk: Chunk,
+    kind: str,
+    body: str,
+    reviewed: set[str],
+    shifts: dict[tuple[str, int], int],
+) -> list[str]:
+    """
+    Apply a patch or rewrite of one chunk to its line range in the file on
+    disk. `shifts` records how many lines each chunk edit so far has added,
+    keyed by (path, chunk start), so later edits to other chunks of the same
+    file land on the right lines. Returns list of relative paths written.
+    """
+    resolved = _rewrite_target(repo_dir, chunk.path, reviewed)
+    if resolved is None:
+        return []
+    safe_rel, target = resolved
+    own = shifts.get((chunk.path, chunk.start), 0)
+    offset = sum(
+        delta for (path, start), delta in shifts.items()
+        if path == chunk.path and start < chunk.start
+    )
+    try:
+        lines = target.read_bytes().decode("utf-8").splitlines(keepends=True)
+        start, end = chunk.start + offset, chunk.end + offset + own
+        original = "".join(lines[start:end])
+        if kind == "patch":
+            replacement = apply_patch(original, body)
+        else:
+            # Drop the shared header if the model echoed it back
+            replacement = _CHUNK_MARKER_LINE.split(body, maxsplit=1)[-1]
+            if original.endswith("\n") and not replacement.endswith("\n"):
+                replacement += "\n"
+    except (OSError, UnicodeDecodeError, PatchError) as exc:
+        print(f"  [skip] {chunk.label} — {kind} rejected: {exc}", file=sys.stderr)
+        return []
+    new_lines = replacement.splitlines(keepends=True)
+    shifts[chunk.path, chunk.start] = own + len(new_lines) - (end - start)
+    content = "".join(lines[:start] + new_lines + lines[end:])
+    return apply_rewrites(repo_dir, {safe_rel: content}, reviewed)
+
+
+_BLOCK_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+_LINE_NOISE = {
+    # Strings, char literals and line comments, per language family
+    "c": re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.[^']*|[^'\\])'|//.*)"""),
+    "script": re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`[^`]*`|//.*|#.*)"""),
+}
+_C_LIKE = {".go", ".java", ".cs", ".rs"}
+_PAIRS = {")": "(", "]": "[", "}": "{"}
+
+
+def _bracket_error(text: str, suffix: str) -> str | None:
+    """First unbalanced (), [] or {} outside strings and comments, or None."""
+    noise = _LINE_NOISE["c" if suffix in _C_LIKE else "script"]
+    stack: list[tuple[str, int]] = []
+    for lineno, line in enumerate(_BLOCK_COMMENT.sub("", text).splitlines(), 1):
+        for ch in noise.sub("", line):
+            if ch in "([{":
+                stack.append((ch, lineno))
+            elif ch in _PAIRS:
+                if not stack or stack[-1][0] != _PAIRS[ch]:
+                    return f"unmatched '{ch}' near line {lineno}"
+                stack.pop()
+    if stack:
+        return f"unclosed '{stack[-1][0]}' from line {stack[-1][1]}"
+    return None
+
+
+def check_syntax(path: str) -> str | None:
+    """
+    Syntax-check one file: compile() for Python, `node --check` for
+    JavaScript when node is installed, bracket balance otherwise.
+    Returns an error message, or None if the file passes.
+    """
+    suffix = os.path.splitext(path)[1]
+    try:
+        source = Path(path).read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError) as exc:
+        return str(exc)
+    if suffix == ".py":
+        try:
+            compile(source, path, "exec", dont_inherit=True)
+        except (SyntaxError, ValueError) as exc:
+            return f"{type(exc).__name__}: {exc}"
+        return None
+    if suffix == ".js" and shutil.which("node"):
+        try:
+            proc = subprocess.run(
+                ["node", "--check", path], capture_output=True, text=True,
+                timeout=VERIFY_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired) as exc:
+            return f"node --check: {exc}"
+        if proc.returncode == 0:
+            return None
+        lines = [l for l in proc.stderr.splitlines() if "Error" in l]
+        return lines[0] if lines else "node --check failed"
+    return _bracket_error(source, suffix)
+
+
+def _verify_edit(path: str, original: bytes) -> str | None:
+    """
+    check_syntax() for an edited file, ignoring failures the original already
+    had (the checks are heuristics, and old syntax is not the model's fault).
+    Runs in a worker process.
+    """
+    error = check_syntax(path)
+    if error is None:
+        return None
+    # Check the original next to the file so node resolves the same package type
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(original)
+        return None if check_syntax(tmp_path) is not None else error
+    finally:
+        os.unlink(tmp_path)
 
-# Appended to the skill's own system prompt to request structured output.
-SYSTEM_SUFFIX = """
----
 
-After your findings table and prose rewrites, output all results in the following
-machine-readable format so they can be applied automatically.
+def verify_edits(
+    repo_dir: Path, originals: dict[str, bytes], workers: int = VERIFY_WORKERS
+) -> list[tuple[str, str]]:
+    """
+    Syntax-check every edited file in a process pool and atomically restore
+    any that now fail from its original bytes. Returns (path, error) for each
+    file rolled back.
+    """
+    if not originals:
+        return []
+    rels = sorted(originals)
+    with ProcessPoolExecutor(max_workers=min(workers, len(rels))) as pool:
+        errors = list(pool.map(
+            _verify_edit, [str(repo_dir / rel) for rel in rels], [originals[r] for r in rels]
+        ))
+    rolled_back: list[tuple[str, str]] = []
+    for rel, error in zip(rels, errors):
+        if error is None:
+            continue
+        _atomic_write(repo_dir / rel, originals[rel])
+        print(f"  [rollback] {rel} — {error}", file=sys.stderr)
+        rolled_back.append((rel, error))
+    return rolled_back
 
-For each Critical, High, or Medium finding where you rewrote a file, output one block:
 
-<soundcheck-rewrite file="relative/path/to/file">
-complete rewritten file content — the full file, not a diff
-</soundcheck-rewrite>
+class ReviewCache:
+    """
+    On-disk, content-addressed cache of per-file review results.
 
-Then output a JSON findings list:
+    Each entry is a JSON file named by cache_key() holding the file's findings
+    (with the "file" field stripped, so identical content at another path hits
+    too) and its edit, if any, as a full "rewrite" or a "patch". File mtimes
+    track last use for LRU eviction.
+    """
 
-<soundcheck-findings>
-[
-  {
-    "severity": "Critical|High|Medium|Low",
-    "file": "relative/path/to/file",
-    "skill": "skill-name",
-    "finding": "one-line description"
-  }
-]
-</soundcheck-findings>
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        root.mkdir(parents=True, exist_ok=True)
 
-Severity definitions:
-- Critical: exploitable remotely, no authentication required
-- High: exploitable with authentication, or significant data exposure
-- Medium: limited exploitability or requires user interaction
-- Low: defense-in-depth / informational
-"""
+    @staticmethod
+    def cache_key(content: str, skill_text: str, model: str, context: str = "") -> str:
+        """Key for a file's result; `context` is other text its review depended on."""
+        digest = hashlib.sha256()
+        for part in (content, skill_text, SYSTEM_SUFFIX, model) + ((context,) if context else ()):
+            encoded = part.encode("utf-8", errors="replace")
+            digest.update(len(encoded).to_bytes(8, "big"))
+            digest.update(encoded)
+        return digest.hexdigest()
 
-USER_PROMPT_HEADER = """\
-Review the following repository files for security issues. Identify all \
-vulnerabilities. Rewrite every file that has a Critical, High, or Medium finding — \
-output the complete rewritten file, not a diff.
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
 
-"""
+    def get(
+        self, key: str, rel_path: str
+    ) -> tuple[list[dict], tuple[str, str] | None] | None:
+        """Return (findings, edit) for key, attributed to rel_path, or None on a miss."""
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except (OSError, json.JSONDecodeError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        findings = [{**f, "file": rel_path} for f in entry.get("findings", [])]
+        edit = None
+        for kind in ("rewrite", "patch"):
+            if entry.get(kind) is not None:
+                edit = (kind, entry[kind])
+        return findings, edit
 
+    def put(
+        self, key: str, findings: list[dict], edit: tuple[str, str] | None
+    ) -> None:
+        entry = {
+            "findings": [{k: v for k, v in f.items() if k != "file"} for f in findings],
+            "rewrite": edit[1] if edit and edit[0] == "rewrite" else None,
+            "patch": edit[1] if edit and edit[0] == "patch" else None,
+        }
+        _atomic_write(self._path(key), json.dumps(entry).encode("utf-8"))
 
-def collect_files(repo_dir: Path, max_files: int) -> list[tuple[str, str]]:
-    """
-    Glob source files from repo_dir, respecting size and count limits.
-    Returns a list of (relative_path, content) tuples.
-    """
-    candidates: list[Path] = []
-    seen: set[Path] = set()
-    for pattern in SOURCE_GLOBS:
-        for path in sorted(repo_dir.glob(pattern)):
-            if any(skip in path.parts for skip in SKIP_DIRS):
+    def evict(self) -> int:
+        """Remove least-recently-used entries until the cache fits max_bytes."""
+        entries = []
+        for path in self.root.glob("*.json"):
+            try:
+                st = path.stat()
+            except OSError:
                 continue
-            if path not in seen:
-                seen.add(path)
-                candidates.append(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
 
-    files: list[tuple[str, str]] = []
-    total_bytes = 0
-    for path in candidates:
-        if len(files) >= max_files or total_bytes >= MAX_TOTAL_BYTES:
-            break
-        try:
-            content = path.read_text(encoding="utf-8", errors="replace")
-        except OSError:
-            continue
-        if len(content.encode()) > MAX_FILE_BYTES:
-            content = content[:MAX_FILE_BYTES] + "\n# [TRUNCATED — file exceeds 50 KB]"
-        rel = str(path.relative_to(repo_dir))
-        files.append((rel, content))
-        total_bytes += len(content.encode())
+    def export(self, dest: Path) -> int:
+        """Write every entry to a JSONL file, oldest first. Returns the entry count."""
+        count = 0
+        with dest.open("w", encoding="utf-8") as out:
+            for path in sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime):
+                try:
+                    entry = json.loads(path.read_text(encoding="utf-8"))
+                except (OSError, json.JSONDecodeError, ValueError):
+                    continue
+                record = {"key": path.stem, "last_used": path.stat().st_mtime, **entry}
+                out.write(json.dumps(record) + "\n")
+                count += 1
+        return count
 
-    return files
+    def import_(self, src: Path) -> int:
+        """
+        Load entries from an export() file, keeping their last-used times.
+        Malformed records are skipped.
+        """
+        count = 0
+        for line in src.read_text(encoding="utf-8").splitlines():
+            try:
+                record = json.loads(line)
+                key = record["key"]
+                last_used = float(record.get("last_used", time.time()))
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                continue
+            findings = record.get("findings", [])
+            if (not re.fullmatch(r"[0-9a-f]{64}", str(key)) or not math.isfinite(last_used)
+                    or not isinstance(findings, list)
+                    or not all(isinstance(f, dict) for f in findings)):
+                continue
+            edit = None
+            for kind in ("rewrite", "patch"):
+                if isinstance(record.get(kind), str):
+                    edit = (kind, record[kind])
+            self.put(key, findings, edit)
+            os.utime(self._path(key), (last_used, last_used))
+            count += 1
+        return count
 
 
-_SOUNDCHECK_TAG = re.compile(r"<(/?)soundcheck-", re.IGNORECASE)
+@lru_cache(maxsize=64)
+def _definition_spans(rel_path: str, source: str) -> list[tuple[str, int, int]]:
+    return _definitions(rel_path, source)
 
 
-def _sanitize_content(content: str) -> str:
-    """Neutralize soundcheck XML tags in file content to prevent prompt injection."""
-    return _SOUNDCHECK_TAG.sub(r"<\1soundcheck\u2011", content)
+def _enclosing_spans(rel_path: str, source: str, line: int) -> list[tuple[str, int, int]]:
+    """(name, start, end) of the definitions around 1-based `line`, outermost first."""
+    return sorted(
+        (span for span in _definition_spans(rel_path, source) if span[1] < line <= span[2]),
+        key=lambda span: span[1] - span[2],
+    )
 
 
-def build_user_prompt(files: list[tuple[str, str]]) -> str:
-    parts = [USER_PROMPT_HEADER]
-    for rel_path, content in files:
-        ext = Path(rel_path).suffix.lstrip(".")
-        parts.append(f"## {rel_path}\n```{ext}\n{_sanitize_content(content)}\n```\n")
-    return "\n".join(parts)
+def enclosing_definition(rel_path: str, source: str, line: int) -> str:
+    """
+    Dotted name of the definitions around 1-based `line`, outermost first
+    ("Repo.find"), or "" at module level or when the file can't be parsed.
+    """
+    return ".".join(name for name, _, _ in _enclosing_spans(rel_path, source, line))
 
 
-def parse_rewrites(response: str) -> dict[str, str]:
-    """Extract <soundcheck-rewrite file="..."> blocks from the response."""
-    pattern = re.compile(
-        r'<soundcheck-rewrite\s+file="([^"]+)">\n(.*?)\n</soundcheck-rewrite>',
-        re.DOTALL,
-    )
-    return {m.group(1): m.group(2) for m in pattern.finditer(response)}
+def _normalized(lines: list[str]) -> str:
+    """Lines stripped of indentation and trailing space, blank lines dropped."""
+    return "".join(line.strip() + "\n" for line in lines if line.strip())
 
 
-def parse_findings(response: str) -> list[dict]:
-    """Extract <soundcheck-findings> JSON array from the response."""
-    match = re.search(
-        r"<soundcheck-findings>\s*(\[.*?\])\s*</soundcheck-findings>",
-        response,
-        re.DOTALL,
-    )
-    if not match:
-        return []
+def fingerprint(finding: dict, source: str | None) -> str:
+    """
+    Stable ID for a finding: its file, skill and the code around its line,
+    never the model's wording. Inside a definition the anchor is the dotted
+    name (see enclosing_definition) plus the normalized code of the
+    innermost definition, so it survives edits elsewhere in the file and a
+    line that is off by a few, but not a change to that code. Elsewhere (at
+    module level, or in a file whose definitions can't be found) it is the
+    normalized code of the line and FINGERPRINT_WINDOW non-blank lines each
+    side. Findings of one skill on the same anchor share an ID, as do
+    line-less findings of one skill in a file; is_baselined still compares
+    severities.
+    """
+    anchor = ""
+    line = finding.get("line")
+    if source is not None and isinstance(line, int) and line > 0:
+        lines = source.splitlines()
+        while 1 < line <= len(lines) and not lines[line - 1].strip():
+            line -= 1  # a blank line is a near miss for the code above it
+        around = _enclosing_spans(finding.get("file", ""), source, line)
+        if around:
+            _, start, end = around[-1]
+            anchor = ".".join(name for name, _, _ in around) + "\n" + _normalized(lines[start:end])
+        else:
+            code = [i for i, text in enumerate(lines) if text.strip()]
+            at = sum(1 for i in code if i < line - 1)
+            window = code[max(0, at - FINGERPRINT_WINDOW):at + FINGERPRINT_WINDOW + 1]
+            anchor = _normalized([lines[i] for i in window])
+    digest = hashlib.sha256()
+    for part in (finding.get("file", ""), finding.get("skill") or "security-review", anchor):
+        encoded = part.encode("utf-8", errors="replace")
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()[:32]
+
+
+def load_baseline(path: Path) -> dict[str, dict]:
+    """Accepted findings by fingerprint; a missing file is an empty baseline."""
     try:
-        return json.loads(match.group(1))
-    except (json.JSONDecodeError, ValueError):
-        return []
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    return {
+        entry["fingerprint"]: entry for entry in data.get("findings", [])
+        if isinstance(entry, dict) and "fingerprint" in entry
+    }
 
 
-def apply_rewrites(
-    repo_dir: Path, rewrites: dict[str, str], reviewed: set[str]
-) -> list[str]:
+def is_baselined(finding: dict, baseline: dict[str, dict]) -> bool:
+    """True if the finding was accepted at the same or a higher severity."""
+    entry = baseline.get(finding.get("fingerprint", ""))
+    if entry is None:
+        return False
+    current, accepted = (
+        float(SECURITY_SEVERITY.get(f.get("severity"), "2.0")) for f in (finding, entry)
+    )
+    return current <= accepted
+
+
+def write_baseline(
+    path: Path, baseline: dict[str, dict], findings: list[dict], reviewed: set[str]
+) -> int:
     """
-    Write rewritten content to disk using atomic writes.
-    Skips any path that:
-      - escapes the repo root (path traversal guard)
-      - was not in the set of files sent for review (allowlist)
-    Returns list of relative paths successfully written.
+    Accept the current findings: replace the baseline entries of every
+    reviewed file with this run's findings, keep the entries of files not
+    reviewed this run, and write the result sorted for stable diffs.
+    Findings sharing a fingerprint are recorded at the highest severity, so
+    none of them is reported again at or below it.
+    `reviewed` must hold only files reviewed in full: a file left out keeps
+    its accepted entries. Returns the number of entries written.
     """
-    import tempfile
-    repo_root = repo_dir.resolve()
-    written: list[str] = []
-    for rel_path, content in rewrites.items():
-        safe_rel = rel_path.replace("\r", "").replace("\n", "")
-        if safe_rel not in reviewed:
-            print(f"  [skip] {safe_rel} — not in reviewed file set", file=sys.stderr)
-            continue
-        target = (repo_dir / safe_rel).resolve()
-        if not target.is_relative_to(repo_root):
-            print(f"  [skip] {safe_rel} — path outside repo root", file=sys.stderr)
-            continue
-        target.parent.mkdir(parents=True, exist_ok=True)
-        tmp_fd, tmp_path = tempfile.mkstemp(dir=target.parent)
-        try:
-            with os.fdopen(tmp_fd, "w", encoding="utf-8") as fh:
-                fh.write(content)
-            os.replace(tmp_path, target)
-        except Exception:
-            os.unlink(tmp_path)
-            raise
-        written.append(safe_rel)
-        print(f"  [rewrite] {safe_rel}")
-    return written
+    keep = ("fingerprint", "file", "line", "severity", "skill", "finding")
+    entries = {fp: e for fp, e in baseline.items() if e.get("file") not in reviewed}
+    for f in findings:
+        current = entries.get(f["fingerprint"])
+        if current is None or not is_baselined(f, {f["fingerprint"]: current}):
+            entries[f["fingerprint"]] = {k: f[k] for k in keep if k in f}
+    ordered = sorted(entries.values(), key=lambda e: (e.get("file", ""), e["fingerprint"]))
+    data = json.dumps({"version": 1, "findings": ordered}, indent=2) + "\n"
+    _atomic_write(path, data.encode("utf-8"))
+    return len(ordered)
 
 
-def build_pr_body(findings: list[dict], rewritten: list[str], file_count: int) -> str:
-    if not findings:
-        return (
-            "## Soundcheck Security Review\n\n"
-            f"Scanned {file_count} file(s). No issues found. ✅\n\n"
-            "_Generated by [Soundcheck](https://github.com/thejefflarson/soundcheck)_"
-        )
+def rule_id(finding: dict) -> str:
+    """Stable rule ID for a finding: one rule per skill."""
+    return f"soundcheck/{finding.get('skill') or 'security-review'}"
+
+
+class FindingsWriter(abc.ABC):
+    """
+    Write findings to a file one at a time as they are parsed, so large scans
+    reach disk (and downstream ingestion) without waiting for the whole run.
+    Safe to call from worker threads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = path.open("w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self.count = 0
 
+    def write(self, finding: dict) -> None:
+        with self._lock:
+            self._file.write(self._format(finding))
+            self._file.flush()
+            self.count += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+    @abc.abstractmethod
+    def _format(self, finding: dict) -> str:
+        """The text appended to the file for one finding."""
+
+
+class JsonlWriter(FindingsWriter):
+    """One JSON object per line: the finding plus its ruleId."""
+
+    def _format(self, finding: dict) -> str:
+        return json.dumps({"ruleId": rule_id(finding), **finding}) + "\n"
+
+
+class SarifWriter(FindingsWriter):
+    """
+    A SARIF 2.1.0 log with a single run. The run header (with one rule per
+    skill in skills_dir and severity, since code scanning only reads
+    security-severity from rules) is written up front and each result is
+    appended as it arrives; close() writes the closing brackets.
+    """
+
+    def __init__(self, path: Path, skills_dir: Path):
+        super().__init__(path)
+        skills = {"security-review": "Security review"}  # rule_id() for findings without one
+        for skill_md in sorted(skills_dir.glob("*/SKILL.md")):
+            title = re.search(r"^# (.+)$", skill_md.read_text(encoding="utf-8"), re.MULTILINE)
+            skills[skill_md.parent.name] = title.group(1) if title else skill_md.parent.name
+        rules = [
+            {
+                "id": f"soundcheck/{name}/{severity.lower()}",
+                "name": name,
+                "shortDescription": {"text": f"{text} ({severity})"},
+                "properties": {"security-severity": score},
+            }
+            for name, text in skills.items() for severity, score in SECURITY_SEVERITY.items()
+        ]
+        log = {
+            "version": "2.1.0",
+            "$schema": SARIF_SCHEMA,
+            "runs": [{
+                "tool": {"driver": {
+                    "name": "Soundcheck",
+                    "informationUri": "https://github.com/thejefflarson/soundcheck",
+                    "rules": rules,
+                }},
+                "results": [],
+            }],
+        }
+        # Split the serialized log at the empty results array to stream into it
+        head, self._tail = json.dumps(log, indent=2).split('"results": []')
+        self._file.write(head + '"results": [')
+        self._file.flush()
+
+    def _format(self, finding: dict) -> str:
+        severity = finding.get("severity", "Low")
+        if severity not in SECURITY_SEVERITY:
+            severity = "Low"
+        location: dict = {"artifactLocation": {
+            "uri": finding.get("file", ""), "uriBaseId": "%SRCROOT%",
+        }}
+        if isinstance(finding.get("line"), int):
+            location["region"] = {"startLine": finding["line"]}
+        elif finding.get("lines"):
+            first, last = finding["lines"].lstrip("L").split("-L")
+            location["region"] = {"startLine": int(first), "endLine": int(last)}
+        result = {
+            "ruleId": f"{rule_id(finding)}/{severity.lower()}",
+            "level": SARIF_LEVELS[severity],
+            "message": {"text": finding.get("finding", "")},
+            "locations": [{"physicalLocation": location}],
+            "properties": {"severity": severity},
+        }
+        if finding.get("fingerprint"):
+            result["partialFingerprints"] = {"soundcheck/v1": finding["fingerprint"]}
+        return ("," if self.count else "") + "\n" + json.dumps(result)
+
+    def close(self) -> None:
+        self._file.write("\n      ]" + self._tail + "\n")
+        super().close()
+
+
+def _findings_table(findings: list[dict]) -> list[str]:
+    """Markdown table rows for findings, most severe first."""
     by_severity = {s: [] for s in ("Critical", "High", "Medium", "Low")}
     for f in findings:
         by_severity.setdefault(f.get("severity", "Low"), []).append(f)
 
     icons = {"Critical": "🔴", "High": "🟠", "Medium": "🟡", "Low": "🔵"}
-    total = len(findings)
     lines = [
-        "## Soundcheck Security Review",
-        "",
-        f"Scanned **{file_count}** file(s) · "
-        f"Found **{total}** issue(s) · "
-        f"Rewrote **{len(rewritten)}** file(s)",
-        "",
         "| Severity | File | Skill | Finding |",
         "|----------|------|-------|---------|",
     ]
@@ -219,15 +3481,93 @@ def build_pr_body(findings: list[dict], rewritten: list[str], file_count: int) -
         for f in by_severity[severity]:
             icon = icons[severity]
             file_ = f"`{f.get('file', '—')}`" if f.get("file") else "—"
+            if f.get("lines"):
+                file_ += f" ({f['lines']})"
             skill = f"`{f.get('skill', '—')}`" if f.get("skill") else "—"
             lines.append(
                 f"| {icon} {severity} | {file_} | {skill} | {f.get('finding', '—')} |"
             )
+    return lines
+
+
+def build_pr_body(
+    findings: list[dict],
+    rewritten: list[str],
+    file_count: int,
+    unreviewed: int = 0,
+    rolled_back: list[tuple[str, str]] | None = None,
+    packages: dict[str, str] | None = None,
+    suppressed: int = 0,
+    skipped: list[tuple[str, str]] | None = None,
+    summarized: int = 0,
+    unrouted: int = 0,
+) -> str:
+    """
+    Markdown summary for the PR. With `packages` (file -> package root, from
+    --monorepo) the findings are grouped into one table per package.
+    `suppressed` counts findings left out because the baseline accepts them;
+    `skipped` lists (path, reason) for files left out of the review, and
+    `summarized` counts --map-reduce files that were summarized but not
+    reviewed in full and `unrouted` counts --route-skills files that matched
+    no skill (neither is part of file_count).
+    """
+    warning = (
+        f"> ⚠️ {unreviewed} file(s) could not be reviewed because their request failed.\n\n"
+        if unreviewed else ""
+    )
+    if suppressed:
+        warning += f"> {suppressed} finding(s) accepted in the baseline are not shown.\n\n"
+    if summarized:
+        warning += (f"> {summarized} more file(s) were only summarized: no flow through them "
+                    "was selected for a full review.\n\n")
+    if unrouted:
+        warning += (f"> {unrouted} more file(s) matched no skill triggers and were not "
+                    "reviewed.\n\n")
+    section_lines = [
+        "", "### Edits rolled back (failed syntax check)", "",
+        *(f"- `{p}` — {error}" for p, error in rolled_back or []),
+    ] if rolled_back else []
+    section_lines += [
+        "", "### Files skipped (generated, vendored, minified or too large)", "",
+        *(f"- `{p}` — {reason}" for p, reason in skipped),
+    ] if skipped else []
+    if not findings:
+        sections = "\n".join(section_lines[1:]) + "\n\n" if section_lines else ""
+        return (
+            "## Soundcheck Security Review\n\n"
+            f"{warning}"
+            f"Scanned {file_count} file(s). No issues found. ✅\n\n"
+            f"{sections}"
+            "_Generated by [Soundcheck](https://github.com/thejefflarson/soundcheck)_"
+        )
+
+    total = len(findings)
+    scope = f" in **{len(set(packages.values()))}** package(s)" if packages else ""
+    lines = [
+        "## Soundcheck Security Review",
+        "",
+        *([warning.rstrip("\n"), ""] if warning else []),
+        f"Scanned **{file_count}** file(s){scope} · "
+        f"Found **{total}** issue(s) · "
+        f"Rewrote **{len(rewritten)}** file(s)",
+    ]
+    if packages:
+        by_package: dict[str, list[dict]] = {}
+        for f in findings:
+            by_package.setdefault(packages.get(f.get("file", ""), "."), []).append(f)
+        for package in sorted(by_package):
+            lines += [
+                "", f"### 📦 `{package}` — {len(by_package[package])} issue(s)", "",
+                *_findings_table(by_package[package]),
+            ]
+    else:
+        lines += ["", *_findings_table(findings)]
 
     if rewritten:
         lines += ["", "### Files rewritten in this PR", ""]
         for p in rewritten:
             lines.append(f"- `{p}`")
+    lines += section_lines
 
     lines += [
         "",
@@ -250,8 +3590,152 @@ def main() -> int:
         help="Path to security-review SKILL.md",
     )
     parser.add_argument(
-        "--max-files", type=int, default=DEFAULT_MAX_FILES, metavar="N",
-        help=f"Max source files to include in review (default: {DEFAULT_MAX_FILES})",
+        "--max-files", type=int, default=None, metavar="N",
+        help=f"Max source files to include in review "
+             f"(default: {DEFAULT_MAX_FILES}, or unlimited with --sharded)",
+    )
+    parser.add_argument(
+        "--include-generated", action="store_true",
+        help="Review generated, minified, vendored and snapshot files instead of "
+             "skipping them",
+    )
+    parser.add_argument(
+        "--callee-context", action="store_true",
+        help="Index definitions across the repo and send each file with the bodies of "
+             "the functions it calls from other files",
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running: review files as they are saved and print findings "
+             "(no edits; cached in --cache-dir or " + DEFAULT_WATCH_CACHE + ")",
+    )
+    parser.add_argument(
+        "--baseline", metavar="PATH",
+        help=f"JSON file of accepted findings to suppress (default: {DEFAULT_BASELINE} "
+             "in --repo-dir, if present)",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true",
+        help="Accept this run's findings: write them to the baseline file",
+    )
+    parser.add_argument(
+        "--compact", action="store_true",
+        help="Strip license headers, docstring bodies, commented-out code and blank-line "
+             "runs before sending; findings and edits are mapped back to the original lines",
+    )
+    parser.add_argument(
+        "--sharded", action="store_true",
+        help="Review the whole repo as token-budgeted shards sent concurrently",
+    )
+    parser.add_argument(
+        "--shard-tokens", type=int, default=DEFAULT_SHARD_TOKENS, metavar="N",
+        help=f"Estimated input tokens per shard (default: {DEFAULT_SHARD_TOKENS})",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS, metavar="N",
+        help=f"Concurrent review requests in --sharded mode (default: {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--route-skills", action="store_true",
+        help="Route each file to the skills its code triggers and review per skill "
+             "with only that skill's SKILL.md",
+    )
+    parser.add_argument(
+        "--skills-dir", metavar="PATH", default=str(DEFAULT_SKILLS_DIR),
+        help="Skills directory used by --route-skills",
+    )
+    parser.add_argument(
+        "--cascade", action="store_true",
+        help="Triage every file with a cheap model first and review only flagged files "
+             "with --model",
+    )
+    parser.add_argument(
+        "--triage-model", default=TRIAGE_MODEL, metavar="MODEL",
+        help=f"Cheap model for the --cascade triage and --map-reduce map passes "
+             f"(default: {TRIAGE_MODEL})",
+    )
+    parser.add_argument(
+        "--triage-confidence", type=float, default=TRIAGE_MIN_CONFIDENCE, metavar="X",
+        help="Minimum triage confidence (0-1) for a Medium+ candidate to escalate its file "
+             f"(default: {TRIAGE_MIN_CONFIDENCE})",
+    )
+    parser.add_argument(
+        "--map-reduce", action="store_true",
+        help="Summarize every file with --triage-model, then fully review only the "
+             "cross-file flows --model picks from the summaries",
+    )
+    parser.add_argument(
+        "--two-phase", action="store_true",
+        help="Ask for findings only, then fix each affected file in its own concurrent "
+             "request",
+    )
+    parser.add_argument(
+        "--monorepo", action="store_true",
+        help="Detect package roots (pyproject.toml, package.json, go.mod, Cargo.toml, ...) "
+             "and review each package as its own unit with its own file budget",
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="Send review requests through the Message Batches API and wait for results",
+    )
+    parser.add_argument(
+        "--batch-id", metavar="ID",
+        help="Resume waiting for a batch submitted earlier with --batch",
+    )
+    parser.add_argument(
+        "--batch-state", metavar="PATH", default=DEFAULT_BATCH_STATE,
+        help=f"Where --batch saves resume state (default: {DEFAULT_BATCH_STATE})",
+    )
+    parser.add_argument(
+        "--no-verify", action="store_true",
+        help="Skip syntax-checking edited files (and rolling back those that fail)",
+    )
+    parser.add_argument(
+        "--sarif", metavar="PATH",
+        help="Stream findings to a SARIF 2.1.0 file for code-scanning ingestion",
+    )
+    parser.add_argument(
+        "--jsonl", metavar="PATH",
+        help="Stream findings to a JSON Lines file, one finding per line",
+    )
+    parser.add_argument(
+        "--token-budget", type=int, metavar="N",
+        help="Budget the review by N estimated input tokens of file content "
+             "instead of the 200 KB byte limit",
+    )
+    parser.add_argument(
+        "--calibrate", action="store_true",
+        help="Calibrate the token estimator against the token-counting endpoint first",
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="Print the request plan, dropped files and projected cost; send nothing",
+    )
+    parser.add_argument(
+        "--no-rank", action="store_true",
+        help="Keep path order instead of risk-ranking files when over budget",
+    )
+    parser.add_argument(
+        "--base", metavar="REF",
+        help="Review only files changed since REF (plus the files they import)",
+    )
+    parser.add_argument(
+        "--cache-dir", metavar="PATH",
+        help="Cache per-file review results here and skip unchanged files "
+             "(keep it outside the repo)",
+    )
+    parser.add_argument(
+        "--cache-max-bytes", type=int, default=DEFAULT_CACHE_BYTES, metavar="N",
+        help=f"Evict least-recently-used cache entries beyond N bytes "
+             f"(default: {DEFAULT_CACHE_BYTES})",
+    )
+    parser.add_argument(
+        "--cache-import", metavar="PATH",
+        help="Load cache entries from a JSONL export before reviewing",
+    )
+    parser.add_argument(
+        "--cache-export", metavar="PATH",
+        help="Write the cache to a JSONL file after reviewing",
     )
     parser.add_argument(
         "--output-summary", metavar="PATH", default="/tmp/soundcheck-summary.md",
@@ -262,11 +3746,25 @@ def main() -> int:
         help=f"Claude model to use (default: {MODEL})",
     )
     args = parser.parse_args()
+    if args.cascade and (args.batch or args.batch_id):
+        print("ERROR: --cascade cannot be combined with --batch", file=sys.stderr)
+        return 1
+    if args.two_phase and (args.batch or args.batch_id):
+        print("ERROR: --two-phase cannot be combined with --batch", file=sys.stderr)
+        return 1
+    if args.watch and (args.batch or args.batch_id or args.plan):
+        print("ERROR: --watch cannot be combined with --batch or --plan", file=sys.stderr)
+        return 1
+    if args.map_reduce and (args.batch or args.batch_id or args.plan):
+        print("ERROR: --map-reduce cannot be combined with --batch or --plan",
+              file=sys.stderr)
+        return 1
 
     api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not api_key:
+    if not api_key and (args.calibrate or not args.plan):
         print("ERROR: ANTHROPIC_API_KEY not set", file=sys.stderr)
         return 1
+    client = anthropic.Anthropic(api_key=api_key) if api_key else None
 
     repo_dir = Path(args.repo_dir).resolve()
     skill_path = Path(args.skill_path)
@@ -274,43 +3772,385 @@ def main() -> int:
         print(f"ERROR: skill not found: {skill_path}", file=sys.stderr)
         return 1
 
-    system_prompt = skill_path.read_text(encoding="utf-8") + SYSTEM_SUFFIX
+    skill_text = skill_path.read_text(encoding="utf-8")
+    baseline_path = Path(args.baseline) if args.baseline else repo_dir / DEFAULT_BASELINE
+    try:
+        baseline = load_baseline(baseline_path)
+    except (OSError, ValueError) as exc:
+        print(f"ERROR: could not read baseline {baseline_path}: {exc}", file=sys.stderr)
+        return 1
+    if baseline:
+        print(f"Baseline: {len(baseline)} accepted finding(s) from {baseline_path}")
+
+    cache: ReviewCache | None = None
+    if args.cache_dir or args.cache_import or args.cache_export:
+        if not args.cache_dir:
+            print("ERROR: --cache-import/--cache-export require --cache-dir", file=sys.stderr)
+            return 1
+        cache = ReviewCache(Path(args.cache_dir).expanduser(), args.cache_max_bytes)
+        if args.cache_import:
+            try:
+                imported = cache.import_(Path(args.cache_import))
+            except (OSError, UnicodeDecodeError) as exc:
+                print(f"ERROR: could not import {args.cache_import}: {exc}", file=sys.stderr)
+                return 1
+            print(f"Imported {imported} cache entries")
+
+    if args.watch:
+        if cache is None:
+            cache = ReviewCache(Path(DEFAULT_WATCH_CACHE), args.cache_max_bytes)
+        return watch_repo(
+            client, args.model, repo_dir, skill_text, cache, args.workers, baseline,
+            classify=not args.include_generated, compact=args.compact,
+        )
+
+    if args.sharded or args.map_reduce:
+        max_files, max_total_bytes = args.max_files, None
+    else:
+        max_files = args.max_files if args.max_files is not None else DEFAULT_MAX_FILES
+        max_total_bytes = MAX_TOTAL_BYTES
+    if args.token_budget is not None:
+        max_total_bytes = None
+
+    if args.calibrate:
+        measured = calibrate_token_ratios(client, args.model, repo_dir)
+        print("Calibrated chars/token: " + ", ".join(
+            f"{suffix} {ratio:.2f}" for suffix, ratio in sorted(measured.items())
+        ))
+
+    include: list[str] | None = None
+    context_only: set[str] = set()
+    if args.base:
+        try:
+            changed = changed_files(repo_dir, args.base)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            print(f"ERROR: could not diff against {args.base}: {exc}", file=sys.stderr)
+            return 1
+        context_only = set(import_context(repo_dir, changed))
+        include = changed + sorted(context_only)
+        print(f"{len(changed)} changed source file(s) since {args.base}, "
+              f"{len(context_only)} imported for context")
+        if not changed:
+            print("No changed source files.")
+            return 0
 
-    print(f"Collecting source files from {repo_dir} (max {args.max_files})...")
-    files = collect_files(repo_dir, args.max_files)
+    limit = max_files if max_files is not None else "unlimited"
+    print(f"Collecting source files from {repo_dir} (max {limit})...")
+    # A PR's own changes are always reviewed: a marker comment must not exempt them
+    classify = not args.include_generated and not args.base
+    dropped: list[str] = []
+    skipped: list[tuple[str, str]] = []
+    blobs = BlobIndex()
+    packages: dict[str, str] = {}  # file -> package root, in --monorepo mode
+    if args.monorepo:
+        # Every package gets the full per-run budget of its own
+        files = []
+        candidates = include if include is not None else walk_source_files(repo_dir)
+        for root, paths in assign_packages(repo_dir, candidates).items():
+            print(f"  [package] {root}: {len(paths)} candidate file(s)")
+            package_files = collect_files(
+                repo_dir, max_files, max_total_bytes,
+                paths if include is not None else None, not args.no_rank,
+                max_total_tokens=args.token_budget, dropped=dropped, candidates=paths,
+                blobs=blobs, classify=classify, skipped=skipped,
+            )
+            packages.update((rel, root) for rel in paths)
+            files += package_files
+    else:
+        files = collect_files(
+            repo_dir, max_files, max_total_bytes, include, not args.no_rank,
+            max_total_tokens=args.token_budget, dropped=dropped, blobs=blobs,
+            classify=classify, skipped=skipped,
+        )
     if not files:
         print("No source files found.")
         return 0
-    total_kb = sum(len(c.encode()) for _, c in files) // 1024
-    print(f"Collected {len(files)} file(s) ({total_kb} KB). Sending to {args.model}...")
+    reviewed = {rel for rel, _ in files} - context_only
+    copies = {rel: paths for rel, paths in blobs.copies.items() if rel in reviewed}
+    reviewed |= {copy for paths in copies.values() for copy in paths}
+    copy_count = sum(len(paths) for paths in copies.values())
+    if copy_count:
+        print(f"Deduplicated {copy_count} identical file(s); "
+              f"reviewing {len(copies)} shared blob(s) once each")
+    sources = {rel: content for rel, content in files}
+    sources.update((copy, sources[rel]) for rel, paths in copies.items() for copy in paths)
+    accepted: dict[str, list[dict]] = {}
+    for entry in baseline.values():
+        accepted.setdefault(entry.get("file", ""), []).append(
+            {k: entry[k] for k in ("line", "severity", "finding") if k in entry}
+        )
+    units, chunks = chunk_files(files)
+    context_only |= {label for label, chunk in chunks.items() if chunk.path in context_only}
+    compactions: dict[str, Compaction] = {}
+    if args.compact:
+        units, compactions = compact_files(units)
+    rewritten: list[str] = []
+    edited: set[str] = set()
+    shifts: dict[tuple[str, int], int] = {}
+    originals: dict[str, bytes] = {}  # pre-edit bytes, for rollback
+    write_lock = threading.Lock()
+    deferred: dict[str, list[tuple[str, str]]] = {}  # edits to files with accepted findings
 
-    client = anthropic.Anthropic(api_key=api_key)
-    response = client.messages.create(
-        model=args.model,
-        max_tokens=8192,
-        system=system_prompt,
-        messages=[{"role": "user", "content": build_user_prompt(files)}],
-    )
-    response_text = response.content[0].text
+    def on_edit(kind: str, rel_path: str, body: str) -> None:
+        # Called from worker threads as each rewrite/patch block completes
+        path = source_path(rel_path)
+        if any(p in accepted for p in (path, *copies.get(path, []))):
+            # Held until the findings show whether the unit has any that are not accepted
+            with write_lock:
+                deferred.setdefault(rel_path, []).append((kind, body))
+            return
+        apply_edit(kind, rel_path, body)
+
+    def apply_edit(kind: str, rel_path: str, body: str) -> None:
+        with write_lock:
+            if rel_path in context_only:
+                print(f"  [skip] {rel_path} — context only; edit ignored", file=sys.stderr)
+                return
+            if rel_path in compactions:
+                body = uncompact_edit(compactions[rel_path], kind, body)
+            if kind == "rewrite" and rel_path in edited:
+                # Another review already changed this file; a full rewrite
+                # based on the original would silently discard that fix.
+                print(f"  [skip] {rel_path} — already edited this run; "
+                      "full rewrite ignored", file=sys.stderr)
+                return
+            path = source_path(rel_path)
+            for p in (path, *copies.get(path, [])):
+                if p in reviewed and p not in originals:
+                    try:
+                        originals[p] = (repo_dir / p).read_bytes()
+                    except OSError:
+                        pass
+            try:
+                before = (repo_dir / path).read_bytes()
+            except OSError:
+                before = None
+            if rel_path in chunks:
+                written = apply_chunk_edit(
+                    repo_dir, chunks[rel_path], kind, body, reviewed, shifts
+                )
+            elif kind == "patch":
+                written = apply_patches(repo_dir, {rel_path: body}, reviewed)
+            else:
+                written = apply_rewrites(repo_dir, {rel_path: body}, reviewed)
+            if written and before is not None and path in copies:
+                written += mirror_copies(repo_dir, path, copies[path], before, reviewed)
+            if written:
+                edited.add(rel_path)
+                rewritten.extend(p for p in written if p not in rewritten)
+
+    # One review unit per package (or the whole repo), so shards never mix packages
+    unit_sets = [units]
+    summarized_only: set[str] = set()  # --map-reduce files in no selected flow
+    if args.map_reduce:
+        # ...or per set of cross-file flows, so a flow's files are reviewed together
+        try:
+            unit_sets = map_reduce(
+                client, args.triage_model, args.model, units, args.shard_tokens,
+                args.workers, cache,
+            )
+        except anthropic.APIError as exc:
+            print(f"ERROR: map-reduce failed: {exc}", file=sys.stderr)
+            return 1
+        summarized_only = {source_path(label) for label, _ in units} - {
+            source_path(label) for unit_set in unit_sets for label, _ in unit_set
+        }
+        summarized_only |= {copy for rel in summarized_only for copy in copies.get(rel, [])}
+    elif packages:
+        by_package: dict[str, list[tuple[str, str]]] = {}
+        for label, content in units:
+            by_package.setdefault(packages[source_path(label)], []).append((label, content))
+        unit_sets = list(by_package.values())
+        print(f"Monorepo: {len(by_package)} package(s) with files to review")
+    groups: list[tuple[str | None, str, list[tuple[str, str]]]] = []
+    unrouted: list[str] = []
+    for unit_set in unit_sets:
+        if args.route_skills:
+            set_groups, set_unrouted = skill_groups(unit_set, Path(args.skills_dir))
+            groups += set_groups
+            unrouted += set_unrouted
+        else:
+            groups.append((None, skill_text, unit_set))
+    # Files with a unit in no group (unrouted, or in no selected flow) are not fully reviewed
+    grouped = {label for _, _, unit_set in groups for label, _ in unit_set}
+    partial = {source_path(label) for label, _ in units if label not in grouped}
+    partial |= {copy for rel in partial for copy in copies.get(rel, [])}
+    # ...and files with no unit in any group were not reviewed at all
+    unrouted_only = {source_path(label) for label, _ in units} - context_only - {
+        source_path(label) for label in grouped
+    } - summarized_only
+    unrouted_only |= {copy for rel in unrouted_only for copy in copies.get(rel, [])}
+    cache_context: dict[tuple[int, str], str] = {}
+    if args.callee_context:
+        index = build_symbol_index(repo_dir, walk_source_files(repo_dir))
+        with_callees = []
+        attached = 0
+        for gi, (skill, text, unit_set) in enumerate(groups):
+            unit_set, excerpts, refs = callee_context(repo_dir, unit_set, index)
+            sent = dict(unit_set)
+            for label, used in refs.items():
+                # A cached result is stale once a definition it relied on changes
+                cache_context[gi, label] = "".join(f"{ref}\n{sent[ref]}" for ref in used)
+            with_callees.append((skill, text, unit_set))
+            chunks.update(excerpts)
+            context_only |= set(excerpts)
+            attached += len(excerpts)
+        groups = with_callees
+        print(f"Symbol index: {sum(len(d) for d in index.defs.values())} definition(s) in "
+              f"{len(index.lines)} file(s); attached {attached} referenced definition(s)")
+    accepted_keys: dict[str, list[str]] = {}
+    for fp, entry in sorted(baseline.items()):
+        accepted_keys.setdefault(entry.get("file", ""), []).append(
+            f"accepted {fp} {entry.get('severity')}"
+        )
+    for gi, (_, _, unit_set) in enumerate(groups):
+        for label, _ in unit_set:
+            # A result from before a finding was accepted would re-apply its fix
+            if source_path(label) in accepted_keys:
+                cache_context[gi, label] = "\n".join(
+                    [cache_context.get((gi, label), ""), *accepted_keys[source_path(label)]]
+                )
+    if args.route_skills:
+        skills = {skill for skill, _, _ in groups}
+        print(f"Routed {len(units) - len(unrouted)} file(s) to {len(skills)} skill(s); "
+              f"{len(unrouted)} file(s) matched no skill triggers")
+
+    shard_tokens = args.shard_tokens if args.sharded else None
+    if args.plan:
+        jobs, hits, _ = plan_jobs(
+            groups, args.model, shard_tokens, context_only, cache, cache_context
+        )
+        print(format_plan(groups, jobs, dropped, args.model, len(hits), skipped))
+        return 0
+
+    writers: list[FindingsWriter] = []
+    if args.jsonl:
+        writers.append(JsonlWriter(Path(args.jsonl)))
+    if args.sarif:
+        writers.append(SarifWriter(Path(args.sarif), Path(args.skills_dir)))
+
+    def reportable(found: list[dict]) -> list[dict]:
+        # Context-only files and excerpts are not under review: drop their findings
+        return [f for f in found if f.get("file") not in context_only
+                and source_path(f.get("file", "")) not in context_only]
+
+    def on_findings(new: list[dict]) -> None:
+        new = unchunk_findings(uncompact_findings(reportable(new), compactions), chunks)
+        for finding in fan_out_findings(new, copies):
+            finding["fingerprint"] = fingerprint(finding, sources.get(finding.get("file")))
+            if is_baselined(finding, baseline):
+                continue
+            for writer in writers:
+                writer.write(finding)
+
+    total_kb = sum(len(c.encode()) for _, c in files) // 1024
+    print(f"Collected {len(files)} file(s) ({total_kb} KB). Reviewing with {args.model}...")
+    try:
+        if args.batch or args.batch_id:
+            result = review_files_batch(
+                client, args.model, groups, shard_tokens=shard_tokens,
+                context_only=context_only, cache=cache, on_edit=on_edit,
+                state_path=Path(args.batch_state), batch_id=args.batch_id,
+                on_findings=on_findings if writers else None, cache_context=cache_context,
+                accepted=accepted,
+            )
+        else:
+            result = review_files(
+                client, args.model, groups, args.workers,
+                shard_tokens=shard_tokens,
+                context_only=context_only, cache=cache, on_edit=on_edit,
+                on_findings=on_findings if writers else None,
+                triage_model=args.triage_model if args.cascade else None,
+                triage_min_confidence=args.triage_confidence,
+                two_phase=args.two_phase, accepted=accepted, cache_context=cache_context,
+            )
+    except (OSError, ValueError, anthropic.APIError) as exc:
+        print(f"ERROR: review failed: {exc}", file=sys.stderr)
+        return 1
+    finally:
+        for writer in writers:
+            writer.close()
+            print(f"Wrote {writer.count} finding(s) to {writer.path}")
+    if cache is not None:
+        print(f"Cache: {cache.hits} hit(s), {cache.misses} miss(es)")
+    if result.usage.requests:
+        print(f"Tokens: {result.usage.describe()}")
+    if result.requested and len(result.unreviewed) == result.requested \
+            and not result.findings and not result.edits:
+        print("ERROR: every review request failed", file=sys.stderr)
+        return 1
+    findings = reportable(result.findings)
+    if len(findings) < len(result.findings):
+        print(f"Ignored {len(result.findings) - len(findings)} finding(s) in context-only "
+              "files")
+    findings = unchunk_findings(uncompact_findings(findings, compactions), chunks)
+    findings = fan_out_findings(findings, copies)
+    for f in findings:
+        f["fingerprint"] = fingerprint(f, sources.get(f.get("file")))
+    dropped_edits: set[str] = set()
+    for rel_path, held in deferred.items():
+        chunk = chunks.get(rel_path)
+        own = [f for f in findings if f.get("file") == source_path(rel_path) and (
+            chunk is None or f.get("lines") == f"L{chunk.start + 1}-L{chunk.end}"
+        )]
+        if not own or all(is_baselined(f, baseline) for f in own):
+            # Whether the model also "fixes" accepted findings varies from run to run
+            print(f"  [skip] {rel_path} — every finding is accepted in the baseline; "
+                  "edit not applied", file=sys.stderr)
+            dropped_edits.add(rel_path)
+            continue
+        for kind, body in held:
+            apply_edit(kind, rel_path, body)
+    unreviewed = list(dict.fromkeys(source_path(rel) for rel in result.unreviewed))
+    unreviewed += [copy for rel in unreviewed for copy in copies.get(rel, [])]
+    baseline_refused = False
+    if args.update_baseline and unreviewed:
+        # Their accepted entries would be dropped for want of this run's findings
+        print(f"ERROR: not updating the baseline: {len(unreviewed)} file(s) could not be "
+              "reviewed", file=sys.stderr)
+        baseline_refused = True
+    elif args.update_baseline:
+        count = write_baseline(baseline_path, baseline, findings, reviewed - partial)
+        print(f"Baseline: wrote {count} accepted finding(s) to {baseline_path}")
+        baseline = load_baseline(baseline_path)
+    suppressed = sum(1 for f in findings if is_baselined(f, baseline))
+    if suppressed:
+        findings = [f for f in findings if not is_baselined(f, baseline)]
+        print(f"Baseline: suppressed {suppressed} accepted finding(s)")
+    rolled_back: list[tuple[str, str]] = []
+    if not args.no_verify:
+        edited_originals = {rel: originals[rel] for rel in rewritten if rel in originals}
+        rolled_back = verify_edits(repo_dir, edited_originals)
+        failed = {rel for rel, _ in rolled_back}
+        rewritten = [rel for rel in rewritten if rel not in failed]
+    edits = {rel: edit for rel, edit in result.edits.items() if rel not in dropped_edits}
 
-    findings = parse_findings(response_text)
-    rewrites = parse_rewrites(response_text)
+    if cache is not None:
+        evicted = cache.evict()
+        if evicted:
+            print(f"Cache: evicted {evicted} least-recently-used entries")
+        if args.cache_export:
+            print(f"Exported {cache.export(Path(args.cache_export))} cache entries "
+                  f"to {args.cache_export}")
 
     critical_high = [f for f in findings if f.get("severity") in ("Critical", "High")]
     medium = [f for f in findings if f.get("severity") == "Medium"]
     print(f"\nFindings: {len(findings)} "
           f"({len(critical_high)} Critical/High, {len(medium)} Medium) · "
-          f"Rewrites: {len(rewrites)}")
+          f"Edits: {len(edits)}"
+          + (f" ({len(rolled_back)} rolled back)" if rolled_back else ""))
 
-    reviewed = {rel for rel, _ in files}
-    rewritten = apply_rewrites(repo_dir, rewrites, reviewed)
-
-    summary = build_pr_body(findings, rewritten, len(files))
+    summary = build_pr_body(
+        findings, rewritten,
+        len(files) + copy_count - len(summarized_only) - len(unrouted_only), len(unreviewed),
+        rolled_back, {rel: root for rel, root in packages.items() if rel in reviewed} or None,
+        suppressed, skipped, len(summarized_only), len(unrouted_only),
+    )
     Path(args.output_summary).write_text(summary, encoding="utf-8")
     print(f"\nPR summary written to {args.output_summary}")
     print("\n" + summary)
 
-    return 1 if critical_high else 0
+    return 1 if critical_high or baseline_refused else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,679 @@
+"""
+Unit tests for the parsing, patching, line-mapping and review helpers in
+security-review-action.py. No API calls are made: the review helpers are
+driven by a fake client.
+
+Usage:
+    python -m pytest scripts/test_security_review_action.py
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+_SCRIPT = Path(__file__).parent / "security-review-action.py"
+_spec = importlib.util.spec_from_file_location("security_review_action", _SCRIPT)
+sra = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = sra  # dataclasses look the module up by name
+_spec.loader.exec_module(sra)
+
+
+def hunk(search: str, replace: str) -> str:
+    return f"<<<<<<< SEARCH\n{search}=======\n{replace}>>>>>>> REPLACE"
+
+
+# --- apply_patch / _find_hunk ---------------------------------------------
+
+def test_apply_patch_replaces_unique_hunk():
+    original = "a = 1\nb = 2\nc = 3\n"
+    assert sra.apply_patch(original, hunk("b = 2\n", "b = 20\n")) == "a = 1\nb = 20\nc = 3\n"
+
+
+def test_apply_patch_ignores_trailing_whitespace():
+    original = "x = 1   \ny = 2\n"
+    assert sra.apply_patch(original, hunk("x = 1\n", "x = 0\n")) == "x = 0\ny = 2\n"
+
+
+def test_apply_patch_rejects_ambiguous_hunk():
+    with pytest.raises(sra.PatchError, match="matches 2 places"):
+        sra.apply_patch("pass\npass\n", hunk("pass\n", "return\n"))
+
+
+def test_apply_patch_rejects_missing_hunk():
+    with pytest.raises(sra.PatchError, match="not found"):
+        sra.apply_patch("a = 1\n", hunk("b = 2\n", "b = 3\n"))
+
+
+def test_apply_patch_rejects_empty_search_and_no_hunks():
+    with pytest.raises(sra.PatchError, match="empty SEARCH"):
+        sra.apply_patch("a = 1\n", hunk("\n", "b = 2\n"))
+    with pytest.raises(sra.PatchError, match="no SEARCH/REPLACE"):
+        sra.apply_patch("a = 1\n", "just prose")
+
+
+def test_apply_patch_hunks_apply_in_order():
+    patch = hunk("a\n", "b\n") + "\n" + hunk("b\nb\n", "c\n")
+    assert sra.apply_patch("a\nb\n", patch) == "c\n"
+
+
+def test_apply_patch_keeps_crlf_and_missing_final_newline():
+    assert sra.apply_patch("a\r\nb\r\n", hunk("b\n", "c\n")) == "a\r\nc\r\n"
+    assert sra.apply_patch("a\nb", hunk("b\n", "c\n")) == "a\nc"
+
+
+def test_find_hunk_prefers_exact_match_over_whitespace_match():
+    lines = ["x = 1  \n", "x = 1\n"]
+    assert sra._find_hunk(lines, ["x = 1"]) == 1
+
+
+def test_apply_patches_keeps_crlf_line_endings_on_disk(tmp_path):
+    (tmp_path / "win.py").write_bytes(b"a = 1\r\nb = 2\r\n")
+    written = sra.apply_patches(tmp_path, {"win.py": hunk("b = 2\n", "b = 3\n")}, {"win.py"})
+    assert written == ["win.py"]
+    assert (tmp_path / "win.py").read_bytes() == b"a = 1\r\nb = 3\r\n"
+
+
+# --- StreamParser -----------------------------------------------------------
+
+RESPONSE = (
+    "Some prose <b>with</b> tags.\n"
+    '<soundcheck-patch file="app/cmd.py">\n' + hunk("run(cmd, shell=True)\n", "run(cmd)\n")
+    + "\n</soundcheck-patch>\n"
+    '<soundcheck-rewrite file="app/x.py">\nprint("<soundcheck-")\n</soundcheck-rewrite>\n'
+    '<soundcheck-findings>[{"severity": "High", "file": "app/cmd.py"}]</soundcheck-findings>'
+)
+
+
+def parse_in_pieces(size: int) -> tuple[list, "sra.StreamParser"]:
+    parser = sra.StreamParser()
+    events = []
+    for i in range(0, len(RESPONSE), size):
+        events += parser.feed(RESPONSE[i:i + size])
+    return events, parser
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 13, len(RESPONSE)])
+def test_stream_parser_handles_tags_split_across_deltas(size):
+    events, parser = parse_in_pieces(size)
+    assert [(kind, rel) for kind, rel, _ in events] == [
+        ("patch", "app/cmd.py"), ("rewrite", "app/x.py"), ("findings", None),
+    ]
+    assert events[0][2] == hunk("run(cmd, shell=True)\n", "run(cmd)\n")
+    assert events[1][2] == 'print("<soundcheck-")'
+    assert events[2][2] == [{"severity": "High", "file": "app/cmd.py"}]
+    assert parser.finished
+
+
+def test_stream_parser_waits_for_unclosed_block():
+    parser = sra.StreamParser()
+    assert parser.feed('<soundcheck-rewrite file="a.py">\nx = 1\n') == []
+    assert not parser.finished
+    assert parser.feed("</soundcheck-rewrite>") == [("rewrite", "a.py", "x = 1")]
+
+
+def test_stream_parser_skips_malformed_findings():
+    parser = sra.StreamParser()
+    assert parser.feed("<soundcheck-findings>[not json</soundcheck-findings>") == []
+    assert not parser.saw_findings
+
+
+# --- compaction round trip --------------------------------------------------
+
+COMPACTABLE = '''\
+# Copyright 2024 Example Corp.
+# Licensed under the Apache License, Version 2.0.
+
+import subprocess
+
+
+def run(cmd):
+    """
+    Run a command.
+
+    Long explanation that compaction drops.
+    """
+    # subprocess.call(cmd)
+    return subprocess.run(cmd, shell=True)
+'''
+
+
+def compaction() -> "sra.Compaction":
+    text, kept = sra.compact_source("app/run.py", COMPACTABLE)
+    return sra.Compaction(COMPACTABLE, kept)
+
+
+def test_compact_source_drops_boilerplate_and_maps_lines():
+    text, kept = sra.compact_source("app/run.py", COMPACTABLE)
+    assert "Copyright" not in text and "Long explanation" not in text
+    assert "# subprocess.call" not in text
+    original = COMPACTABLE.splitlines(keepends=True)
+    assert [original[i] for i in kept] == text.splitlines(keepends=True)
+
+
+def test_uncompact_edit_patch_round_trip():
+    c = compaction()
+    compacted = "".join(COMPACTABLE.splitlines(keepends=True)[i] for i in c.kept)
+    # Spans the docstring and commented-out code that compaction removed
+    patch = hunk(
+        '    Run a command.\n    """\n    return subprocess.run(cmd, shell=True)\n',
+        '    Run a command.\n    """\n    return subprocess.run(cmd)\n',
+    )
+    # The patch is valid against the compacted text...
+    sra.apply_patch(compacted, patch)
+    # ...and once translated, against the original, keeping the removed lines
+    result = sra.apply_patch(COMPACTABLE, sra.uncompact_edit(c, "patch", patch))
+    assert result == COMPACTABLE.replace("run(cmd, shell=True)", "run(cmd)")
+
+
+def test_uncompact_edit_rewrite_keeps_untouched_original_lines():
+    c = compaction()
+    compacted = "".join(COMPACTABLE.splitlines(keepends=True)[i] for i in c.kept)
+    rewrite = compacted.replace("shell=True", "shell=False")
+    assert sra.uncompact_edit(c, "rewrite", rewrite) == COMPACTABLE.replace(
+        "shell=True", "shell=False"
+    )
+
+
+def test_uncompact_findings_translates_lines():
+    c = compaction()
+    text = "".join(COMPACTABLE.splitlines(keepends=True)[i] for i in c.kept)
+    line = text.splitlines().index("    return subprocess.run(cmd, shell=True)") + 1
+    [finding] = sra.uncompact_findings([{"file": "app/run.py", "line": line}],
+                                       {"app/run.py": c})
+    assert COMPACTABLE.splitlines()[finding["line"] - 1].endswith("shell=True)")
+
+
+
+
+def test_compact_source_leaves_multi_line_strings_alone():
+    source = (
+        "# Copyright 2024 Example Corp.\n"
+        "SCRIPT = '''\n"
+        "# set -e\n"
+        "\n"
+        "\n"
+        "# rm -rf /tmp/x\n"
+        "'''\n"
+        "\n"
+        "\n"
+        "# run(SCRIPT)\n"
+        "run(SCRIPT)\n"
+    )
+    text, kept = sra.compact_source("app/deploy.py", source)
+    assert text == source.replace("# Copyright 2024 Example Corp.\n", "").replace(
+        "'''\n\n\n# run(SCRIPT)\n", "'''\n\n"
+    )
+
+
+# --- apply_chunk_edit -------------------------------------------------------
+
+def test_apply_chunk_edit_tracks_line_shifts(tmp_path):
+    (tmp_path / "big.py").write_text("".join(f"line{i}\n" for i in range(10)))
+    first, second = sra.Chunk("big.py", 0, 5), sra.Chunk("big.py", 5, 10)
+    reviewed, shifts = {"big.py"}, {}
+
+    # Grow the first chunk by two lines...
+    sra.apply_chunk_edit(tmp_path, first, "patch",
+                         hunk("line2\n", "line2\nextra1\nextra2\n"), reviewed, shifts)
+    assert shifts == {("big.py", 0): 2}
+    # ...then edit the second chunk, which must now start two lines later
+    sra.apply_chunk_edit(tmp_path, second, "patch", hunk("line5\n", "LINE5\n"),
+                         reviewed, shifts)
+    # ...and the first chunk again, whose range now ends two lines later
+    sra.apply_chunk_edit(tmp_path, first, "patch", hunk("extra2\nline3\n", "line3\n"),
+                         reviewed, shifts)
+    lines = (tmp_path / "big.py").read_text().splitlines()
+    assert lines == ["line0", "line1", "line2", "extra1", "line3", "line4",
+                     "LINE5", "line6", "line7", "line8", "line9"]
+    assert shifts == {("big.py", 0): 1, ("big.py", 5): 0}
+
+
+def test_apply_chunk_edit_rewrite_drops_echoed_header(tmp_path):
+    (tmp_path / "big.py").write_text("import os\na = 1\nb = 2\n")
+    chunk = sra.Chunk("big.py", 1, 3, header_lines=1)
+    body = "import os\n⋮ lines 2–3 of big.py follow; lines above are shared context\nb = 3\n"
+    sra.apply_chunk_edit(tmp_path, chunk, "rewrite", body, {"big.py"}, {})
+    assert (tmp_path / "big.py").read_text() == "import os\nb = 3\n"
+
+
+def test_apply_chunk_edit_rejects_patch_outside_chunk(tmp_path, capsys):
+    (tmp_path / "big.py").write_text("a = 1\nb = 2\n")
+    chunk = sra.Chunk("big.py", 1, 2)
+    assert sra.apply_chunk_edit(tmp_path, chunk, "patch", hunk("a = 1\n", "a = 0\n"),
+                                {"big.py"}, {}) == []
+    assert "patch rejected" in capsys.readouterr().err
+    assert (tmp_path / "big.py").read_text() == "a = 1\nb = 2\n"
+
+
+
+
+def test_apply_chunk_edit_keeps_crlf_line_endings(tmp_path):
+    (tmp_path / "big.py").write_bytes(b"a = 1\r\nb = 2\r\n")
+    chunk = sra.Chunk("big.py", 1, 2)
+    sra.apply_chunk_edit(tmp_path, chunk, "patch", hunk("b = 2\n", "b = 3\n"), {"big.py"}, {})
+    assert (tmp_path / "big.py").read_bytes() == b"a = 1\r\nb = 3\r\n"
+
+
+# --- walk_source_files ------------------------------------------------------
+
+def test_walk_source_files_anchors_gitignore_patterns(tmp_path):
+    (tmp_path / ".gitignore").write_text("/out\n/gen.py\nbuild-*/\nlib/vendor\n")
+    for rel in ("out/a.py", "src/out/b.py", "gen.py", "src/gen.py", "build-x/c.py",
+                "src/build-y/d.py", "lib/vendor/e.py", "src/lib/vendor/f.py"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x = 1\n")
+    assert sra.walk_source_files(tmp_path) == [
+        "src/gen.py", "src/lib/vendor/f.py", "src/out/b.py",
+    ]
+
+
+@pytest.mark.parametrize("pattern, path, ignored", [
+    ("[!a]x.py", "bx.py", True),
+    ("[!a]x.py", "ax.py", False),
+    ("[a!]x.py", "!x.py", True),
+    ("[a!]x.py", "bx.py", False),
+])
+def test_gitignore_rule_only_negates_on_leading_bang(pattern, path, ignored):
+    rule = sra._gitignore_rule("", pattern)
+    assert sra._is_ignored([rule], path, is_dir=False) == ignored
+
+
+# --- classify_file ----------------------------------------------------------
+
+@pytest.mark.parametrize("rel_path, content, expected", [
+    ("gen/x.go", "// Code generated by protoc-gen-go. DO NOT EDIT.\npackage x\n",
+     ("skip", "generated")),
+    ("web/a.js", "// @generated\nrun()\n", ("skip", "generated")),
+    ("app/auth.py", '"""Auto-generated tokens are validated here."""\n',
+     ("demote", "possibly generated")),
+    ("app/token.py", "# the token is generated by the server\n", None),
+    ("src/sign-1.2.js", "function sign() {}\n", None),
+    ("app/migrations/0001_initial.py", "# Generated by Django 4.2\n", ("demote", "migration")),
+])
+def test_classify_file_skips_only_strong_markers(rel_path, content, expected):
+    assert sra.classify_file(rel_path, content) == expected
+
+
+# --- fingerprint ------------------------------------------------------------
+
+DB_PY = '''\
+import sqlite3
+
+
+class Repo:
+    def find(self, name):
+        sql = "SELECT * FROM t WHERE n = '%s'" % name
+        return sqlite3.connect("x").execute(sql)
+
+    def delete(self, name):
+        return sqlite3.connect("x").execute("DELETE FROM t WHERE n = " + name)
+'''
+
+
+def test_fingerprint_is_anchored_on_the_enclosing_definition():
+    def fp(line, text="SQL injection"):
+        finding = {"file": "app/db.py", "skill": "injection", "line": line, "finding": text}
+        return sra.fingerprint(finding, DB_PY)
+
+    assert sra.enclosing_definition("app/db.py", DB_PY, 7) == "Repo.find"
+    # A line off by one, a trailing blank line or new wording is the same finding...
+    assert fp(6) == fp(7) == fp(8) == fp(7, "Unsanitized name concatenated into a query")
+    # ...another method or module level is not
+    assert fp(7) != fp(10) != fp(1)
+    # Without a line the file and skill alone identify it, never the wording
+    assert fp(None, "one wording") == fp(None, "another")
+
+
+def test_fingerprint_changes_with_the_code_of_its_definition():
+    finding = {"file": "app/db.py", "skill": "injection", "line": 7}
+    moved = "# Data access\n\n" + DB_PY.replace("    def find", "    # Lookups\n    def find")
+    assert sra.fingerprint({**finding, "line": 10}, moved) == sra.fingerprint(finding, DB_PY)
+    # A new injection in an accepted definition is a new finding
+    changed = DB_PY.replace("return sqlite3", "log(name)\n        return sqlite3", 1)
+    assert sra.fingerprint(finding, changed) != sra.fingerprint(finding, DB_PY)
+
+
+def test_fingerprint_outside_definitions_hashes_the_surrounding_lines():
+    source = "".join(f"puts {i}\n" for i in range(20))  # Ruby: no definitions are found
+    def fp(line, text=source):
+        return sra.fingerprint({"file": "app/x.rb", "skill": "injection", "line": line}, text)
+
+    assert len({fp(line) for line in range(1, 21)}) == 20
+    # Blank lines and edits more than FINGERPRINT_WINDOW lines away do not matter
+    edited = "require 'x'\n\n" + source.replace("puts 19", "puts 99")
+    assert fp(10) == fp(12, edited)
+    assert fp(19) != fp(21, edited)
+
+
+# --- baseline ---------------------------------------------------------------
+
+def test_is_baselined_only_at_the_same_or_a_lower_severity():
+    baseline = {"fp": {"fingerprint": "fp", "severity": "High"}}
+    assert sra.is_baselined({"fingerprint": "fp", "severity": "Medium"}, baseline)
+    assert sra.is_baselined({"fingerprint": "fp", "severity": "High"}, baseline)
+    assert not sra.is_baselined({"fingerprint": "fp", "severity": "Critical"}, baseline)
+    assert not sra.is_baselined({"fingerprint": "other", "severity": "Low"}, baseline)
+
+
+def test_write_baseline_replaces_reviewed_files_and_keeps_the_highest_severity(tmp_path):
+    baseline = {
+        "a1": {"fingerprint": "a1", "file": "a.py", "severity": "Low"},
+        "b1": {"fingerprint": "b1", "file": "b.py", "severity": "High"},
+    }
+    findings = [
+        {"fingerprint": "a2", "file": "a.py", "severity": "Medium", "line": 3, "extra": 1},
+        {"fingerprint": "a2", "file": "a.py", "severity": "Critical", "line": 4},
+        {"fingerprint": "a2", "file": "a.py", "severity": "Low", "line": 5},
+    ]
+    path = tmp_path / "baseline.json"
+    assert sra.write_baseline(path, baseline, findings, {"a.py"}) == 2
+    assert sra.load_baseline(path) == {
+        "a2": {"fingerprint": "a2", "file": "a.py", "severity": "Critical", "line": 4},
+        "b1": {"fingerprint": "b1", "file": "b.py", "severity": "High"},
+    }
+
+
+# --- ReviewCache ------------------------------------------------------------
+
+def test_review_cache_round_trip_attributes_findings_to_the_requested_path(tmp_path):
+    cache = sra.ReviewCache(tmp_path / "cache")
+    key = sra.ReviewCache.cache_key("x = 1\n", "skill", "model")
+    assert cache.get(key, "a.py") is None
+    cache.put(key, [{"file": "a.py", "severity": "High"}], ("patch", "body"))
+    assert cache.get(key, "copy/a.py") == (
+        [{"file": "copy/a.py", "severity": "High"}], ("patch", "body")
+    )
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_review_cache_key_depends_on_context():
+    key = sra.ReviewCache.cache_key
+    assert key("x", "s", "m") == key("x", "s", "m", "")
+    assert key("x", "s", "m") != key("x", "s", "m", "callee")
+
+
+def test_review_cache_evicts_least_recently_used(tmp_path):
+    cache = sra.ReviewCache(tmp_path / "cache")
+    keys = [f"{i:064x}" for i in range(3)]
+    for age, key in enumerate(keys):
+        cache.put(key, [], None)
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+    cache.max_bytes = 2 * cache._path(keys[0]).stat().st_size
+    assert cache.evict() == 1
+    assert cache.get(keys[0], "a.py") is None
+    assert cache.get(keys[2], "a.py") is not None
+
+
+def test_review_cache_export_import_keeps_last_used_and_skips_bad_records(tmp_path):
+    cache = sra.ReviewCache(tmp_path / "a")
+    key = f"{1:064x}"
+    cache.put(key, [{"severity": "Low"}], ("rewrite", "x = 2\n"))
+    os.utime(cache._path(key), (1234, 1234))
+    export = tmp_path / "cache.jsonl"
+    assert cache.export(export) == 1
+    with export.open("a") as out:
+        out.write("not json\n")
+        out.write(json.dumps({"key": "../escape", "findings": []}) + "\n")
+        out.write(json.dumps({"key": f"{2:064x}", "last_used": "yesterday"}) + "\n")
+        out.write(json.dumps({"key": f"{3:064x}", "last_used": float("inf")}) + "\n")
+        out.write(json.dumps({"key": f"{4:064x}", "findings": "none"}) + "\n")
+        out.write(json.dumps(["a list"]) + "\n")
+
+    other = sra.ReviewCache(tmp_path / "b")
+    assert other.import_(export) == 1
+    assert other._path(key).stat().st_mtime == 1234
+    assert other.get(key, "a.py") == ([{"severity": "Low", "file": "a.py"}], ("rewrite", "x = 2\n"))
+
+
+# --- build_pr_body ----------------------------------------------------------
+
+def test_build_pr_body_reports_files_left_out_of_the_scanned_count():
+    body = sra.build_pr_body([], [], 3, summarized=2, unrouted=4)
+    assert "Scanned 3 file(s)" in body
+    assert "2 more file(s) were only summarized" in body
+    assert "4 more file(s) matched no skill triggers" in body
+
+
+# --- SarifWriter ------------------------------------------------------------
+
+def test_sarif_writer_streams_a_valid_log_with_severity_on_rules(tmp_path):
+    (tmp_path / "skills" / "injection").mkdir(parents=True)
+    (tmp_path / "skills" / "injection" / "SKILL.md").write_text("# Injection\n")
+    writer = sra.SarifWriter(tmp_path / "out.sarif", tmp_path / "skills")
+    writer.write({"file": "a.py", "line": 3, "severity": "High", "skill": "injection",
+                  "finding": "shell injection", "fingerprint": "abc"})
+    writer.write({"file": "b.py", "lines": "L2-L5", "severity": "Medium", "finding": "x"})
+    writer.close()
+
+    [run] = json.loads((tmp_path / "out.sarif").read_text())["runs"]
+    rules = {rule["id"]: rule for rule in run["tool"]["driver"]["rules"]}
+    assert len(rules) == len(run["tool"]["driver"]["rules"])
+    first, second = run["results"]
+    assert first["ruleId"] == "soundcheck/injection/high"
+    assert rules[first["ruleId"]]["properties"]["security-severity"] == "7.5"
+    assert first["partialFingerprints"] == {"soundcheck/v1": "abc"}
+    assert first["locations"][0]["physicalLocation"]["region"] == {"startLine": 3}
+    assert second["ruleId"] == "soundcheck/security-review/medium"
+    assert second["locations"][0]["physicalLocation"]["region"] == {"startLine": 2, "endLine": 5}
+    assert all(result["ruleId"] in rules for result in run["results"])
+
+
+# --- byte-identical copies --------------------------------------------------
+
+def test_fan_out_findings_repeats_findings_for_each_copy():
+    findings = [{"file": "a/x.py", "line": 3}, {"file": "b.py", "line": 1}]
+    assert sra.fan_out_findings(findings, {"a/x.py": ["c/x.py", "d/x.py"]}) == [
+        {"file": "a/x.py", "line": 3}, {"file": "b.py", "line": 1},
+        {"file": "c/x.py", "line": 3}, {"file": "d/x.py", "line": 3},
+    ]
+
+
+def test_mirror_copies_skips_copies_that_diverged(tmp_path, capsys):
+    before = b"x = 1\n"
+    for rel in ("a.py", "same.py", "changed.py"):
+        (tmp_path / rel).write_bytes(before)
+    (tmp_path / "a.py").write_bytes(b"x = 2\n")
+    (tmp_path / "changed.py").write_bytes(b"x = 3\n")
+    reviewed = {"a.py", "same.py", "changed.py"}
+    assert sra.mirror_copies(tmp_path, "a.py", ["same.py", "changed.py"], before,
+                             reviewed) == ["same.py"]
+    assert (tmp_path / "same.py").read_bytes() == b"x = 2\n"
+    assert (tmp_path / "changed.py").read_bytes() == b"x = 3\n"
+    assert "no longer identical" in capsys.readouterr().err
+
+
+# --- stream_review ----------------------------------------------------------
+
+class FakeStream:
+    def __init__(self, text: str, stop_reason: str):
+        self.text_stream = [text]
+        self._message = SimpleNamespace(
+            stop_reason=stop_reason, usage=SimpleNamespace(input_tokens=10, output_tokens=5),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_final_message(self):
+        return self._message
+
+
+class FakeClient:
+    """Answers each request with respond(request) -> (text, stop_reason) and records it."""
+
+    def __init__(self, respond):
+        self.requests: list[dict] = []
+        self._respond = respond
+        self._lock = threading.Lock()
+        self.messages = SimpleNamespace(stream=self._stream)
+
+    def _stream(self, **kwargs):
+        with self._lock:
+            self.requests.append(kwargs)
+        return FakeStream(*self._respond(kwargs))
+
+
+def replay(*responses: tuple[str, str]):
+    """A respond() for FakeClient returning responses in order."""
+    responses = iter(responses)
+    return lambda request: next(responses)
+
+
+def test_stream_review_continues_from_prefill_after_max_tokens():
+    client = FakeClient(replay(("<soundcheck-findings>[", "max_tokens"), ("]  ", "max_tokens"),
+                               ("</soundcheck-findings>", "end_turn")))
+    parser = sra.StreamParser()
+    seen: list[str] = []
+    usage = sra.TokenUsage()
+    kwargs = {"messages": [{"role": "user", "content": "review"}]}
+
+    def on_text(text):
+        seen.append(text)
+        parser.feed(text)
+
+    message = sra.stream_review(client, kwargs, on_text, usage, lambda: parser.finished)
+    assert message.stop_reason == "end_turn"
+    assert "".join(seen) == "<soundcheck-findings>[]</soundcheck-findings>"
+    # Each continuation resends the output so far, without trailing whitespace
+    assert [r["messages"][1:] for r in client.requests] == [
+        [],
+        [{"role": "assistant", "content": "<soundcheck-findings>["}],
+        [{"role": "assistant", "content": "<soundcheck-findings>[]"}],
+    ]
+    assert (usage.requests, usage.continuations, usage.output_tokens) == (3, 2, 15)
+
+
+def test_stream_review_stops_once_every_block_is_closed():
+    client = FakeClient(replay(("<soundcheck-findings>[]</soundcheck-findings>", "max_tokens")))
+    message = sra.stream_review(client, {"messages": []}, lambda text: None,
+                                finished=lambda: True)
+    assert message.stop_reason == "max_tokens"
+    assert len(client.requests) == 1
+
+
+# --- triage_jobs ------------------------------------------------------------
+
+def test_triage_jobs_escalates_confident_medium_or_higher_candidates():
+    candidates = {
+        "a.py": [{"file": "a.py", "severity": "High", "confidence": 0.9},
+                 {"file": "b.py", "severity": "Critical", "confidence": 0.2},
+                 {"file": "b.py", "severity": "Low", "confidence": 1.0}],
+        "c.py": [{"file": "c.py", "severity": "Low", "confidence": 1.0}],
+        "d.py": [{"file": "d.py#L1-L50", "severity": "Medium"}],
+    }
+
+    def respond(request):
+        content = str(request["messages"])
+        if "e.py" in content:
+            raise sra.anthropic.APIConnectionError(request=None)
+        [found] = [found for rel, found in candidates.items() if rel in content]
+        return f"<soundcheck-findings>{json.dumps(found)}</soundcheck-findings>", "end_turn"
+
+    first = [("a.py", "x"), ("b.py", "x"), ("ctx.py", "x")]
+    jobs = [(0, first), (0, [("c.py", "x")]), (1, [("d.py", "x"), ("d2.py", "x")]),
+            (1, [("e.py", "x")])]
+    groups = [(None, "skill one", []), ("injection", "skill two", [])]
+    usage = sra.TokenUsage()
+    escalated = sra.triage_jobs(FakeClient(respond), "triage", groups, jobs, 2, {"ctx.py"},
+                                0.5, usage)
+    assert escalated == [
+        (0, [("a.py", "x"), ("ctx.py", "x")]),
+        (1, [("d.py", "x")]),  # a candidate on a chunk label counts for its file
+        (1, [("e.py", "x")]),  # a failed triage request escalates the whole shard
+    ]
+    assert usage.requests == 3
+
+
+def test_review_files_counts_triage_requests_in_its_usage():
+    found = '[{"file": "a.py", "severity": "High", "confidence": 1.0}]'
+    client = FakeClient(lambda request: (
+        f"<soundcheck-findings>{found}</soundcheck-findings>", "end_turn"
+    ))
+    result = sra.review_files(client, "review", [(None, "skill", [("a.py", "x")])], 1,
+                              triage_model="triage")
+    assert [r["model"] for r in client.requests] == ["triage", "review"]
+    assert result.usage.requests == 2
+
+
+# --- fix_findings -----------------------------------------------------------
+
+def test_fix_findings_merges_each_files_edits_into_its_shard():
+    def respond(request):
+        content = str(request["messages"])
+        if "b.py" in content:
+            raise sra.anthropic.APIConnectionError(request=None)
+        return '<soundcheck-rewrite file="a.py">\nfixed\n</soundcheck-rewrite>', "end_turn"
+
+    shard = [("a.py", "x"), ("b.py", "y"), ("c.py", "z"), ("ctx.py", "w")]
+    findings = [{"file": "a.py", "severity": "High"}, {"file": "b.py", "severity": "Medium"},
+                {"file": "c.py", "severity": "Low"}, {"file": "ctx.py", "severity": "High"}]
+    jobs = [(0, shard), (0, [("d.py", "v")])]
+    outcomes = [(findings, {}, True), ([{"file": "d.py", "severity": "High"}], {}, False)]
+    client = FakeClient(respond)
+    merged, unfixed = sra.fix_findings(client, "model", [(None, "skill", [])], jobs, outcomes,
+                                       2, {"ctx.py"})
+    # Only a.py and b.py have a fixable finding in a complete outcome
+    assert len(client.requests) == 2
+    assert merged == [(findings, {"a.py": ("rewrite", "fixed")}, True), outcomes[1]]
+    assert unfixed == {"b.py"}
+    assert outcomes[0][1] == {}  # the phase-one outcomes are left as they were
+
+
+# --- group_flows ------------------------------------------------------------
+
+def test_group_flows_merges_shared_files_only_within_shard_tokens():
+    units = [(rel, "x" * 400) for rel in ("a.py", "b.py", "c.py", "d.py", "helper.py")]
+    size = {rel: sra._file_tokens(rel, content) for rel, content in units}
+    flows = [{"files": ["a.py", "helper.py"]}, {"files": ["b.py", "helper.py"]},
+             {"files": ["c.py", "helper.py"]}, {"files": ["a.py"]}, {"files": ["d.py"]}]
+    fits_two_flows = size["a.py"] + size["b.py"] + size["helper.py"]
+    assert sra.group_flows(flows, units, fits_two_flows) == [
+        {"a.py", "b.py", "helper.py"},
+        {"c.py", "helper.py"},  # a third flow would not fit, so the helper is repeated
+        {"d.py"},
+    ]
+    assert sra.group_flows(flows, units, sum(size.values())) == [
+        {"a.py", "b.py", "c.py", "helper.py"}, {"d.py"},
+    ]
+
+
+# --- callee_context ---------------------------------------------------------
+
+def test_callee_context_sends_each_called_definition_once(tmp_path):
+    files = {
+        "app/__init__.py": "",
+        "app/util.py": "import subprocess\n\n\ndef run_it(cmd):\n    return subprocess.run(cmd)"
+                       "\n\n\ndef unused():\n    pass\n",
+        "app/views.py": "from app.util import run_it\n\n\ndef view(x):\n    return run_it(x)\n",
+        "app/api.py": "from app import util\n\n\ndef api(x):\n    return util.run_it(x)\n",
+    }
+    for rel, content in files.items():
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text(content)
+    index = sra.build_symbol_index(tmp_path, sorted(files))
+    units = [(rel, files[rel]) for rel in ("app/views.py", "app/api.py")]
+
+    out, excerpts, refs = sra.callee_context(tmp_path, units, index)
+    assert [label for label, _ in out] == ["app/views.py", "app/util.py#L4-L5", "app/api.py"]
+    assert out[1][1] == "def run_it(cmd):\n    return subprocess.run(cmd)\n"
+    assert excerpts["app/util.py#L4-L5"] == sra.Chunk("app/util.py", 3, 5)
+    # The second caller depends on the excerpt sent after the first
+    assert refs == {"app/views.py": ["app/util.py#L4-L5"], "app/api.py": ["app/util.py#L4-L5"]}
+
+
+def test_callee_context_skips_files_already_in_the_set(tmp_path):
+    (tmp_path / "util.py").write_text("def helper():\n    pass\n")
+    (tmp_path / "main.py").write_text("import util\n\nutil.helper()\n")
+    index = sra.build_symbol_index(tmp_path, ["main.py", "util.py"])
+    units = [("main.py", "import util\n\nutil.helper()\n"),
+             ("util.py", "def helper():\n    pass\n")]
+    assert sra.callee_context(tmp_path, units, index) == (units, {}, {})